@@ -4,7 +4,7 @@ import logging
 from blueprints.course import course
 from blueprints.task import task
 from blueprints.user import user
-from blueprints.testing import testing
+from blueprints.testing import testing, resume_batch_automark_jobs
 
 logging.basicConfig(level=logging.WARNING)
 logging.getLogger("werkzeug").setLevel(logging.WARNING)
@@ -18,6 +18,9 @@ app.register_blueprint(testing, url_prefix="/api/testing")
 
 CORS(app)
 
+# Carry on with any batch automark the server was in the middle of when it stopped
+resume_batch_automark_jobs()
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=9900, debug=True)
@@ -1,10 +1,14 @@
+import base64
+import hashlib
 import logging
 import re
-from firebase import db
+from datetime import datetime
+from firebase import db, bucket
 from firebase_admin import auth
 from flask import request, jsonify
 from functools import wraps
 from cache.user_cache import get_user_cache
+from grading.compare import expected_output_digests
 
 # Helper function to validate token and return the user's zID
 def verify_token(token):
@@ -67,6 +71,51 @@ def get_script_path(course_code, task, hidden):
     return path
 
 
+# Helper function to get N out of a blob in a test case folder, i.e.
+# "{course}/{task}/scripts/{autotest|automark}/test_N/...". Returns None for
+# anything else in the scripts folder, like run.sh or build.sh.
+def get_test_number(blob_name):
+    test_case_match = re.match(
+        r"^[^/]+/[^/]+/scripts/(autotest|automark)/test_([0-9]+)/", blob_name
+    )
+    if test_case_match is None:
+        return None
+    return int(test_case_match.group(2))
+
+
+# Reference solutions (the admin's own answer to a task, used to calibrate the
+# tests' limits) are stored like a submission from this made up zID, i.e. at
+# "{course}/{task}/reference/{timestamp}/", so they can be graded like one.
+REFERENCE_SOLUTION_ZID = "reference"
+
+
+# Helper function to find the timestamp of the latest reference solution uploaded
+# for a task, None if there isn't one
+def get_latest_reference_timestamp(course_code, task):
+    prefix = f"{course_code}/{task}/{REFERENCE_SOLUTION_ZID}/"
+    timestamps = {
+        blob.name[len(prefix) :].split("/")[0]
+        for blob in bucket.list_blobs(prefix=prefix)
+    }
+    if not timestamps:
+        return None
+    return max(
+        timestamps, key=lambda timestamp: datetime.strptime(timestamp, "%d-%m-%Y %X")
+    )
+
+
+# Helper function to work out the parameters.json fields that let grading skip
+# normalising the expected output. "expected_output_md5" is in the same format as
+# Cloud Storage's md5_hash so the runner can tell if "out" changed behind our back.
+def get_expected_output_parameters(output_bytes):
+    return {
+        "expected_output_md5": base64.b64encode(
+            hashlib.md5(output_bytes).digest()
+        ).decode("utf-8"),
+        "expected_output_digests": expected_output_digests(output_bytes),
+    }
+
+
 # Helper function to fetch students data from Firestore
 def get_student_results(course_code, task_name):
     students_data = []
@@ -7,7 +7,9 @@ from werkzeug.utils import secure_filename
 import os
 from io import StringIO, BytesIO
 import csv
+import zipfile
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 from blueprints.helpers import (
     get_student_results,
@@ -19,12 +21,21 @@ from blueprints.helpers import (
     USER_LEVEL_STUDENT,
     USER_LEVEL_ZID_DOESNT_EXIST,
     get_script_path,
+    get_test_number,
+    get_expected_output_parameters,
+    REFERENCE_SOLUTION_ZID,
     authorize
 )
+from blueprints.testing import get_autotest_version, start_speculative_autotest
 from firebase import db, bucket
+from cache.suite_bundles import publish_suite_bundle
+from grading.submission_archives import load_submission_files, store_submission_archive
 
 task = Blueprint("task", __name__)
 
+# How many students' submissions an export downloads at the same time
+EXPORT_DOWNLOAD_THREADS = int(os.environ.get("IGIVE_EXPORT_DOWNLOAD_THREADS", 16))
+
 
 @task.route("/query_tasks", methods=["GET"])
 @authorize(allowed_user_levels=[USER_LEVEL_STUDENT, USER_LEVEL_TUTOR, USER_LEVEL_ADMIN])
@@ -70,6 +81,8 @@ def set_task_data():
             - "percent_deduction_per_day": the percentage deduction per day
             - "late_day_type": the type of late day (CALENDAR or BUSINESS)
             - "max_late_days": the maximum number of late days
+        - "speculative_autotest": optional, true to start the autotests of every submission as soon as
+          it's uploaded, so they're ready by the time the student runs them
     Headers:
         - "Authorization": the user's JWT token
     Returns:
@@ -153,6 +166,10 @@ def set_task_data():
                 "percentDeductionPerDay": percent_deduction_per_day,
             },
         }
+        if "speculative_autotest" in data:
+            new_task_details["speculativeAutotest"] = bool(
+                data["speculative_autotest"]
+            )
 
         task_collection_ref.document(task_name).set(new_task_details, merge=True)
 
@@ -184,6 +201,7 @@ def get_task_data(course_code, task_name, user_zid, user_level):
             - "allowedFileTypes": a list of allowed file types
             - "maxFileSize": the maximum file size in MB
             - "requiredFiles": a list of required files
+            - "speculativeAutotest": whether autotests start as soon as a submission is uploaded
         - 401 status code if token is invalid
         - 403 status code if user is not an admin
         - 404 status code if task data is not found
@@ -234,6 +252,7 @@ def get_task_data(course_code, task_name, user_zid, user_level):
             "allowedFileTypes": allowed_file_types,
             "maxFileSize": max_file_size,
             "requiredFiles": required_files,
+            "speculativeAutotest": task_data.get("speculativeAutotest", False),
         }
 
         return jsonify(response_data), 200
@@ -246,13 +265,15 @@ def get_task_data(course_code, task_name, user_zid, user_level):
 @task.route("/upload_script", methods=["POST"])
 def upload_script():
     """
-    Route to upload a new run.sh to a task in order to run autotests
+    Route to upload a new run.sh to a task in order to run autotests, or a build.sh
+    that is run once per submission before any of the tests (e.g. to compile it)
     Request body:
     formdata containing:
         - "task": the task name to upload the script for
         - "course_code": the course code in which the task is located
         - "hidden": a boolean indicating if the script is for automark (true) or autotest (false)
-        - "script": the run.sh file to upload
+        - "script": the run.sh (or build.sh) file to upload
+        - "script_type": optional, "run" (the default) or "build"
     Headers:
         - "Authorization": the user's JWT token
     Returns:
@@ -269,16 +290,113 @@ def upload_script():
         return jsonify({"error": "Unauthorised"}), 401
 
     script = request.files["script"]
+    script_type = request.form.get("script_type", "run")
+    if script_type not in ["run", "build"]:
+        return jsonify({"error": "script_type must be either run or build"}), 400
 
     url = (
-        get_script_path(course_code, task, request.form["hidden"] == "true") + "run.sh"
+        get_script_path(course_code, task, request.form["hidden"] == "true")
+        + f"{script_type}.sh"
     )
 
     blob = bucket.blob(url)
     blob.upload_from_file(script)
+    publish_suite_bundle(course_code, task, request.form["hidden"] == "true")
     return jsonify({"message": "Script uploaded"}), 200
 
 
+@task.route(
+    "/delete_build_script/<course_code>/<task_name>/<hidden>", methods=["DELETE"]
+)
+def delete_build_script(course_code, task_name, hidden):
+    """
+    Route to remove the build.sh of a task, so submissions aren't built before testing
+    Parameters:
+        - "course_code": the course code in which the task is located
+        - "task_name": the task name
+        - "hidden": a boolean indicating if the script is for automark (true) or autotest (false)
+    Headers:
+        - "Authorization": the user's JWT token
+    Returns:
+        - 200 status code with json confirming the script was deleted
+        - 401 status code if user is not an admin
+        - 404 status code if the task has no build.sh
+    """
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+    level = get_user_level(logged_in_zid, course_code)
+    if level != USER_LEVEL_ADMIN:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    blob = bucket.blob(
+        get_script_path(course_code, task_name, hidden == "true") + "build.sh"
+    )
+    if not blob.exists():
+        return jsonify({"error": "This task has no build script"}), 404
+
+    blob.delete()
+    publish_suite_bundle(course_code, task_name, hidden == "true")
+    return jsonify({"message": "Build script deleted"}), 200
+
+
+@task.route("/upload_reference_solution", methods=["PUT"])
+def upload_reference_solution():
+    """
+    Route to upload a reference solution for a task, i.e. code that passes every
+    test. It isn't a submission, it is used by /testing/calibrate to measure what
+    the tests really need and set their limits from that.
+    Request body:
+    formdata containing:
+        - "course_code": the course code in which the task is located
+        - "task": the task name to upload the reference solution for
+        - "files[]": the files of the reference solution
+    Headers:
+        - "Authorization": the user's JWT token
+    Returns:
+        - 200 status code with json containing:
+            - "message": confirming the files were uploaded
+            - "timestamp": the timestamp the reference solution was stored under
+        - 400 status code if no files were uploaded
+        - 401 status code if user is not an admin
+        - 404 status code if the task is not found
+    """
+    course_code = request.form["course_code"]
+    task_name = request.form["task"]
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+    level = get_user_level(logged_in_zid, course_code)
+    if level != USER_LEVEL_ADMIN:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    files = request.files.getlist("files[]")
+    if not files:
+        return jsonify({"error": "No files uploaded"}), 400
+
+    task_doc = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task_name)
+        .get()
+    )
+    if not task_doc.exists:
+        return jsonify({"error": "Task not found"}), 404
+
+    # Stored exactly like a submission, older ones are kept
+    timestamp = datetime.now(pytz.timezone("Australia/Sydney")).strftime("%d-%m-%Y %X")
+    for file in files:
+        blob = bucket.blob(
+            f"{course_code}/{task_name}/{REFERENCE_SOLUTION_ZID}/{timestamp}/"
+            f"{secure_filename(file.filename)}"
+        )
+        blob.upload_from_file(file)
+
+    return (
+        jsonify({"message": "Reference solution uploaded", "timestamp": timestamp}),
+        200,
+    )
+
+
 @task.route("/get_script/<course_code>/<task_name>", methods=["GET"])
 @authorize(allowed_user_levels=[USER_LEVEL_ADMIN])
 def get_script(course_code, task_name, user_zid, user_level):
@@ -452,8 +570,9 @@ def edit_test(course_code, task_name, test_name, hidden):
         if blob.name.endswith("/"):
             continue
 
-        curr = blob.name.split("/")[4]
-        curr = int(curr[5:])
+        curr = get_test_number(blob.name)
+        if curr is None:
+            continue
         if curr > max:
             max = curr
 
@@ -569,11 +688,25 @@ def edit_test(course_code, task_name, test_name, hidden):
                     "ignore_trailing_whitespaces",
                 ]
 
+                # precompute the expected output under every tolerance filter combination
+                parameters_content.update(
+                    get_expected_output_parameters(
+                        request.form["output"].encode("utf-8")
+                    )
+                )
+
                 # upload updated parameters.json
                 blob.upload_from_string(
                     json.dumps(parameters_content), content_type="text/plain"
                 )
 
+                # repack the suite(s) that changed for the graders
+                publish_suite_bundle(
+                    course_code, task_name, request.form["hidden"] == "true"
+                )
+                if isMoved:
+                    publish_suite_bundle(course_code, task_name, hidden == "true")
+
                 return (
                     jsonify(
                         {
@@ -629,6 +762,7 @@ def delete_test(course_code, task_name, hidden, test_name):
     deleting_blobs = bucket.list_blobs(prefix=url + deleting + "/")
     for blob in deleting_blobs:
         blob.delete()
+    publish_suite_bundle(course_code, task_name, hidden == "true")
     return jsonify({"message": f"{task_name} deleted"}), 200
 
 
@@ -717,8 +851,9 @@ def add_autotest_from_string():
         if blob.name.endswith("/"):
             continue
 
-        curr = blob.name.split("/")[4]
-        curr = int(curr[5:])
+        curr = get_test_number(blob.name)
+        if curr is None:
+            continue
         if curr > max:
             max = curr
 
@@ -735,12 +870,22 @@ def add_autotest_from_string():
     memory_megabytes = request.form["memory_megabytes"]
 
     # @everyone: revisit
-    default_json = f'{{"cpu_time": {int(cpu_time)}, "memory_megabytes": {int(memory_megabytes)}, "runner_args": "{runner_args}", "test_name": "{test_name}", "tolerance_filters": ["ignore_trailing_newline", "ignore_trailing_whitespaces"]}}'
+    default_parameters = {
+        "cpu_time": int(cpu_time),
+        "memory_megabytes": int(memory_megabytes),
+        "runner_args": runner_args,
+        "test_name": test_name,
+        "tolerance_filters": ["ignore_trailing_newline", "ignore_trailing_whitespaces"],
+    }
 
-    parameters.upload_from_string(default_json)
+    # precompute the expected output under every tolerance filter combination
+    default_parameters.update(get_expected_output_parameters(output.encode("utf-8")))
+
+    parameters.upload_from_string(json.dumps(default_parameters))
 
     blob_input.upload_from_string(input)
     blob_output.upload_from_string(output)
+    publish_suite_bundle(course_code, task, request.form["hidden"] == "true")
     test_type = "automark" if request.form["hidden"] == "true" else "autotest"
     return jsonify({"message": f"{test_name} added as {test_type} {file_count}"}), 200
 
@@ -792,8 +937,9 @@ def add_autotest_from_file():
         if blob.name.endswith("/"):
             continue
 
-        curr = blob.name.split("/")[4]
-        curr = int(curr[5:])
+        curr = get_test_number(blob.name)
+        if curr is None:
+            continue
         if curr > max:
             max = curr
 
@@ -810,11 +956,22 @@ def add_autotest_from_file():
     memory_megabytes = request.form["memory_megabytes"]
 
     # @everyone: revisit
-    default_json = f'{{"cpu_time": {int(cpu_time)}, "memory_megabytes": {int(memory_megabytes)}, "runner_args": "{runner_args}", "test_name": "{test_name}", "tolerance_filters": ["ignore_trailing_newline", "ignore_trailing_whitespaces"]}}'
+    default_parameters = {
+        "cpu_time": int(cpu_time),
+        "memory_megabytes": int(memory_megabytes),
+        "runner_args": runner_args,
+        "test_name": test_name,
+        "tolerance_filters": ["ignore_trailing_newline", "ignore_trailing_whitespaces"],
+    }
+
+    # precompute the expected output under every tolerance filter combination
+    default_parameters.update(get_expected_output_parameters(output.read()))
+    output.seek(0)
 
-    parameters.upload_from_string(default_json)
+    parameters.upload_from_string(json.dumps(default_parameters))
     blob_input.upload_from_file(input)
     blob_output.upload_from_file(output)
+    publish_suite_bundle(course_code, task, request.form["hidden"] == "true")
     test_type = "automark" if request.form["hidden"] == "true" else "autotest"
     return jsonify({"message": f"{test_name} added as {test_type} {file_count}"}), 200
 
@@ -1187,6 +1344,19 @@ def upload_submissions():
             )
             blob.upload_from_file(file)
 
+        # Also pack the whole submission into one archive, grading and exports
+        # fetch that instead of every file. Without one they use the files above.
+        try:
+            archived_files = []
+            for file in files:
+                file.seek(0)
+                archived_files.append((file.filename, file.read()))
+            store_submission_archive(
+                course_code, task, logged_in_zid, formatted_time, archived_files
+            )
+        except Exception as e:
+            logging.error(f"Couldn't archive the submission of {logged_in_zid}: {e}")
+
         # Create database reference
         student_ref = (
             db.collection("courses")
@@ -1214,6 +1384,20 @@ def upload_submissions():
         # Update the database with submission info
         student_ref.set(submission_data)
 
+        # Students nearly always run the autotests straight after uploading. If the
+        # task opted in, start them now so the results are ready when they ask.
+        if task_data.get("speculativeAutotest"):
+            try:
+                start_speculative_autotest(
+                    course_code,
+                    task,
+                    logged_in_zid,
+                    formatted_time,
+                    get_autotest_version(task_data),
+                )
+            except Exception as e:
+                logging.error(f"Couldn't start autotests for {logged_in_zid}: {e}")
+
         return (
             jsonify(
                 {
@@ -1264,16 +1448,16 @@ def check_submissions(course_code, user_zid, user_level):
     blobs = bucket.list_blobs(prefix=path)
 
     # Blobs contains all files and subdirectories recursively...why Google?
-    # Need to filter for all the submission times, and requery for the list of files in that time
-    sub_times = set()
+    # Which means it already has every file of every submission, just group them
+    # by submission time
+    files_by_time = {}
     for blob in blobs:
-        # Determine whether this is the top level subdirectory
-        # Necessary as list_blobs is recursive
+        # Only what's inside a submission time subdirectory
         parents = blob.name.split("/")
-        if len(parents) > 3:
-            sub_times.add(parents[3])
+        if len(parents) > 4:
+            files_by_time.setdefault(parents[3], []).append(blob.name)
 
-    sub_times = list(sub_times)
+    sub_times = list(files_by_time)
     sub_times.sort(
         key=lambda x: datetime.strptime(x, "%d-%m-%Y %H:%M:%S").timestamp(),
         reverse=True,
@@ -1281,11 +1465,7 @@ def check_submissions(course_code, user_zid, user_level):
 
     response = {"submissions": OrderedDict()}
     for sub_time in sub_times:
-        blobs = bucket.list_blobs(prefix=f"{path}{sub_time}/")
-        for blob in blobs:
-            if sub_time not in response["submissions"]:
-                response["submissions"][sub_time] = []
-            response["submissions"][sub_time].append(blob.name)
+        response["submissions"][sub_time] = files_by_time[sub_time]
 
     return response
 
@@ -1456,6 +1636,78 @@ def generate_csv(course_code, task_name, user_zid, user_level):
         return jsonify({"error": str(e)}), 500
 
 
+@task.route("/export_submissions/<course_code>/<task_name>", methods=["GET"])
+@authorize(allowed_user_levels=[USER_LEVEL_TUTOR, USER_LEVEL_ADMIN])
+def export_submissions(course_code, task_name, user_zid, user_level):
+    """
+    Route to download every student's latest submission for a task in one zip
+    Parameters:
+        - "course_code": the course code in which the task is located
+        - "task_name": the task name to export
+    Headers:
+        - "Authorization": the user's JWT token
+    Returns:
+        - 200 status code with a zip file as an attachment, with a "{zid}/" folder
+          holding the files of each student's latest submission
+        - 403 status code if user is not a tutor or admin of the course
+        - 404 status code if the task is not found
+        - 500 status code if an error occurs
+    """
+    try:
+        task_ref = (
+            db.collection("courses")
+            .document(course_code)
+            .collection("tasks")
+            .document(task_name)
+        )
+        if not task_ref.get().exists:
+            return jsonify({"error": "Task not found"}), 404
+
+        # Every student with a result record has submitted at least once
+        submissions = []
+        for doc in task_ref.collection("results").stream():
+            last_submitted = doc.to_dict().get("lastSubmitted")
+            if last_submitted:
+                submissions.append((doc.id, last_submitted))
+
+        # Mostly waiting on storage, hence the threads. Archived submissions are
+        # one download each.
+        def fetch_submission(submission):
+            zid, submission_timestamp = submission
+            files = []
+            for blob in load_submission_files(
+                course_code, task_name, zid, submission_timestamp
+            ):
+                if hasattr(blob, "open_local"):
+                    data = blob.open_local().read()
+                else:
+                    data = blob.download_as_bytes()
+                files.append((blob.name.split("/")[-1], data))
+            return zid, files
+
+        with ThreadPoolExecutor(max_workers=EXPORT_DOWNLOAD_THREADS) as executor:
+            fetched = list(executor.map(fetch_submission, submissions))
+
+        output = BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as export:
+            for zid, files in fetched:
+                for file_name, data in files:
+                    if file_name:
+                        export.writestr(f"{zid}/{file_name}", data)
+
+        output.seek(0)
+        return send_file(
+            output,
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name=f"{course_code}_{task_name}_submissions.zip",
+        )
+
+    except Exception as e:
+        logging.error(f"Error exporting submissions: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
 @task.route("/set_file_restrictions", methods=["POST"])
 def set_file_restrictions():
     """
@@ -1956,6 +2208,39 @@ def get_tolerance_filters(course_code, user_zid, user_level):
         return jsonify({"error": f"Error getting tolerance filters: {str(e)}"}), 500
 
 
+def refresh_expected_output_parameters(url):
+    """
+    Makes sure every test under the given scripts folder has up to date precomputed
+    expected outputs in its parameters.json.
+    """
+    blobs = {blob.name: blob for blob in bucket.list_blobs(prefix=url)}
+    for name, blob in blobs.items():
+        if not name.endswith("parameters.json"):
+            continue
+
+        directory_prefix = name.rsplit("parameters.json", 1)[0]
+        out_blob = blobs.get(directory_prefix + "out")
+        if out_blob is None:
+            continue
+
+        parameters_content = json.loads(blob.download_as_string().decode("utf-8"))
+        if (
+            parameters_content.get("expected_output_md5") == out_blob.md5_hash
+            and "expected_output_digests" in parameters_content
+        ):
+            continue
+
+        try:
+            parameters_content.update(
+                get_expected_output_parameters(out_blob.download_as_bytes())
+            )
+            blob.upload_from_string(
+                json.dumps(parameters_content), content_type="text/plain"
+            )
+        except Exception as e:
+            logging.error(f"Could not precompute expected output of {name}: {str(e)}")
+
+
 @task.route("/set_tolerance_filters", methods=["PUT"])
 def set_tolerance_filters():
     """
@@ -2016,6 +2301,15 @@ def set_tolerance_filters():
 
         task_ref.set({"toleranceFilters": tolerance_filters}, merge=True)
 
+        # Tests made before expected outputs were precomputed (or whose out was
+        # replaced directly in storage) get their digests worked out now rather
+        # than on every grading run.
+        for hidden in [False, True]:
+            refresh_expected_output_parameters(
+                get_script_path(course_code, task_name, hidden)
+            )
+            publish_suite_bundle(course_code, task_name, hidden)
+
         return (
             jsonify({"message": "Tolerance filter settings saved successfully."}),
             200,
@@ -1,15 +1,21 @@
 from datetime import datetime, timedelta
+import hashlib
 import os
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, Response, stream_with_context
 import logging
 import re
-import tempfile
 import re
 import json
-import resource
 import subprocess
 import shlex
+import shutil
+import signal
 import math
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from blueprints.helpers import (
     USER_LEVEL_TUTOR,
     verify_token,
@@ -17,15 +23,186 @@ from blueprints.helpers import (
     USER_LEVEL_ADMIN,
     USER_LEVEL_NOT_MEMBER,
     USER_LEVEL_STUDENT,
+    get_script_path,
+    get_test_number,
+    get_latest_reference_timestamp,
+    REFERENCE_SOLUTION_ZID,
+)
+from cache.build_cache import build_cache_key, restore_build, store_build
+from cache.fixture_cache import copy_fixture, read_fixture
+from cache.suite_bundles import (
+    get_suite_fixtures,
+    publish_suite_bundle,
+    suite_bundle_kind,
+)
+from cache.result_cache import (
+    get_cached_results,
+    result_cache_key,
+    store_cached_results,
+)
+from grading.batch_jobs import (
+    claim_batch_item,
+    create_batch_job,
+    finish_batch_item,
+    get_batch_job,
+    get_unfinished_batch_items,
+)
+from grading.compare import (
+    TOLERANCE_FILTERS,
+    compare_outputs,
+    normalise_newlines,
+    output_digest,
+    tolerance_filters_key,
+)
+from grading.raw_outputs import (
+    RAW_OUTPUTS_TOTAL_LIMIT_BYTES,
+    execution_hash,
+    load_raw_outputs,
+    make_raw_output,
+    raw_output_size,
+    raw_outputs_path,
+    store_raw_outputs,
+    stored_runner_result,
+    submission_digest,
+)
+from grading.sandbox_fs import remove_sandbox_later, sandbox_directory
+from grading.sandbox_pool import allow_sandbox_helpers, run_sandboxed
+from grading.submission_archives import load_submission_files, submission_exists
+from grading.test_usage import (
+    get_test_runtimes,
+    get_test_usage_stats,
+    record_test_usage,
+)
+from grading.job_queue import grading_affinity
+from grading.scheduler import GradingQueueFullError
+from grading.worker_pool import (
+    GRADING_JOB_STATUS_FAILED,
+    GRADING_JOB_STATUS_RUNNING,
+    GRADING_LANE_BATCH,
+    GRADING_LANE_CALIBRATION,
+    GRADING_LANE_SPECULATIVE,
+    GRADING_WORKER_CPUS,
+    create_grading_stream,
+    find_grading_job,
+    get_grading_job,
+    get_grading_wait_seconds,
+    schedule_grading,
+    share_grading_job,
+    submit_grading_job,
+    wait_for_grading_job,
 )
 from firebase import db, bucket
 
 testing = Blueprint("testing", __name__)
 
-TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE = "ignoreTrailingNewline"
-TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES = "ignoreTrailingWhitespaces"
-TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT = "ignoreWhitespacesAmount"
-TOLERANCE_FILTER_IGNORE_CASE_DIFFERENCES = "ignoreCaseDifferences"
+GRADING_JOB_KIND_AUTOTEST = "autotest"
+GRADING_JOB_KIND_AUTOMARK = "automark"
+GRADING_JOB_KIND_CALIBRATION = "calibration"
+
+# How often a streaming endpoint sends something when there are no results to send
+SSE_KEEP_ALIVE_SECONDS = 15
+
+# Batch automark jobs feed a whole cohort to the grading workers from these threads
+BATCH_AUTOMARK_WORKERS = int(os.environ.get("IGIVE_BATCH_AUTOMARK_WORKERS", 2))
+batch_automark_executor = ThreadPoolExecutor(
+    max_workers=BATCH_AUTOMARK_WORKERS, thread_name_prefix="batch-automark"
+)
+
+# Speculative autotests started by this process, kept after they finish for as long
+# as their grading job is, (course_code, task, zid, submission_timestamp) ->
+# (job_id, autotest_version)
+_speculative_jobs = {}
+_speculative_jobs_lock = threading.Lock()
+
+# How many students' stored outputs a what-if regrade downloads at the same time
+REGRADE_DOWNLOAD_THREADS = int(os.environ.get("IGIVE_REGRADE_DOWNLOAD_THREADS", 16))
+
+# Calibration proposes limits this many times what the reference solution used,
+# unless the request asks for something else. Memory never goes below the minimum,
+# the runner's shell and the interpreter need some no matter what.
+CALIBRATION_DEFAULT_MULTIPLIER = float(
+    os.environ.get("IGIVE_CALIBRATION_MULTIPLIER", 3)
+)
+CALIBRATION_MIN_MEMORY_MEGABYTES = int(
+    os.environ.get("IGIVE_CALIBRATION_MIN_MEMORY_MB", 64)
+)
+CALIBRATION_MAX_RUNS = 5
+
+# How many test cases of a single run_testing() call are allowed to run at the same
+# time. Each test case gets its own working directory so they can't see each other.
+# By default a grading worker's share of the CPUs, there are GRADING_WORKERS of them.
+# With the default of one grading worker per CPU that is 1, i.e. a submission's
+# tests run one after another and submissions are graded in parallel instead. A
+# course can still set "testParallelism" (see get_test_parallelism()), and
+# IGIVE_TEST_PARALLELISM or fewer IGIVE_GRADING_WORKERS raise the default.
+DEFAULT_TEST_PARALLELISM = int(
+    os.environ.get("IGIVE_TEST_PARALLELISM", GRADING_WORKER_CPUS)
+)
+
+# How much a test's runner may print (per stream) unless its parameters.json says
+# otherwise with "output_limit_bytes". Anything over gets it killed, so a runaway
+# print loop can't fill the disk or the grading worker's memory.
+DEFAULT_OUTPUT_LIMIT_BYTES = int(os.environ.get("IGIVE_OUTPUT_LIMIT_KB", 1024)) * 1024
+# Reports only ever show this much of any input, output or diff, half from the
+# start and half from the end
+REPORT_EXCERPT_BYTES = int(os.environ.get("IGIVE_REPORT_EXCERPT_KB", 16)) * 1024
+
+# A test's "cpu_time" is enforced as real CPU time (RLIMIT_CPU) so a busy machine
+# doesn't fail anyone. A runner that isn't using CPU (e.g. stuck reading stdin or
+# sleeping) is still killed after cpu_time * factor + slack seconds of wall time.
+WALL_TIME_LIMIT_FACTOR = float(os.environ.get("IGIVE_WALL_TIME_FACTOR", 3))
+WALL_TIME_LIMIT_SLACK_SECONDS = float(os.environ.get("IGIVE_WALL_TIME_SLACK", 2))
+# A crashed runner whose peak memory got this close to its memory limit is
+# reported as having run out of memory, as is one that complains about it
+MEMORY_LIMIT_THRESHOLD = 0.9
+OUT_OF_MEMORY_MESSAGES = [
+    b"MemoryError",
+    b"std::bad_alloc",
+    b"OutOfMemoryError",
+    b"Cannot allocate memory",
+    b"out of memory",
+]
+
+# Every test result has one of these as its "status"
+TEST_STATUS_PASSED = "passed"
+TEST_STATUS_FAILED = "failed"
+TEST_STATUS_CPU_TIME_LIMIT = "cpu_time_limit_exceeded"
+TEST_STATUS_WALL_TIME_LIMIT = "wall_time_limit_exceeded"
+TEST_STATUS_MEMORY_LIMIT = "memory_limit_exceeded"
+TEST_STATUS_OUTPUT_LIMIT = "output_limit_exceeded"
+TEST_STATUS_BUILD_FAILED = "build_failed"
+TEST_STATUS_BUILD_TIME_LIMIT = "build_time_limit_exceeded"
+TEST_STATUS_SKIPPED = "skipped"
+TEST_STATUS_ERROR = "error"
+# The ones that only depend on the code and the test, so can be cached and reused.
+# Wall time limits and server errors could just mean the machine was busy.
+FINAL_TEST_STATUSES = [
+    TEST_STATUS_PASSED,
+    TEST_STATUS_FAILED,
+    TEST_STATUS_CPU_TIME_LIMIT,
+    TEST_STATUS_MEMORY_LIMIT,
+    TEST_STATUS_OUTPUT_LIMIT,
+    TEST_STATUS_BUILD_FAILED,
+]
+
+# Limits for a task's build.sh, which runs once per submission before the tests
+BUILD_TIME_LIMIT_SECONDS = int(os.environ.get("IGIVE_BUILD_TIME_LIMIT", 60))
+BUILD_MEMORY_LIMIT_MEGABYTES = int(os.environ.get("IGIVE_BUILD_MEMORY_MB", 2048))
+
+
+def get_test_parallelism(course_dict) -> int:
+    # An admin can override the global setting for a single course by setting
+    # "testParallelism" on the course document, e.g. to 1 for a course whose
+    # run.sh is not safe to run more than once at a time.
+    parallelism = course_dict.get("testParallelism", DEFAULT_TEST_PARALLELISM)
+    try:
+        parallelism = int(parallelism)
+    except (TypeError, ValueError):
+        logging.error(
+            f"Bad testParallelism value {parallelism}, using {DEFAULT_TEST_PARALLELISM}"
+        )
+        parallelism = DEFAULT_TEST_PARALLELISM
+    return max(1, parallelism)
 
 
 def run_testing(
@@ -34,7 +211,36 @@ def run_testing(
     course_code: str,
     task: str,
     submission_timestamp: str,
+    run_options=None,
+    on_result=None,
+    should_stop=None,
+    previous_outcomes=None,
+    test_hashes=None,
 ):
+    # on_result(index, result) is called as soon as each test case finishes, index
+    # being its position in the returned (sorted) list. Test cases that haven't
+    # started yet when should_stop() returns True are skipped and left out.
+
+    # run_options is what get_autotest_run_options() parsed out of the request:
+    #   - "fail_fast": stop starting test cases once this many have failed
+    #   - "time_budget": stop starting test cases after this many seconds
+    #   - "cheapest_first": run the historically quickest test cases first
+    #   - "always_run": really run every test case, no cached or stored results
+    #   - "limits": test case folder name (e.g. "test_3") -> {"cpu_time": ...,
+    #     "memory_megabytes": ...} to run those test cases under instead of their own
+    # Test cases that didn't run because of these are still reported, as skipped.
+    # Automark never passes any, every test has to run for the mark to mean anything.
+
+    # previous_outcomes lets a re-mark skip the test cases that haven't changed since
+    # this submission was last marked. It maps a test case's folder name (e.g. "test_3")
+    # to {"hash": its test_case_hash() back then, "result": its result back then}.
+    # If test_hashes is given it is filled in with folder name -> test_case_hash() for
+    # every test case, for the caller to store alongside the results.
+    run_options = run_options or {}
+    fail_fast = run_options.get("fail_fast")
+    time_budget = run_options.get("time_budget")
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
     # First we query the DB to see what tolerance filters are turned on by the admin
     tolerance_filters = []
     course_ref = db.collection("courses").document(course_code)
@@ -57,6 +263,8 @@ def run_testing(
                 if task_dict["toleranceFilters"][filter]:
                     tolerance_filters.append(filter)
 
+    parallelism = get_test_parallelism(course_doc.to_dict())
+
     # Then work out where in the storage bucket to grab files from
     path = f"{course_code}/{task}/scripts/"
     if is_autotest:
@@ -64,236 +272,900 @@ def run_testing(
     else:
         path += "automark/"
 
-    # Work out where all the test cases are. Again, Google's stupid list_blobs
-    # is recursive so we need to unrecurse it.
-    blobs = bucket.list_blobs(prefix=path)
-    test_cases_directories_set = set()
-    for blob in blobs:
-        test_case_match = re.match(
-            r"^([A-Z0-9]+/[^/]*/scripts/(autotest|automark)/test_[0-9]+/)", blob.name
+    # Work out where all the test cases are. The whole suite comes from its bundle
+    # in one go if it has one. Otherwise Google's stupid list_blobs is recursive so
+    # we need to unrecurse it. The listing carries each blob's generation, which is
+    # what the fixture cache keys on, so keep hold of them.
+    fixtures = get_suite_fixtures(path, task_dict, not is_autotest)
+    test_cases_storage = test_case_directories(fixtures)
+    hashes = {
+        test_case_dir: test_case_hash(fixtures, path, test_case_dir, tolerance_filters)
+        for test_case_dir in test_cases_storage
+    }
+    if test_hashes is not None:
+        test_hashes.update(
+            {
+                test_case_name(test_case_dir): hashes[test_case_dir]
+                for test_case_dir in hashes
+            }
         )
-        if test_case_match:
-            test_cases_directories_set.add(test_case_match.group(1))
+
+    # Reuse the old result of any test case that is exactly the same as last time
+    reused_results = {}
+    for index, test_case_dir in enumerate(test_cases_storage):
+        previous = (previous_outcomes or {}).get(test_case_name(test_case_dir))
+        if (
+            previous is not None
+            and previous["hash"] == hashes[test_case_dir]
+            and is_final_verdict(previous["result"])
+        ):
+            reused_results[index] = previous["result"]
+
+    # One request for the whole submission if it was archived when it was made
+    submission_blobs = load_submission_files(
+        course_code, task, zid_requested, submission_timestamp
+    )
+
+    # Has this exact code been graded against this exact suite before? (maybe by
+    # someone else, identical submissions share results)
+    cache_key = None
+    if not run_options.get("always_run"):
+        cache_key = result_cache_key(
+            submission_blobs, path, fixtures.values(), tolerance_filters
+        )
+    cached_results = get_cached_results(cache_key)
+    if cached_results is not None:
+        if on_result is not None:
+            for index, result in enumerate(cached_results):
+                on_result(index, result)
+        return cached_results
+
+    # If the runner's output from an earlier automark of this exact code was kept,
+    # and the test would still be run the same way, there's no need to run it
+    # again, just judge that output (e.g. the tolerance filters or expected output
+    # changed). Autotests don't keep outputs, see raw_outputs.py.
+    outputs_path = None
+    stored_outputs = {}
+    # What ran under other limits than the test case's own can't be judged again
+    # as if it hadn't, so that isn't kept
+    digest = None
+    if not is_autotest and not run_options.get("limits"):
+        digest = submission_digest(submission_blobs)
+    if digest is not None:
+        outputs_path = raw_outputs_path(course_code, task, digest)
+        stored_outputs = load_raw_outputs(outputs_path)
+    for index, test_case_dir in enumerate(test_cases_storage):
+        stored = stored_outputs.get(test_case_name(test_case_dir))
+        if index in reused_results or stored is None or run_options.get("always_run"):
+            continue
+        parameters = load_test_parameters(fixtures, test_case_dir)
+        if stored["execution_hash"] != execution_hash(
+            fixtures, path, test_case_dir, parameters
+        ):
+            continue
+        try:
+            reused_results[index] = rejudge_test_case(
+                test_case_dir, fixtures, tolerance_filters, stored
+            )
+        except Exception as e:
+            # just run it then
+            logging.error(f"Couldn't judge stored output of {test_case_dir}: {e}")
+
+    if len(reused_results) == len(test_cases_storage):
+        # nothing has to run at all, no need to even stage the submission
+        if on_result is not None:
+            for index, result in reused_results.items():
+                on_result(index, result)
+        return [reused_results[index] for index in range(len(test_cases_storage))]
 
     # For each test case, create a temp folder, copy in all the necessary file and execute
     # Not a true sandbox, but we ball
-    test_cases_storage = sorted(list(test_cases_directories_set))
-    run_result = []
-    with tempfile.TemporaryDirectory() as sandbox:
-        # Copy in the student's code
-        submission_path = f"{course_code}/{task}/{zid_requested}/{submission_timestamp}"
-        submission_blobs = bucket.list_blobs(prefix=submission_path)
+    with sandbox_directory() as sandbox:
+        # Stage the student's code and the runner once, every test case gets its
+        # own copy of this folder so they can't trample each other's files.
+        staging_dir = os.path.join(sandbox, "submission")
+        os.mkdir(staging_dir)
+
+        # Copy in the student's code. That goes through the fixture cache too, the
+        # same submission tends to get tested over and over (autotest, automark...)
         for blob in submission_blobs:
-            blob.download_to_filename(os.path.join(sandbox, blob.name.split("/")[-1]))
+            copy_fixture(blob, os.path.join(staging_dir, blob.name.split("/")[-1]))
 
-        # Copy in the runner
         runner_path = path + "run.sh"
-        runner_blob = bucket.blob(runner_path)
-        try:
-            runner_blob.download_to_filename(os.path.join(sandbox, "run.sh"))
-        except:
+        if runner_path not in fixtures:
             logging.error("No runner script found, aborting.")
             return None
 
-        for test_case_dir in test_cases_storage:
-            # grab the parameters
-            parameters_blob = bucket.blob(test_case_dir + "parameters.json")
-            parameters_str = parameters_blob.download_as_bytes().decode("utf-8")
-            # now deserialise it
-            parameters = json.loads(parameters_str)
-            runner_args = parameters["runner_args"]
-            cpu_time_limit = parameters["cpu_time"]
-            memory_limit = parameters["memory_megabytes"]
-
-            if isinstance(cpu_time_limit, str):
-                cpu_time_limit = int(cpu_time_limit)
-            if isinstance(memory_limit, str):
-                memory_limit = int(memory_limit)
-
-            # Download test files from storage
-            input_blob = bucket.blob(test_case_dir + "in")
-            input_blob.download_to_filename(os.path.join(sandbox, "in"))
-            output_blob = bucket.blob(test_case_dir + "out")
-            output_blob.download_to_filename(os.path.join(sandbox, "out"))
-
-            # Convert Windows' CRLF to *unix's LF
-            subprocess.run(
-                ["dos2unix", os.path.join(sandbox, "in")],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            subprocess.run(
-                ["dos2unix", os.path.join(sandbox, "out")],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+        # If the task has a build step (e.g. compiling C) do it once here, every
+        # test case then gets a copy of what it built
+        build_failure = None
+        if path + "build.sh" in fixtures:
+            build_failure = build_submission(
+                fixtures[path + "build.sh"], submission_blobs, staging_dir, sandbox
             )
 
-            # Apply tolerance filters to our reference in and out if necessary
-            if TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE in tolerance_filters:
-                subprocess.run(
-                    ["perl", "-i", "-pe", "'chomp if eof'", os.path.join(sandbox, "in")]
+        # Copy in the runner
+        copy_fixture(fixtures[runner_path], os.path.join(staging_dir, "run.sh"))
+
+        failures = 0
+        failures_lock = threading.Lock()
+        new_outputs = {}
+        new_outputs_size = 0
+        new_outputs_lock = threading.Lock()
+
+        def run_in_sandbox(index):
+            nonlocal failures
+            if should_stop is not None and should_stop():
+                return None
+
+            test_case_dir = test_cases_storage[index]
+            skip_reason = None
+            with failures_lock:
+                if fail_fast is not None and failures >= fail_fast:
+                    skip_reason = f"{failures} test(s) already failed."
+            if deadline is not None and time.monotonic() >= deadline:
+                skip_reason = f"The time budget of {time_budget} seconds ran out."
+
+            if index in reused_results:
+                result = reused_results[index]
+                if not result["passed"]:
+                    with failures_lock:
+                        failures += 1
+            elif build_failure is not None:
+                parameters = load_test_parameters(fixtures, test_case_dir)
+                result = {
+                    "test_name": parameters["test_name"],
+                    "passed": False,
+                    "status": build_failure["status"],
+                    "output": build_failure["output"],
+                }
+            elif skip_reason is not None:
+                parameters = load_test_parameters(fixtures, test_case_dir)
+                result = {
+                    "test_name": parameters["test_name"],
+                    "passed": False,
+                    "status": TEST_STATUS_SKIPPED,
+                    "skipped": True,
+                    "output": f"# TEST SKIPPED. {skip_reason}",
+                }
+            else:
+                on_runner_result = None
+                if outputs_path is not None:
+                    # keep what the runner printed so it can be judged again later
+                    execution = execution_hash(
+                        fixtures,
+                        path,
+                        test_case_dir,
+                        load_test_parameters(fixtures, test_case_dir),
+                    )
+
+                    def keep_output(runner_result, usage):
+                        nonlocal new_outputs_size
+                        raw_output = make_raw_output(execution, runner_result, usage)
+                        if raw_output is None:
+                            return
+                        with new_outputs_lock:
+                            size = raw_output_size(raw_output)
+                            if (
+                                new_outputs_size + size
+                                <= RAW_OUTPUTS_TOTAL_LIMIT_BYTES
+                            ):
+                                new_outputs[test_case_name(test_case_dir)] = raw_output
+                                new_outputs_size += size
+
+                    on_runner_result = keep_output
+
+                result = run_test_case(
+                    test_case_dir,
+                    fixtures,
+                    staging_dir,
+                    sandbox,
+                    tolerance_filters,
+                    on_runner_result=on_runner_result,
+                    limits=run_options.get("limits", {}).get(
+                        test_case_name(test_case_dir)
+                    ),
                 )
-                subprocess.run(
-                    [
-                        "perl",
-                        "-i",
-                        "-pe",
-                        "'chomp if eof'",
-                        os.path.join(sandbox, "out"),
-                    ]
+                # free up the sandbox's space as soon as possible
+                remove_sandbox_later(
+                    os.path.join(sandbox, test_case_name(test_case_dir))
                 )
+                if "usage" in result:
+                    try:
+                        record_test_usage(test_case_dir, result["usage"])
+                    except Exception as e:
+                        # only statistics, not worth failing the test over
+                        logging.error(f"Couldn't record usage of {test_case_dir}: {e}")
+
+                if not result["passed"]:
+                    with failures_lock:
+                        failures += 1
+
+            if on_result is not None:
+                on_result(index, result)
+            return index, result
+
+        # Cheapest first means a broken submission fails (and fail fast kicks in)
+        # as early as possible. Tests we've never timed go first, they're usually new.
+        run_order = list(range(len(test_cases_storage)))
+        if run_options.get("cheapest_first"):
+            runtimes = get_test_runtimes(test_cases_storage)
+            run_order.sort(key=lambda index: runtimes.get(test_cases_storage[index], 0))
+
+        # Each test case only waits on its own subprocess, so threads are plenty here.
+        # Every one of them needs a sandbox helper to start its runner.
+        allow_sandbox_helpers(parallelism)
+        if parallelism == 1 or len(test_cases_storage) <= 1:
+            run_result = list(map(run_in_sandbox, run_order))
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                run_result = list(executor.map(run_in_sandbox, run_order))
+
+    # Add the new outputs to the stored ones, forgetting test cases that are gone
+    if outputs_path is not None and new_outputs:
+        test_case_names = {
+            test_case_name(test_case_dir) for test_case_dir in test_cases_storage
+        }
+        kept_outputs = {
+            name: raw_output
+            for name, raw_output in stored_outputs.items()
+            if name in test_case_names
+        }
+        kept_outputs.update(new_outputs)
+        store_raw_outputs(outputs_path, kept_outputs)
+
+    # Hand the results back in test order no matter what order they ran in
+    run_result = sorted(result for result in run_result if result is not None)
+    results = [result for _, result in run_result]
+
+    # Only remember runs where every test ran to a verdict
+    if len(results) == len(test_cases_storage) and all(
+        is_final_verdict(result) for result in results
+    ):
+        store_cached_results(cache_key, results)
+    return results
+
+
+def run_testing_streamed(progress_queue, cancel_event, *args):
+    """
+    run_testing() for a grading worker whose results are being streamed to a
+    client. Every finished test case is put on progress_queue as
+    ("result", index, result) and the whole run as ("done", None, results) at the
+    end. Setting cancel_event skips the test cases that haven't started yet.
+    """
+    results = run_testing(
+        *args,
+        on_result=lambda index, result: progress_queue.put(("result", index, result)),
+        should_stop=cancel_event.is_set,
+    )
+    progress_queue.put(("done", None, results))
+    return results
+
+
+def build_submission(build_blob, submission_blobs, staging_dir, sandbox):
+    """
+    Runs the task's build.sh inside the staged submission folder, or unpacks what an
+    identical earlier build left behind. Returns None if it built, otherwise the
+    "status" and "output" every test case of this run fails with.
+    """
+    cache_key = build_cache_key(build_blob, submission_blobs)
+    if restore_build(cache_key, staging_dir):
+        return None
+
+    # build.sh goes next to the submission folder rather than in it, so it doesn't
+    # end up in the build cache or every test case's folder
+    build_script = os.path.join(sandbox, "build.sh")
+    copy_fixture(build_blob, build_script)
+    try:
+        build_result = run_sandboxed(
+            ["/bin/sh", build_script],
+            cwd=staging_dir,
+            timeout=BUILD_TIME_LIMIT_SECONDS,
+            rlimits={"RLIMIT_DATA": BUILD_MEMORY_LIMIT_MEGABYTES * 1024 * 1024},
+            output_limit=DEFAULT_OUTPUT_LIMIT_BYTES,
+            output_dir=sandbox,
+        )
+    except subprocess.TimeoutExpired:
+        return {
+            "status": TEST_STATUS_BUILD_TIME_LIMIT,
+            "output": f"You've exceeded the build time limit of {BUILD_TIME_LIMIT_SECONDS} seconds.",
+        }
+    except Exception as e:
+        logging.error(e)
+        return {
+            "status": TEST_STATUS_ERROR,
+            "output": f"A server error occurred while building: {e}.",
+        }
+
+    if build_result.returncode != 0:
+        report = "# TEST FAILED. Your code didn't build.\n"
+        report += (
+            f"The stdout message (if any) is:\n{report_excerpt(build_result.stdout)}\n"
+        )
+        report += (
+            f"The stderr message (if any) is:\n{report_excerpt(build_result.stderr)}\n"
+        )
+        return {"status": TEST_STATUS_BUILD_FAILED, "output": report}
+
+    store_build(cache_key, staging_dir)
+    return None
+
+
+def runner_usage(rusage) -> dict:
+    # What a runner used, reported with its test's result. The wall time is the
+    # sandbox helper's, from starting the runner to reaping it, so waiting for a
+    # free helper doesn't count.
+    return {
+        "wall_seconds": round(rusage["wall_seconds"], 3),
+        "user_cpu_seconds": round(rusage["utime"], 3),
+        "system_cpu_seconds": round(rusage["stime"], 3),
+        "peak_rss_kb": rusage["maxrss_kb"],
+    }
+
+
+def report_excerpt(data) -> str:
+    """
+    Decodes bytes (or takes a str) for a report, cutting out the middle if it's
+    longer than REPORT_EXCERPT_BYTES.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if len(data) > REPORT_EXCERPT_BYTES:
+        half = REPORT_EXCERPT_BYTES // 2
+        omitted = len(data) - 2 * half
+        data = (
+            data[:half]
+            + f"\n... ({omitted} bytes not shown) ...\n".encode("utf-8")
+            + data[-half:]
+        )
+    return data.decode("utf-8", errors="replace")
+
+
+def is_final_verdict(result) -> bool:
+    # Did the test actually get to run to a verdict that doesn't depend on how busy
+    # the machine was? Results stored before there was a "status" only have the
+    # report to go on.
+    if "status" in result:
+        return result["status"] in FINAL_TEST_STATUSES
+    return result["output"].startswith(("# TEST PASSED", "# TEST FAILED"))
+
+
+def killed_by(returncode, signal_number) -> bool:
+    # Either the runner itself was killed, or the shell running run.sh reports that
+    # what it ran was (as 128 + the signal number)
+    return returncode in [-signal_number, 128 + signal_number]
+
+
+def test_case_directories(fixtures) -> list:
+    """
+    Returns the sorted folders of every test case in a test suite listing.
+    """
+    test_cases_directories_set = set()
+    for blob_name in fixtures:
+        test_case_match = re.match(
+            r"^([A-Z0-9]+/[^/]*/scripts/(autotest|automark)/test_[0-9]+/)", blob_name
+        )
+        if test_case_match:
+            test_cases_directories_set.add(test_case_match.group(1))
+    return sorted(list(test_cases_directories_set))
+
+
+def test_case_name(test_case_dir: str) -> str:
+    # "COMP1511/lab01/scripts/autotest/test_3/" -> "test_3"
+    return test_case_dir.rstrip("/").split("/")[-1]
+
+
+def test_case_hash(
+    fixtures: dict, suite_path: str, test_case_dir: str, tolerance_filters: list
+) -> str:
+    """
+    A hash of everything that decides a test case's result apart from the student's
+    code: the build script, the runner, the test case's files and the tolerance filters. Uses the md5s
+    storage already keeps, so nothing has to be downloaded.
+    """
+    identity = [tolerance_filters_key(tolerance_filters)]
+    for name in [suite_path + "run.sh", suite_path + "build.sh"] + [
+        test_case_dir + file_name for file_name in ["in", "out", "parameters.json"]
+    ]:
+        blob = fixtures.get(name)
+        identity.append(None if blob is None else blob.md5_hash)
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+def load_test_parameters(fixtures: dict, test_case_dir: str) -> dict:
+    # grab the parameters
+    parameters_str = read_fixture(fixtures[test_case_dir + "parameters.json"]).decode(
+        "utf-8"
+    )
+    # now deserialise it
+    parameters = json.loads(parameters_str)
+
+    for limit in ["cpu_time", "memory_megabytes"]:
+        if isinstance(parameters[limit], str):
+            parameters[limit] = int(parameters[limit])
+    return parameters
+
+
+def load_test_files(fixtures, test_case_dir, parameters, tolerance_filters):
+    """
+    Returns the test case's (input, expected output, digest of the expected output
+    under tolerance_filters). The digest is None if there isn't a trustworthy one.
+    """
+    # Grab test files from the fixture cache (or storage on a miss), converting
+    # Windows' CRLF to *nix's LF on the way in
+    input_bytes = normalise_newlines(read_fixture(fixtures[test_case_dir + "in"]))
+    output_blob = fixtures[test_case_dir + "out"]
+    expected_output = normalise_newlines(read_fixture(output_blob))
+
+    # Adding or editing a test stores digests of the expected output under every
+    # combination of tolerance filters. Only trust them if they were made from the
+    # exact out we've got, someone could have replaced it directly in storage.
+    expected_digest = None
+    if parameters.get("expected_output_md5") == output_blob.md5_hash:
+        expected_digest = parameters.get("expected_output_digests", {}).get(
+            tolerance_filters_key(tolerance_filters)
+        )
+    return input_bytes, expected_output, expected_digest
+
+
+def run_test_case(
+    test_case_dir: str,
+    fixtures: dict,
+    staging_dir: str,
+    sandbox: str,
+    tolerance_filters: list,
+    on_runner_result=None,
+    limits=None,
+):
+    # on_runner_result(runner_result, usage) is called with what the runner did
+    # before it is judged, unless it ran out of time (or couldn't be run at all).
+    # limits, if given, are "cpu_time" and "memory_megabytes" to use instead of the
+    # test's own.
+
+    # test_case_dir looks like "COMP1511/lab01/scripts/autotest/test_3/", give this
+    # test case a private working directory named after it inside the sandbox
+    test_sandbox = os.path.join(sandbox, test_case_name(test_case_dir))
+    shutil.copytree(staging_dir, test_sandbox)
+
+    parameters = load_test_parameters(fixtures, test_case_dir)
+    parameters.update(limits or {})
+    runner_args = parameters["runner_args"]
+    cpu_time_limit = parameters["cpu_time"]
+    memory_limit = parameters["memory_megabytes"]
+    wall_time_limit = (
+        cpu_time_limit * WALL_TIME_LIMIT_FACTOR + WALL_TIME_LIMIT_SLACK_SECONDS
+    )
+    output_limit = int(parameters.get("output_limit_bytes", DEFAULT_OUTPUT_LIMIT_BYTES))
 
-            # got all the files in place, but there are a few more moving pieces to set up
-            # call the shell lexer on "runner_args", theres some deep osdev lore behind this:
-            # the shell do argument splitting for you into an array then invoke the exec syscall which
-            # sets up the child process's argv in the stack to point to the array the shell did the splitting on.
-            # since python doesnt do this we need to do it explicitly to maintain shell word splitting
-            # semantics (e.g. words with spaces inside a quote is one argument).
-            exec_command = shlex.split(
-                f"/bin/sh {os.path.join(sandbox, 'run.sh')} {runner_args}"
+    input_bytes, expected_output, expected_digest = load_test_files(
+        fixtures, test_case_dir, parameters, tolerance_filters
+    )
+    with open(os.path.join(test_sandbox, "in"), "wb") as input_handle:
+        input_handle.write(input_bytes)
+    with open(os.path.join(test_sandbox, "out"), "wb") as output_handle:
+        output_handle.write(expected_output)
+
+    # got all the files in place, but there are a few more moving pieces to set up
+    # call the shell lexer on "runner_args", theres some deep osdev lore behind this:
+    # the shell do argument splitting for you into an array then invoke the exec syscall which
+    # sets up the child process's argv in the stack to point to the array the shell did the splitting on.
+    # since python doesnt do this we need to do it explicitly to maintain shell word splitting
+    # semantics (e.g. words with spaces inside a quote is one argument).
+    exec_command = shlex.split(
+        f"/bin/sh {os.path.join(test_sandbox, 'run.sh')} {runner_args}"
+    )
+
+    # set memory limit, this won't crash the subprocess if it runs out of memory
+    # but allocations in that subprocess will fail, which is enough to cause test cases to fail.
+    # The output limit is enforced by the file size limit, output goes to files.
+    # One byte of slack so that printing exactly the limit is still fine.
+    # The CPU limit sends SIGXCPU, and SIGKILL a second later for runners that
+    # catch that. Each process gets its own allowance, the wall time limit catches
+    # run.sh starting lots of them.
+    rlimits = {
+        "RLIMIT_DATA": memory_limit * 1024 * 1024,
+        "RLIMIT_FSIZE": output_limit + 1,
+        "RLIMIT_CPU": [math.ceil(cpu_time_limit), math.ceil(cpu_time_limit) + 1],
+    }
+
+    # now we can actually run, on one of this worker's sandbox helpers
+    try:
+        runner_result = run_sandboxed(
+            exec_command,
+            cwd=test_sandbox,
+            timeout=wall_time_limit,
+            rlimits=rlimits,
+            output_limit=output_limit,
+            # next to the test's folder rather than in it, out of the runner's way
+            output_dir=sandbox,
+        )
+        usage = runner_usage(runner_result.rusage)
+        if on_runner_result is not None:
+            on_runner_result(runner_result, usage)
+        return judge_test_case(
+            parameters,
+            input_bytes,
+            expected_output,
+            expected_digest,
+            runner_result,
+            usage,
+            tolerance_filters,
+        )
+
+    except subprocess.TimeoutExpired as e:
+        return {
+            "test_name": parameters["test_name"],
+            "passed": False,
+            "status": TEST_STATUS_WALL_TIME_LIMIT,
+            "output": f"# TEST FAILED. Your code ran for more than {wall_time_limit:g} seconds. "
+            "It could be waiting for input that never comes, or sleeping.",
+            "usage": runner_usage(e.rusage),
+        }
+    except Exception as e:
+        logging.error(e)
+        return {
+            "test_name": parameters["test_name"],
+            "passed": False,
+            "status": TEST_STATUS_ERROR,
+            "output": f"A server error occurred: {e}.",
+        }
+
+
+def judge_test_case(
+    parameters,
+    input_bytes,
+    expected_output,
+    expected_digest,
+    runner_result,
+    usage,
+    tolerance_filters,
+):
+    """
+    Works out the result of a test case from what its runner did (a finished
+    run_sandboxed() result and its usage).
+    """
+    cpu_time_limit = parameters["cpu_time"]
+    memory_limit = parameters["memory_megabytes"]
+    output_limit = int(parameters.get("output_limit_bytes", DEFAULT_OUTPUT_LIMIT_BYTES))
+
+    if runner_result.output_limit_exceeded:
+        report = "# TEST FAILED. Output limit exceeded, "
+        report += f"you printed more than {output_limit} bytes.\n"
+        report += f"*** Your output starts with: \n"
+        report += report_excerpt(runner_result.stdout[:REPORT_EXCERPT_BYTES])
+        return {
+            "test_name": parameters["test_name"],
+            "passed": False,
+            "status": TEST_STATUS_OUTPUT_LIMIT,
+            "output": report,
+            "usage": usage,
+        }
+
+    # SIGXCPU only ever comes from the CPU limit. SIGKILL is the hard limit if
+    # they caught that, as long as they really did use (about) that much CPU.
+    cpu_seconds = usage["user_cpu_seconds"] + usage["system_cpu_seconds"]
+    if killed_by(runner_result.returncode, signal.SIGXCPU) or (
+        killed_by(runner_result.returncode, signal.SIGKILL)
+        and cpu_seconds >= cpu_time_limit * 0.9
+    ):
+        return {
+            "test_name": parameters["test_name"],
+            "passed": False,
+            "status": TEST_STATUS_CPU_TIME_LIMIT,
+            "output": f"# TEST FAILED. You've exceeded the CPU time limit of {cpu_time_limit} seconds.",
+            "usage": usage,
+        }
+
+    # run.sh finished, student's output in stdout stream. Compare it against
+    # ours with the tolerances configured by the admin. Most submissions pass,
+    # so try the precomputed digest first, the full comparison (and diff) only
+    # happens when that doesn't match.
+    if expected_digest is not None and expected_digest == output_digest(
+        [runner_result.stdout], tolerance_filters
+    ):
+        output_diff_equal, difference = True, ""
+    else:
+        output_diff_equal, difference = compare_outputs(
+            expected_output, runner_result.stdout, tolerance_filters
+        )
+
+    # run.sh can also return an error code so it can do some custom testing
+    runner_success = runner_result.returncode == 0
+
+    # Map the two results into an easy to read (hopefully) report.
+    def runner_fail(runner_stdout_bytes, runner_stderr_bytes) -> str:
+        report = "# TEST FAILED. Our code runner returned an error. "
+        report += (
+            "You could be crashing, failing a hidden check or running out of memory.\n"
+        )
+        report += (
+            f"The stdout message (if any) is:\n{report_excerpt(runner_stdout_bytes)}\n"
+        )
+        report += (
+            f"The stderr message (if any) is:\n{report_excerpt(runner_stderr_bytes)}\n"
+        )
+        return report
+
+    def diff_fail(in_bytes, our_out_bytes, their_out_bytes, difference) -> str:
+        report = "# TEST FAILED. Your output does not match the expected output.\n"
+        report += f"*** Input is: \n"
+        report += report_excerpt(in_bytes)
+        report += f"*** Expected output is: \n"
+        report += report_excerpt(our_out_bytes)
+        report += f"*** Your output is: \n"
+        report += report_excerpt(their_out_bytes)
+        report += f"*** The difference is: \n"
+        report += report_excerpt(difference)
+        report += f"*** This test case was ran with these tolerances: \n"
+        report += str(tolerance_filters) + "\n"
+        return report
+
+    # Allocations fail once the memory limit is hit, which usually crashes the
+    # runner one way or another. Tell them that's what happened.
+    out_of_memory = not runner_success and (
+        usage["peak_rss_kb"] >= memory_limit * 1024 * MEMORY_LIMIT_THRESHOLD
+        or any(message in runner_result.stderr for message in OUT_OF_MEMORY_MESSAGES)
+    )
+
+    if output_diff_equal and runner_success:
+        output = "# TEST PASSED"
+        status = TEST_STATUS_PASSED
+    elif out_of_memory:
+        output = f"# TEST FAILED. You've exceeded the memory limit of {memory_limit} megabytes.\n"
+        output += runner_fail(runner_result.stdout, runner_result.stderr)
+        status = TEST_STATUS_MEMORY_LIMIT
+    else:
+        status = TEST_STATUS_FAILED
+        output = ""
+        if not output_diff_equal:
+            output += diff_fail(
+                input_bytes, expected_output, runner_result.stdout, difference
             )
+        if not runner_success:
+            output += runner_fail(runner_result.stdout, runner_result.stderr)
 
-            # set memory limit, this won't crash the subprocess if it runs out of memory
-            # but allocations in that subprocess will fail, which is enough to cause test cases to fail.
-            def limit_subproc_mem():
-                soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
-                resource.setrlimit(
-                    resource.RLIMIT_DATA, (memory_limit * 1024 * 1024, hard)
-                )
+    return {
+        "test_name": parameters["test_name"],
+        "passed": output_diff_equal and runner_success,
+        "status": status,
+        "output": output,
+        "usage": usage,
+    }
 
-            # now we can actually run
-            try:
-                runner_result = subprocess.run(
-                    exec_command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    preexec_fn=limit_subproc_mem,
-                    timeout=cpu_time_limit,
-                    cwd=sandbox,
-                )
 
-                # run.sh finished, student's output in stdout stream, dump it into a file so we can use GNU diff on it
-                their_out_path = os.path.join(sandbox, "their_out")
-                with open(their_out_path, "wb") as their_out_handle:
-                    their_out_handle.write(runner_result.stdout)
+def rejudge_test_case(test_case_dir, fixtures, tolerance_filters, raw_output):
+    """
+    Judges a test case again from the runner's stored output (see raw_outputs.py)
+    instead of running it.
+    """
+    parameters = load_test_parameters(fixtures, test_case_dir)
+    input_bytes, expected_output, expected_digest = load_test_files(
+        fixtures, test_case_dir, parameters, tolerance_filters
+    )
+    return judge_test_case(
+        parameters,
+        input_bytes,
+        expected_output,
+        expected_digest,
+        stored_runner_result(raw_output),
+        raw_output["usage"],
+        tolerance_filters,
+    )
 
-                # Apply the ignore last newline tolerance if enabled to student output
-                if TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE in tolerance_filters:
-                    subprocess.run(
-                        ["perl", "-i", "-pe", "'chomp if eof'", their_out_path]
-                    )
 
-                # Apply other tolerances as configured by admin
-                our_out_path = os.path.join(sandbox, "out")
-                diff_exec_cmd = ["diff"]
-                if TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES in tolerance_filters:
-                    diff_exec_cmd.append("--ignore-trailing-space")
-                if TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT in tolerance_filters:
-                    diff_exec_cmd.append("--ignore-space-change")
-                if TOLERANCE_FILTER_IGNORE_CASE_DIFFERENCES in tolerance_filters:
-                    diff_exec_cmd.append("--ignore-case")
-
-                # Now really run diff
-                diff_result = subprocess.run(
-                    diff_exec_cmd + [their_out_path, our_out_path],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                output_diff_equal = diff_result.returncode == 0
-
-                # run.sh can also return an error code so it can do some custom testing
-                runner_success = runner_result.returncode == 0
-
-                # Map the two results into an easy to read (hopefully) report.
-                def runner_fail(runner_stdout_bytes, runner_stderr_bytes) -> str:
-                    report = "# TEST FAILED. Our code runner returned an error. "
-                    report += "You could be crashing, failing a hidden check or running out of memory.\n"
-                    report += f"The stdout message (if any) is:\n{runner_stdout_bytes.decode('utf-8')}\n"
-                    report += f"The stderr message (if any) is:\n{runner_stderr_bytes.decode('utf-8')}\n"
-                    return report
-
-                def diff_fail(
-                    in_bytes, our_out_bytes, their_out_bytes, diff_stdout_bytes
-                ) -> str:
-                    report = "# TEST FAILED. Your output does not match the expected output.\n"
-                    report += f"*** Input is: \n"
-                    report += in_bytes.decode("utf-8")
-                    report += f"*** Expected output is: \n"
-                    report += our_out_bytes.decode("utf-8")
-                    report += f"*** Your output is: \n"
-                    report += their_out_bytes.decode("utf-8")
-                    report += f"*** The difference is: \n"
-                    report += diff_stdout_bytes.decode("utf-8")
-                    report += f"*** This test case was ran with these tolerances: \n"
-                    report += str(tolerance_filters) + "\n"
-                    return report
-
-                result_rubric = {
-                    (True, True): "# TEST PASSED",
-                    (True, False): runner_fail(
-                        runner_result.stdout, runner_result.stderr
-                    ),
-                    (False, True): diff_fail(
-                        input_blob.download_as_bytes(),
-                        output_blob.download_as_bytes(),
-                        runner_result.stdout,
-                        diff_result.stdout,
-                    ),
-                }
-                result_rubric[(False, False)] = (
-                    result_rubric[(False, True)] + result_rubric[(True, False)]
-                )
+# Helper function for the autotest endpoints, works out whose submission is being
+# tested and makes sure the requestor is allowed to and that it exists.
+# Returns (logged_in_zid, zid_requested, error_message, status)
+def check_autotest_request(data):
+    course_code = data["course_code"]
+    task = data["task"]
+    submission_timestamp = data["timestamp"]
 
-                run_result.append(
-                    {
-                        "test_name": parameters["test_name"],
-                        "passed": output_diff_equal and runner_success,
-                        "output": result_rubric[(output_diff_equal, runner_success)],
-                    }
-                )
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, course_code) <= USER_LEVEL_NOT_MEMBER:
+        return logged_in_zid, None, "Unauthorised", 401
+
+    if get_user_level(logged_in_zid, course_code) == USER_LEVEL_STUDENT:
+        # A student can only run their own autotests
+        zid_requested = logged_in_zid
+    else:
+        zid_requested = data["zid"]
+
+    if not submission_exists(course_code, task, zid_requested, submission_timestamp):
+        return (
+            logged_in_zid,
+            zid_requested,
+            "no submissions recorded for the provided parameters, cannot run autotest!",
+            500,
+        )
+
+    return logged_in_zid, zid_requested, None, None
 
-            except subprocess.TimeoutExpired:
-                run_result.append(
-                    {
-                        "test_name": parameters["test_name"],
-                        "passed": False,
-                        "output": f"You've exceeded the CPU time limit of {cpu_time_limit} seconds.",
-                    }
-                )
-            except Exception as e:
-                run_result.append(
-                    {
-                        "test_name": parameters["test_name"],
-                        "passed": False,
-                        "output": f"A server error occurred: {e}.",
-                    }
-                )
-                logging.error(e)
 
-    return run_result
+# Helper function for the autotest endpoints, pulls the optional fail fast, time
+# budget and ordering settings out of the request body.
+# Returns (run_options, error_message)
+def get_autotest_run_options(data):
+    run_options = {}
+
+    fail_fast = data.get("fail_fast")
+    if fail_fast is True:
+        # "stop at the first failure"
+        fail_fast = 1
+    if fail_fast not in [None, False]:
+        if (
+            isinstance(fail_fast, bool)
+            or not isinstance(fail_fast, int)
+            or fail_fast < 1
+        ):
+            return None, "fail_fast must be true or a positive number of failures"
+        run_options["fail_fast"] = fail_fast
+
+    time_budget = data.get("time_budget")
+    if time_budget is not None:
+        if (
+            isinstance(time_budget, bool)
+            or not isinstance(time_budget, (int, float))
+            or time_budget <= 0
+        ):
+            return None, "time_budget must be a positive number of seconds"
+        run_options["time_budget"] = time_budget
+
+    if data.get("cheapest_first"):
+        run_options["cheapest_first"] = True
+
+    return run_options, None
+
+
+def get_autotest_version(task_dict):
+    """
+    What a task's autotest results depend on besides the submission, i.e. the
+    version of its autotest suite bundle and its tolerance filters. None if the
+    suite isn't bundled.
+    """
+    bundle = (task_dict.get("suiteBundles") or {}).get(suite_bundle_kind(False))
+    if bundle is None:
+        return None
+    tolerance_filters = [
+        filter
+        for filter, enabled in (task_dict.get("toleranceFilters") or {}).items()
+        if enabled
+    ]
+    return bundle["version"], tolerance_filters_key(tolerance_filters)
+
+
+def start_speculative_autotest(
+    course_code, task, zid, submission_timestamp, autotest_version
+):
+    """
+    Starts autotesting a submission that was just uploaded, before the student asks
+    for it, so /run_autotest has the results ready when they do: a finished run's
+    are given straight away, and one still going is waited for. autotest_version
+    (see get_autotest_version()) is what the run is good for.
+    """
+    # Without a bundle version there'd be no telling if the suite changed since
+    if autotest_version is None:
+        return
+
+    try:
+        job_id = submit_grading_job(
+            run_testing,
+            True,
+            zid,
+            course_code,
+            task,
+            submission_timestamp,
+            {},
+            kind=GRADING_JOB_KIND_AUTOTEST,
+            course_code=course_code,
+            owner_zid=zid,
+            lane=GRADING_LANE_SPECULATIVE,
+            task=task,
+        )
+    except GradingQueueFullError:
+        # Too busy to be guessing, the student will ask if they want it
+        return
+
+    key = (course_code, task, zid, submission_timestamp)
+    with _speculative_jobs_lock:
+        # Runs whose jobs have been forgotten can't be answered from any more
+        for old_key, (old_job_id, _) in list(_speculative_jobs.items()):
+            if get_grading_job(old_job_id) is None:
+                del _speculative_jobs[old_key]
+        _speculative_jobs[key] = (job_id, autotest_version)
+
+
+def speculative_autotest_response(
+    course_code, task, zid, submission_timestamp, wait_seconds
+):
+    """
+    The /run_autotest response from the submission's speculative run, straight
+    away if it has finished, once it does if it's running. Returns None if there's
+    no such run (or it failed, or was started against another suite or other
+    tolerance filters), the tests have to be run then.
+    """
+    key = (course_code, task, zid, submission_timestamp)
+    with _speculative_jobs_lock:
+        speculative = _speculative_jobs.get(key)
+    if speculative is None:
+        return None
+    job_id, autotest_version = speculative
+    job = get_grading_job(job_id)
+    if job is None:
+        with _speculative_jobs_lock:
+            _speculative_jobs.pop(key, None)
+        return None
+
+    task_dict = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task)
+        .get()
+        .to_dict()
+        or {}
+    )
+    future = job["future"]
+    if autotest_version == get_autotest_version(task_dict):
+        if future.done():
+            if not future.cancelled() and future.exception() is None:
+                return grading_job_response(job_id, wait_seconds)
+        elif not future.cancel():
+            return grading_job_response(job_id, wait_seconds)
+        # Otherwise it failed, or it was still queued in the speculative lane and
+        # a fresh run in the interactive lane will start sooner
+
+    # Whatever run replaces this one is the one to answer from
+    with _speculative_jobs_lock:
+        if _speculative_jobs.get(key) == speculative:
+            del _speculative_jobs[key]
+    return None
 
 
 @testing.route("/run_autotest", methods=["POST"])
 def autotest():
     """
     Route to run autotests (sample visible tests) for a student's submission for a specific task in a course.
+    If the task runs autotests on upload ("speculative_autotest") and none of fail_fast, time_budget
+    or cheapest_first are given, the run started on upload is answered from instead of running them
+    again, waiting for it if it's still going.
     Request body:
     json containing:
         - "course_code": the course code in which the task is located
         - "task": the task name
         - "timestamp": the submission timestamp to be run
         - "zid": the zid of the student whose submission is to be tested (Only on admin run)
+        - "wait": optional, how many seconds to wait for the results before returning a job id,
+          without it the request waits until they're ready
+        - "fail_fast": optional, true or a number N to skip the remaining tests after N failures
+        - "time_budget": optional, seconds after which the remaining tests are skipped
+        - "cheapest_first": optional, run the historically fastest tests first
     Headers:
         - "Authorization": the bearer token for the user
     Returns:
         - 200 status code if successful with json containing:
+            - "job_id": the id of the grading job
             - "autotest_results": a list of dictionaries, each containing:
                 - "test_name": the name of the test
                 - "passed": whether the test passed
                 - "output": the output of the test (any error messages or differences)
+                - "status": how the test ended, "passed", "failed", "cpu_time_limit_exceeded",
+                  "wall_time_limit_exceeded", "memory_limit_exceeded", "output_limit_exceeded",
+                  "build_failed", "build_time_limit_exceeded", "skipped" or "error"
+                - "skipped": only present (and true) if the test was skipped by fail_fast or time_budget
+                - "usage": if the test ran, the "wall_seconds", "user_cpu_seconds",
+                  "system_cpu_seconds" and "peak_rss_kb" it used (peak_rss_kb is 0 if it used
+                  too little memory to measure, a few MB)
+        - 202 status code if "wait" was given and the results weren't ready in time, with json containing:
+            - "job_id": the id to poll /grading_job/<job_id> with
+            - "status": "running"
+        - 400 status code if fail_fast or time_budget are invalid
         - 401 status code if the user is not authorised
+        - 429 status code if the user already has too many jobs queued or running or the
+          grading queue is full, with a Retry-After header and json containing "error" and
+          "estimated_wait_seconds"
         - 500 status code if there are no submissions recorded for the provided parameters
     """
     data = request.json
@@ -301,39 +1173,353 @@ def autotest():
     task = data["task"]
     submission_timestamp = data["timestamp"]
 
-    token = request.headers.get("Authorization").split("Bearer ")[1]
-    logged_in_zid = verify_token(token)
+    run_options, error_message = get_autotest_run_options(data)
+    if error_message:
+        return jsonify({"error": error_message}), 400
 
-    if get_user_level(logged_in_zid, course_code) <= USER_LEVEL_NOT_MEMBER:
-        return jsonify({"error": "Unauthorised"}), 401
+    logged_in_zid, zid_requested, error_message, status = check_autotest_request(data)
+    if error_message:
+        return jsonify({"error": error_message}), status
 
-    if get_user_level(logged_in_zid, course_code) == USER_LEVEL_STUDENT:
-        # A student can only run their own autotests
-        zid_requested = logged_in_zid
-    else:
-        zid_requested = data["zid"]
+    # Uploading might have started this very run already
+    if not run_options:
+        response = speculative_autotest_response(
+            course_code,
+            task,
+            zid_requested,
+            submission_timestamp,
+            get_grading_wait_seconds(data.get("wait")),
+        )
+        if response is not None:
+            return response
 
-    submission_path = f"{course_code}/{task}/{zid_requested}/{submission_timestamp}/"
-    submission_blobs = bucket.list_blobs(prefix=submission_path)
-    if len(list(submission_blobs)) == 0:
-        return (
-            jsonify(
-                {
-                    "error": "no submissions recorded for the provided parameters, cannot run autotest!"
-                }
-            ),
-            500,
+    # Grading happens on the worker pool, wait for it here for a while so clients
+    # that just want the results don't have to poll
+    try:
+        job_id = submit_grading_job(
+            run_testing,
+            True,
+            zid_requested,
+            course_code,
+            task,
+            submission_timestamp,
+            run_options,
+            kind=GRADING_JOB_KIND_AUTOTEST,
+            course_code=course_code,
+            owner_zid=logged_in_zid,
+            task=task,
+        )
+    except GradingQueueFullError as e:
+        return grading_queue_full_response(e)
+    return grading_job_response(job_id, get_grading_wait_seconds(data.get("wait")))
+
+
+def grading_queue_full_response(error):
+    """
+    The 429 for a grading job the scheduler turned away, telling the client when
+    it's worth trying again.
+    """
+    retry_after = max(1, math.ceil(error.retry_after_seconds))
+    response = jsonify({"error": str(error), "estimated_wait_seconds": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+
+def server_sent_event(event, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+@testing.route("/run_autotest_stream", methods=["POST"])
+def autotest_stream():
+    """
+    Route to run autotests for a submission, streaming each test's result as soon as it
+    finishes as Server-Sent Events. Closing the connection cancels the tests that haven't
+    started yet.
+    Request body:
+    json containing:
+        - "course_code": the course code in which the task is located
+        - "task": the task name
+        - "timestamp": the submission timestamp to be run
+        - "zid": the zid of the student whose submission is to be tested (Only on admin run)
+        - "fail_fast": optional, true or a number N to skip the remaining tests after N failures
+        - "time_budget": optional, seconds after which the remaining tests are skipped
+        - "cheapest_first": optional, run the historically fastest tests first
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code with a text/event-stream of:
+            - "test" events, one per test as it finishes, containing:
+                - "index": the position of the test in the full (sorted) results
+                - "test_name": the name of the test
+                - "passed": whether the test passed
+                - "output": the output of the test (any error messages or differences)
+                - "skipped": only present (and true) if the test was skipped by fail_fast or time_budget
+            - a final "summary" event containing "passed", "failed", "skipped" and "total" counts
+            - or a final "error" event containing "error" if the run failed
+        - 400 status code if fail_fast or time_budget are invalid
+        - 401 status code if the user is not authorised
+        - 429 status code if the user already has too many jobs queued or running or the
+          grading queue is full, with a Retry-After header and json containing "error" and
+          "estimated_wait_seconds"
+        - 500 status code if there are no submissions recorded for the provided parameters
+    """
+    data = request.json
+    course_code = data["course_code"]
+    task = data["task"]
+    submission_timestamp = data["timestamp"]
+
+    run_options, error_message = get_autotest_run_options(data)
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    logged_in_zid, zid_requested, error_message, status = check_autotest_request(data)
+    if error_message:
+        return jsonify({"error": error_message}), status
+
+    progress_queue, cancel_event = create_grading_stream()
+    try:
+        job_id = submit_grading_job(
+            run_testing_streamed,
+            progress_queue,
+            cancel_event,
+            True,
+            zid_requested,
+            course_code,
+            task,
+            submission_timestamp,
+            run_options,
+            kind=GRADING_JOB_KIND_AUTOTEST,
+            course_code=course_code,
+            owner_zid=logged_in_zid,
+            task=task,
         )
+    except GradingQueueFullError as e:
+        return grading_queue_full_response(e)
+    job = get_grading_job(job_id)
+
+    def generate():
+        idle_seconds = 0
+        try:
+            while True:
+                try:
+                    kind, index, payload = progress_queue.get(timeout=1)
+                except queue.Empty:
+                    if job["future"].done() and progress_queue.empty():
+                        # The worker went away without telling us it was done
+                        yield server_sent_event(
+                            "error", {"error": "An internal server error occured."}
+                        )
+                        return
+
+                    # Keep proxies from timing us out, this is also how we notice
+                    # that the client went away
+                    idle_seconds += 1
+                    if idle_seconds >= SSE_KEEP_ALIVE_SECONDS:
+                        idle_seconds = 0
+                        yield ": keep-alive\n\n"
+                    continue
+
+                idle_seconds = 0
+                if kind == "result":
+                    yield server_sent_event("test", {"index": index, **payload})
+                elif payload is None:
+                    yield server_sent_event(
+                        "error", {"error": "An internal server error occured."}
+                    )
+                    return
+                else:
+                    passed = sum(1 for test_case in payload if test_case.get("passed"))
+                    skipped = sum(
+                        1 for test_case in payload if test_case.get("skipped")
+                    )
+                    yield server_sent_event(
+                        "summary",
+                        {
+                            "job_id": job_id,
+                            "passed": passed,
+                            "failed": len(payload) - passed - skipped,
+                            "skipped": skipped,
+                            "total": len(payload),
+                        },
+                    )
+                    return
+        finally:
+            # Either we're done or the client hung up, no point running anything else.
+            # If it's still queued it never starts at all.
+            job["future"].cancel()
+            cancel_event.set()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def get_previous_automark_outcomes(result_doc, submission_timestamp):
+    """
+    Pairs up the stored automark report of a student's result document with the test
+    case hashes it was made with, in the shape run_testing() takes as
+    previous_outcomes. Returns None if the stored report isn't for this submission.
+    """
+    if not result_doc.exists:
+        return None
+    result_record = result_doc.to_dict()
+    if result_record.get("automark_submission_timestamp") != submission_timestamp:
+        return None
+
+    test_hashes = result_record.get("automark_test_hashes", {})
+    try:
+        report = json.loads(result_record.get("automark_report", "[]"))
+    except (TypeError, ValueError):
+        return None
+    # The report is in test case order, which is the sorted order of the names
+    if len(report) != len(test_hashes):
+        return None
+
+    return {
+        name: {"hash": test_hashes[name], "result": test_result}
+        for name, test_result in zip(sorted(test_hashes), report)
+    }
 
-    resp = run_testing(True, zid_requested, course_code, task, submission_timestamp)
 
-    if resp is None:
+def automark_submission(course_code, task, zid_requested, submission_timestamp):
+    """
+    Runs automark on one submission and records the marks in the student's result.
+    Returns a (marked, error_message, status) tuple, error_message is None on success
+    and marked is a dictionary with the test "results" and the "raw_automark".
+    """
+    if not submission_exists(course_code, task, zid_requested, submission_timestamp):
         return (
-            jsonify({"error": "An internal server error occured."}),
+            None,
+            "no submissions recorded for the provided parameters, cant run automark!",
             500,
         )
+
+    # If this submission has been marked before, only the test cases that changed
+    # since then (or are new) have to run again
+    student_result_ref = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task)
+        .collection("results")
+        .document(zid_requested)
+    )
+    previous_outcomes = get_previous_automark_outcomes(
+        student_result_ref.get(), submission_timestamp
+    )
+
+    # Run the tests first
+    test_hashes = {}
+    result = run_testing(
+        False,
+        zid_requested,
+        course_code,
+        task,
+        submission_timestamp,
+        previous_outcomes=previous_outcomes,
+        test_hashes=test_hashes,
+    )
+    if result is None:
+        return None, "Internal server error", 500
+
+    # Calculate raw marks
+    num_passed = sum(1 for test_case in result if test_case.get("passed"))
+    timestamp = datetime.now().strftime(f"%d-%m-%Y %X")
+    mark_released = False
+    report = json.dumps(result)
+
+    # Get task data and special consideration
+    course_ref = db.collection("courses").document(course_code)
+    task_ref = course_ref.collection("tasks").document(task)
+    task_doc = task_ref.get()
+
+    if not task_doc.exists:
+        return None, "Task not found", 404
+
+    task_params = task_doc.to_dict()
+    max_automark = task_params["maxAutomark"]
+
+    # Calculate raw mark before any penalties
+    raw_mark = round(((num_passed / len(result)) * 100) * (max_automark / 100))
+
+    # Check for special consideration
+    special_consideration_ref = (
+        task_ref.collection("specialConsiderations").document(zid_requested).get()
+    )
+    extension_hours = 0
+    if special_consideration_ref.exists:
+        special_consideration = special_consideration_ref.to_dict()
+        if special_consideration.get("status") == "APPROVED":
+            extension_hours = special_consideration.get("extensionHours", 0)
+
+    # Calculate late penalty with special consideration
+    submission_time = datetime.strptime(submission_timestamp, "%d-%m-%Y %X")
+    deadline = datetime.fromisoformat(task_params["deadline"].replace("Z", "+00:00"))
+
+    if extension_hours > 0:
+        # Add extension to deadline
+        deadline = deadline + timedelta(hours=extension_hours)
+
+    # Calculate late days (you would need to import this from your task.py)
+    from blueprints.task import calculate_late_days
+
+    late_days = calculate_late_days(
+        submission_time,
+        deadline,
+        task_params.get("latePolicy", {}).get("lateDayType", "CALENDAR"),
+    )
+
+    # Calculate penalty percentage
+    deduction_per_day = task_params.get("latePolicy", {}).get(
+        "percentDeductionPerDay", 0
+    )
+    penalty_percentage = min(late_days * deduction_per_day, 100) if late_days > 0 else 0
+
+    if task_params.get("latePolicy", {}).get("maxLateDays") < late_days:
+        penalty_percentage = 100
+
+    # Apply penalty to raw mark
+    # final_mark = math.ceil(raw_mark * (1 - penalty_percentage / 100))
+
+    # Update student record
+    if student_result_ref.get().exists:
+        result_record = student_result_ref.get().to_dict()
+        result_record.update(
+            {
+                # "automark": final_mark,
+                "raw_automark": raw_mark,  # Store the raw mark before penalties
+                "automark_timestamp": timestamp,
+                "automark_report": report,
+                # what was marked and against which version of each test case,
+                # so a re-mark can tell which results are still good
+                "automark_submission_timestamp": submission_timestamp,
+                "automark_test_hashes": test_hashes,
+                "lateDays": late_days,
+                "latePenaltyPercentage": penalty_percentage,
+                "comments": result_record.get("comments", ""),
+                "mark_released": result_record.get("mark_released", mark_released),
+                "style": result_record.get("style", 0),
+            }
+        )
+
+        # If there's special consideration, include it in the record
+        if extension_hours > 0:
+            result_record["specialConsiderationApplied"] = {
+                "extensionHours": extension_hours,
+                "originalDeadline": task_params["deadline"],
+                "extendedDeadline": deadline.isoformat(),
+            }
+
+        student_result_ref.update(result_record)
     else:
-        return {"autotest_results": resp}
+        logging.error(
+            "result record does not exist, it should've been created from file upload!"
+        )
+        return None, "Internal server error", 500
+
+    return {"results": result, "raw_automark": raw_mark}, None, None
 
 
 @testing.route("/run_automark", methods=["POST"])
@@ -346,15 +1532,24 @@ def automark():
         - "task": the task name
         - "timestamp": the submission timestamp to be run
         - "zid": the zid of the student whose submission is to be tested (Only on admin run)
+        - "wait": optional, how many seconds to wait for the results before returning a job id,
+          without it the request waits until they're ready
     Headers:
         - "Authorization": the bearer token for the user
     Returns:
         - 200 status code if successful with json containing:
+            - "job_id": the id of the grading job
             - "automark_results": a list of dictionaries, each containing:
                 - "test_name": the name of the test
                 - "passed": whether the test passed
                 - "output": the output of the test (any error messages or differences)
+        - 202 status code if "wait" was given and the results weren't ready in time, with json containing:
+            - "job_id": the id to poll /grading_job/<job_id> with
+            - "status": "running"
         - 401 status code if the user is not authorised
+        - 429 status code if the student already has too many jobs queued or running or the
+          batch queue is full, with a Retry-After header and json containing "error" and
+          "estimated_wait_seconds"
         - 500 status code if there are no submissions recorded for the provided parameters
     """
     try:
@@ -371,125 +1566,710 @@ def automark():
             logging.error(f"AUTOMARK run cancelled, requestor unauthorised")
             return jsonify({"error": "Unauthorised"}), 401
 
-        submission_path = (
-            f"{course_code}/{task}/{zid_requested}/{submission_timestamp}/"
-        )
-        submission_blobs = bucket.list_blobs(prefix=submission_path)
-        if len(list(submission_blobs)) == 0:
+        # Tutors automark a whole class at once from the batch automark dialog, one
+        # request per student, so this is batch work taking turns per student. The
+        # batch lane queues enough for a cohort, see GRADING_MAX_QUEUED_BATCH.
+        try:
+            job_id = submit_grading_job(
+                automark_submission,
+                course_code,
+                task,
+                zid_requested,
+                submission_timestamp,
+                kind=GRADING_JOB_KIND_AUTOMARK,
+                course_code=course_code,
+                owner_zid=logged_in_zid,
+                lane=GRADING_LANE_BATCH,
+                task=task,
+                queue_owner=zid_requested,
+            )
+        except GradingQueueFullError as e:
+            return grading_queue_full_response(e)
+        return grading_job_response(job_id, get_grading_wait_seconds(data.get("wait")))
+
+    except Exception as e:
+        logging.error(f"Error in automark: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+
+def grading_job_response(job_id, wait_seconds):
+    """
+    Waits up to wait_seconds for a grading job and turns it into the response the
+    endpoint that started it would have given, or a 202 with the job id if it
+    hasn't finished yet.
+    """
+    job = find_grading_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    status, result, error = wait_for_grading_job(job_id, wait_seconds)
+    if status is None:
+        return jsonify({"error": error}), 404
+    elif status == GRADING_JOB_STATUS_RUNNING:
+        # The client may poll through another web process
+        share_grading_job(job_id)
+        return jsonify({"job_id": job_id, "status": status}), 202
+    elif status == GRADING_JOB_STATUS_FAILED:
+        return jsonify({"error": error}), 500
+
+    if job["kind"] == GRADING_JOB_KIND_AUTOTEST:
+        if result is None:
             return (
-                jsonify(
-                    {
-                        "error": "no submissions recorded for the provided parameters, cant run automark!"
-                    }
-                ),
+                jsonify({"error": "An internal server error occured."}),
                 500,
             )
+        return {"job_id": job_id, "autotest_results": result}
+    elif job["kind"] == GRADING_JOB_KIND_CALIBRATION:
+        calibration, error_message, error_status = result
+        if error_message:
+            return jsonify({"error": error_message}), error_status
+        return {"job_id": job_id, "calibration": calibration}
+    else:
+        marked, error_message, error_status = result
+        if error_message:
+            return jsonify({"error": error_message}), error_status
+        return {"job_id": job_id, "automark_results": marked["results"]}
+
 
-        # Run the tests first
-        result = run_testing(
-            False, zid_requested, course_code, task, submission_timestamp
+@testing.route("/grading_job/<job_id>", methods=["GET"])
+def grading_job(job_id):
+    """
+    Route to poll an autotest or automark run that didn't finish within its request.
+    Parameters:
+        - "job_id": the job id returned by /run_autotest or /run_automark
+        - "wait": optional query parameter, how many seconds to wait for the job (default 0)
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - the same responses as the endpoint that started the job once it has finished
+        - 202 status code with json containing "job_id" and "status" if it is still running
+        - 401 status code if the user is not authorised
+        - 404 status code if there is no such job, or it finished over an hour ago
+    """
+    job = find_grading_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    # Students can only see the jobs they started themselves
+    if (
+        logged_in_zid != job["owner_zid"]
+        and get_user_level(logged_in_zid, job["course_code"]) < USER_LEVEL_TUTOR
+    ):
+        return jsonify({"error": "Unauthorised"}), 401
+
+    return grading_job_response(
+        job_id, get_grading_wait_seconds(request.args.get("wait", 0))
+    )
+
+
+def calibrate_suite(
+    course_code, task, is_autotest, reference_timestamp, multiplier, runs, apply
+):
+    """
+    Runs a task's tests against its reference solution and works out limits for
+    every test from what the solution really used. Returns a (calibration,
+    error_message, status) tuple, error_message is None on success and calibration
+    is a dictionary with "all_passed", "verified", "applied" and one entry per test
+    in "tests".
+    """
+    path = get_script_path(course_code, task, not is_autotest)
+    fixtures = {blob.name: blob for blob in bucket.list_blobs(prefix=path)}
+    test_cases_storage = test_case_directories(fixtures)
+    if len(test_cases_storage) == 0:
+        return None, "This task has no tests to calibrate", 400
+
+    # A cached result says nothing about how long the test takes now, so everything
+    # really runs. More than one run evens out a noisy machine, the worst one counts.
+    all_results = []
+    for _ in range(runs):
+        results = run_testing(
+            is_autotest,
+            REFERENCE_SOLUTION_ZID,
+            course_code,
+            task,
+            reference_timestamp,
+            {"always_run": True},
         )
-        if result is None:
-            return jsonify({"error": "Internal server error"}), 500
+        if results is None:
+            return None, "Internal server error", 500
+        if len(results) != len(test_cases_storage):
+            return None, "The tests changed while calibrating, please try again", 409
+        all_results.append(results)
 
-        # Calculate raw marks
-        num_passed = sum(1 for test_case in result if test_case.get("passed"))
-        timestamp = datetime.now().strftime(f"%d-%m-%Y %X")
-        mark_released = False
-        report = json.dumps(result)
+    tests = []
+    for index, test_case_dir in enumerate(test_cases_storage):
+        parameters = load_test_parameters(fixtures, test_case_dir)
+        test_results = [results[index] for results in all_results]
+        test = {
+            "test_name": parameters["test_name"],
+            "passed": all(result["passed"] for result in test_results),
+            "cpu_time": parameters["cpu_time"],
+            "memory_megabytes": parameters["memory_megabytes"],
+        }
+        if not test["passed"]:
+            failure = next(result for result in test_results if not result["passed"])
+            test["status"] = failure["status"]
+            test["output"] = failure["output"]
+            tests.append(test)
+            continue
 
-        # Get task data and special consideration
-        course_ref = db.collection("courses").document(course_code)
-        task_ref = course_ref.collection("tasks").document(task)
-        task_doc = task_ref.get()
+        cpu_seconds = max(
+            result["usage"]["user_cpu_seconds"] + result["usage"]["system_cpu_seconds"]
+            for result in test_results
+        )
+        wall_seconds = max(result["usage"]["wall_seconds"] for result in test_results)
+        peak_rss_kb = max(result["usage"]["peak_rss_kb"] for result in test_results)
 
-        if not task_doc.exists:
-            return jsonify({"error": "Task not found"}), 404
+        # The wall time limit comes from the CPU time limit, make sure that leaves
+        # enough room for tests that mostly wait rather than compute too
+        proposed_cpu_time = max(
+            1,
+            math.ceil(cpu_seconds * multiplier),
+            math.ceil(
+                (wall_seconds * multiplier - WALL_TIME_LIMIT_SLACK_SECONDS)
+                / WALL_TIME_LIMIT_FACTOR
+            ),
+        )
+        proposed_memory_megabytes = max(
+            CALIBRATION_MIN_MEMORY_MEGABYTES,
+            math.ceil(peak_rss_kb / 1024 * multiplier),
+        )
+        test.update(
+            {
+                "max_cpu_seconds": round(cpu_seconds, 3),
+                "max_wall_seconds": round(wall_seconds, 3),
+                "max_peak_rss_kb": peak_rss_kb,
+                "proposed_cpu_time": proposed_cpu_time,
+                "proposed_memory_megabytes": proposed_memory_megabytes,
+            }
+        )
+        tests.append(test)
+
+    # Limits are only worth anything if the solution passes all of them
+    all_passed = all(test["passed"] for test in tests)
+
+    # What was measured isn't quite what is enforced, e.g. the memory limit caps the
+    # data segment rather than the resident set, and a runner too short lived to
+    # measure reports no memory at all. So before saving anything make sure the
+    # solution really passes under the proposed limits.
+    verified = None
+    if apply and all_passed:
+        verification = run_testing(
+            is_autotest,
+            REFERENCE_SOLUTION_ZID,
+            course_code,
+            task,
+            reference_timestamp,
+            {
+                "always_run": True,
+                "limits": {
+                    test_case_name(test_case_dir): {
+                        "cpu_time": test["proposed_cpu_time"],
+                        "memory_megabytes": test["proposed_memory_megabytes"],
+                    }
+                    for test_case_dir, test in zip(test_cases_storage, tests)
+                },
+            },
+        )
+        if verification is None:
+            return None, "Internal server error", 500
+        if len(verification) != len(test_cases_storage):
+            return None, "The tests changed while calibrating, please try again", 409
+        for test, result in zip(tests, verification):
+            test["verified"] = result["passed"]
+            if not result["passed"]:
+                test["verification_status"] = result["status"]
+                test["verification_output"] = result["output"]
+        verified = all(test["verified"] for test in tests)
+
+    applied = False
+    if verified:
+        for test_case_dir, test in zip(test_cases_storage, tests):
+            parameters_blob = fixtures[test_case_dir + "parameters.json"]
+            parameters = json.loads(read_fixture(parameters_blob).decode("utf-8"))
+            parameters["cpu_time"] = test["proposed_cpu_time"]
+            parameters["memory_megabytes"] = test["proposed_memory_megabytes"]
+            bucket.blob(parameters_blob.name).upload_from_string(json.dumps(parameters))
+        publish_suite_bundle(course_code, task, not is_autotest)
+        applied = True
 
-        task_params = task_doc.to_dict()
-        max_automark = task_params["maxAutomark"]
+    calibration = {
+        "reference_timestamp": reference_timestamp,
+        "multiplier": multiplier,
+        "runs": runs,
+        "all_passed": all_passed,
+        "verified": verified,
+        "applied": applied,
+        "tests": tests,
+    }
+    return calibration, None, None
 
-        # Calculate raw mark before any penalties
-        raw_mark = round(((num_passed / len(result)) * 100) * (max_automark / 100))
 
-        # Check for special consideration
-        special_consideration_ref = (
-            task_ref.collection("specialConsiderations").document(zid_requested).get()
+@testing.route("/calibrate", methods=["POST"])
+def calibrate():
+    """
+    Route to measure what each test of a task really needs by running them against
+    the task's reference solution (see /task/upload_reference_solution), and
+    propose (or set) their CPU time and memory limits from that.
+    Request body:
+    json containing:
+        - "course_code": the course code in which the task is located
+        - "task": the task name
+        - "hidden": true to calibrate the automark tests, false for the autotests
+        - "timestamp": optional, which reference solution to use (default the latest)
+        - "multiplier": optional, how many times the measured cost to propose as the limits
+        - "runs": optional, how many times to run the tests, the worst run counts (default 1)
+        - "apply": optional, true to save the proposed limits if every test passed, and
+          passes again when run under them
+        - "wait": optional, how many seconds to wait for the results before returning a job id,
+          without it the request waits until they're ready
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code if successful with json containing:
+            - "job_id": the id of the grading job
+            - "calibration": a dictionary containing:
+                - "reference_timestamp", "multiplier", "runs": what was run
+                - "all_passed": whether the reference solution passed every test
+                - "verified": with "apply", whether it passed every test again under the
+                  proposed limits (null if it wasn't run under them)
+                - "applied": whether the proposed limits were saved
+                - "tests": a list of dictionaries, one per test in order, each containing:
+                    - "test_name": the name of the test
+                    - "passed": whether the reference solution passed it (every run)
+                    - "cpu_time", "memory_megabytes": the limits it had when calibrated
+                    - "status", "output": how it failed, if it did
+                    - "max_cpu_seconds", "max_wall_seconds", "max_peak_rss_kb": what it used, if it passed
+                    - "proposed_cpu_time", "proposed_memory_megabytes": the proposed limits, if it passed
+                    - "verified": whether it passed under the proposed limits, if it was run under them
+                    - "verification_status", "verification_output": how it failed under them, if it did
+        - 202 status code if "wait" was given and the results weren't ready in time, with json containing:
+            - "job_id": the id to poll /grading_job/<job_id> with
+            - "status": "running"
+        - 400 status code if the options are invalid or the task has no tests
+        - 401 status code if the user is not authorised
+        - 429 status code if the user already has too many jobs queued or running or the
+          grading queue is full, with a Retry-After header and json containing "error" and
+          "estimated_wait_seconds"
+        - 404 status code if the task has no reference solution
+    """
+    data = request.json
+    course_code = data["course_code"]
+    task = data["task"]
+    is_autotest = not data.get("hidden", False)
+
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, course_code) != USER_LEVEL_ADMIN:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    multiplier = data.get("multiplier", CALIBRATION_DEFAULT_MULTIPLIER)
+    if (
+        isinstance(multiplier, bool)
+        or not isinstance(multiplier, (int, float))
+        or multiplier < 1
+    ):
+        return jsonify({"error": "multiplier must be a number of at least 1"}), 400
+
+    runs = data.get("runs", 1)
+    if (
+        isinstance(runs, bool)
+        or not isinstance(runs, int)
+        or not 1 <= runs <= CALIBRATION_MAX_RUNS
+    ):
+        return (
+            jsonify({"error": f"runs must be between 1 and {CALIBRATION_MAX_RUNS}"}),
+            400,
         )
-        extension_hours = 0
-        if special_consideration_ref.exists:
-            special_consideration = special_consideration_ref.to_dict()
-            if special_consideration.get("status") == "APPROVED":
-                extension_hours = special_consideration.get("extensionHours", 0)
 
-        # Calculate late penalty with special consideration
-        submission_time = datetime.strptime(submission_timestamp, "%d-%m-%Y %X")
-        deadline = datetime.fromisoformat(
-            task_params["deadline"].replace("Z", "+00:00")
+    reference_timestamp = data.get("timestamp") or get_latest_reference_timestamp(
+        course_code, task
+    )
+    reference_path = (
+        f"{course_code}/{task}/{REFERENCE_SOLUTION_ZID}/{reference_timestamp}/"
+    )
+    if reference_timestamp is None or not any(
+        True for _ in bucket.list_blobs(prefix=reference_path)
+    ):
+        return jsonify({"error": "This task has no such reference solution"}), 404
+
+    try:
+        job_id = submit_grading_job(
+            calibrate_suite,
+            course_code,
+            task,
+            is_autotest,
+            reference_timestamp,
+            multiplier,
+            runs,
+            bool(data.get("apply", False)),
+            kind=GRADING_JOB_KIND_CALIBRATION,
+            course_code=course_code,
+            owner_zid=logged_in_zid,
+            task=task,
+            lane=GRADING_LANE_CALIBRATION,
         )
+    except GradingQueueFullError as e:
+        return grading_queue_full_response(e)
+    return grading_job_response(job_id, get_grading_wait_seconds(data.get("wait")))
 
-        if extension_hours > 0:
-            # Add extension to deadline
-            deadline = deadline + timedelta(hours=extension_hours)
 
-        # Calculate late days (you would need to import this from your task.py)
-        from blueprints.task import calculate_late_days
+def run_batch_automark_item(item):
+    # Another process sharing the journal might have beaten us to it
+    if not claim_batch_item(item["job_id"], item["zid"]):
+        return
+
+    try:
+        # This thread just waits, the marking itself happens on a grading worker.
+        # Items of the same batch job take turns with other batch jobs' items. They
+        # are never turned away, the threads of this executor already bound how many
+        # are outstanding.
+        marked, error_message, _ = schedule_grading(
+            automark_submission,
+            item["course_code"],
+            item["task"],
+            item["zid"],
+            item["submission_timestamp"],
+            lane=GRADING_LANE_BATCH,
+            owner=item["job_id"],
+            affinity=grading_affinity(item["course_code"], item["task"]),
+            admission_control=False,
+        ).result()
+    except Exception as e:
+        logging.error(f"Error in batch automark: {str(e)}", exc_info=True)
+        marked, error_message = None, f"A server error occurred: {e}."
 
-        late_days = calculate_late_days(
-            submission_time,
-            deadline,
-            task_params.get("latePolicy", {}).get("lateDayType", "CALENDAR"),
+    if error_message:
+        finish_batch_item(item["job_id"], item["zid"], error=error_message)
+    else:
+        finish_batch_item(
+            item["job_id"],
+            item["zid"],
+            raw_automark=marked["raw_automark"],
+            tests_passed=sum(1 for test in marked["results"] if test.get("passed")),
+            tests_total=len(marked["results"]),
         )
 
-        # Calculate penalty percentage
-        deduction_per_day = task_params.get("latePolicy", {}).get(
-            "percentDeductionPerDay", 0
+
+def resume_batch_automark_jobs():
+    """
+    Picks up every batch automark item that hadn't finished when the server went
+    down. Called once at start up.
+    """
+    # Grading workers import this module too (spawning can even re-import app.py),
+    # only the web process should be resuming jobs
+    if multiprocessing.parent_process() is not None:
+        return
+
+    for item in get_unfinished_batch_items():
+        batch_automark_executor.submit(run_batch_automark_item, item)
+
+
+@testing.route("/batch_automark", methods=["POST"])
+def batch_automark():
+    """
+    Route to start automarking every student's latest submission for a task in the background.
+    Request body:
+    json containing:
+        - "course_code": the course code in which the task is located
+        - "task": the task name
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code if the job was started with json containing:
+            - "job_id": the id to poll /batch_automark/<job_id> with
+            - "total": the number of submissions that will be marked
+        - 400 status code if nobody has submitted the task yet
+        - 401 status code if the user is not authorised
+    """
+    data = request.json
+    course_code = data["course_code"]
+    task = data["task"]
+
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, course_code) < USER_LEVEL_TUTOR:
+        logging.error(f"BATCH AUTOMARK run cancelled, requestor unauthorised")
+        return jsonify({"error": "Unauthorised"}), 401
+
+    # Every student with a result record has submitted at least once
+    results_ref = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task)
+        .collection("results")
+    )
+    submissions = []
+    for doc in results_ref.stream():
+        last_submitted = doc.to_dict().get("lastSubmitted")
+        if last_submitted:
+            submissions.append((doc.id, last_submitted))
+
+    if len(submissions) == 0:
+        return jsonify({"error": "No submissions to automark for this task"}), 400
+
+    job_id = create_batch_job(course_code, task, logged_in_zid, submissions)
+    for zid, submission_timestamp in submissions:
+        batch_automark_executor.submit(
+            run_batch_automark_item,
+            {
+                "job_id": job_id,
+                "course_code": course_code,
+                "task": task,
+                "zid": zid,
+                "submission_timestamp": submission_timestamp,
+            },
+        )
+
+    return jsonify({"job_id": job_id, "total": len(submissions)}), 200
+
+
+@testing.route("/batch_automark/<job_id>", methods=["GET"])
+def batch_automark_status(job_id):
+    """
+    Route to poll the progress of a batch automark job.
+    Parameters:
+        - "job_id": the id returned when the job was started
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code with json containing:
+            - "status": "running" or "finished"
+            - "progress": how many students are pending, running, done or failed, and the total
+            - "students": a list of dictionaries, one per student, each containing:
+                - "zid", "timestamp": the submission that was marked
+                - "status": "pending", "running", "done" or "failed"
+                - "raw_automark", "tests_passed", "tests_total": the outcome once done
+                - "error": why marking failed, if it did
+        - 401 status code if the user is not authorised
+        - 404 status code if there is no such job
+    """
+    job = get_batch_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, job["course_code"]) < USER_LEVEL_TUTOR:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    return jsonify(job), 200
+
+
+def rejudge_submission(
+    course_code, task, zid, submission_timestamp, fixtures, path, tolerance_filters
+):
+    """
+    Judges a submission against the automark tests under tolerance_filters purely
+    from its stored outputs, nothing is run. Returns the results, or None if some
+    test has no usable stored output.
+    """
+    digest = submission_digest(
+        load_submission_files(course_code, task, zid, submission_timestamp)
+    )
+    if digest is None:
+        return None
+    stored_outputs = load_raw_outputs(
+        raw_outputs_path(course_code, task, digest)
+    )
+
+    results = []
+    for test_case_dir in test_case_directories(fixtures):
+        stored = stored_outputs.get(test_case_name(test_case_dir))
+        parameters = load_test_parameters(fixtures, test_case_dir)
+        if stored is None or stored["execution_hash"] != execution_hash(
+            fixtures, path, test_case_dir, parameters
+        ):
+            return None
+        results.append(
+            rejudge_test_case(test_case_dir, fixtures, tolerance_filters, stored)
         )
-        penalty_percentage = (
-            min(late_days * deduction_per_day, 100) if late_days > 0 else 0
+    return results
+
+
+@testing.route("/regrade_automark", methods=["POST"])
+def regrade_automark():
+    """
+    Route to see what every student's automark would be under different tolerance
+    filters, without running anything. Each student's latest submission is judged
+    again from the output it printed when it was last automarked. Nothing is saved,
+    set the filters and run /batch_automark to apply them, which re-judges the same
+    stored outputs rather than running everything again.
+    Request body:
+    json containing:
+        - "course_code": the course code in which the task is located
+        - "task": the task name
+        - "tolerance_filters": a list of the tolerance filters to turn on, e.g.
+          ["ignoreWhitespacesAmount"]
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code with json containing:
+            - "students": a list of dictionaries, one per student that could be regraded, each containing:
+                - "zid", "timestamp": the submission that was regraded
+                - "raw_automark", "tests_passed": what they currently have, null if that submission hasn't been automarked
+                - "new_raw_automark", "new_tests_passed": what they'd get with the new filters
+                - "tests_total": the number of automark tests
+            - "not_regraded": the zids of students whose latest submission has no stored
+              output for some test (never automarked, or the tests have changed since),
+              only automark can grade them
+        - 400 status code if a tolerance filter is unknown or the task has no automark tests
+        - 401 status code if the user is not authorised
+        - 404 status code if the task is not found
+    """
+    data = request.json
+    course_code = data["course_code"]
+    task = data["task"]
+    tolerance_filters = data.get("tolerance_filters", [])
+
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, course_code) < USER_LEVEL_TUTOR:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    if not isinstance(tolerance_filters, list) or any(
+        filter not in TOLERANCE_FILTERS for filter in tolerance_filters
+    ):
+        return (
+            jsonify(
+                {"error": f"tolerance_filters must be a list of {TOLERANCE_FILTERS}"}
+            ),
+            400,
         )
 
-        if task_params.get("latePolicy", {}).get("maxLateDays") < late_days:
-            penalty_percentage = 100
+    task_ref = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task)
+    )
+    task_doc = task_ref.get()
+    if not task_doc.exists:
+        return jsonify({"error": "Task not found"}), 404
+    max_automark = task_doc.to_dict()["maxAutomark"]
 
-        # Apply penalty to raw mark
-        # final_mark = math.ceil(raw_mark * (1 - penalty_percentage / 100))
+    path = get_script_path(course_code, task, True)
+    fixtures = get_suite_fixtures(path, task_doc.to_dict(), True)
+    tests_total = len(test_case_directories(fixtures))
+    if tests_total == 0:
+        return jsonify({"error": "This task has no automark tests"}), 400
 
-        # Update student record
-        student_result_ref = task_ref.collection("results").document(zid_requested)
-        if student_result_ref.get().exists:
-            result_record = student_result_ref.get().to_dict()
-            result_record.update(
-                {
-                    # "automark": final_mark,
-                    "raw_automark": raw_mark,  # Store the raw mark before penalties
-                    "automark_timestamp": timestamp,
-                    "automark_report": report,
-                    "lateDays": late_days,
-                    "latePenaltyPercentage": penalty_percentage,
-                    "comments": result_record.get("comments", ""),
-                    "mark_released": result_record.get("mark_released", mark_released),
-                    "style": result_record.get("style", 0),
-                }
+    def regrade_student(result_doc):
+        result_record = result_doc.to_dict()
+        submission_timestamp = result_record["lastSubmitted"]
+        results = rejudge_submission(
+            course_code,
+            task,
+            result_doc.id,
+            submission_timestamp,
+            fixtures,
+            path,
+            tolerance_filters,
+        )
+        if results is None:
+            return result_doc.id, None
+
+        # Only compare against the current mark if it was for this submission
+        raw_automark = None
+        tests_passed = None
+        if result_record.get("automark_submission_timestamp") == submission_timestamp:
+            raw_automark = result_record.get("raw_automark")
+            tests_passed = sum(
+                1
+                for test_case in json.loads(result_record["automark_report"])
+                if test_case.get("passed")
             )
 
-            # If there's special consideration, include it in the record
-            if extension_hours > 0:
-                result_record["specialConsiderationApplied"] = {
-                    "extensionHours": extension_hours,
-                    "originalDeadline": task_params["deadline"],
-                    "extendedDeadline": deadline.isoformat(),
-                }
+        new_tests_passed = sum(1 for test_case in results if test_case["passed"])
+        return result_doc.id, {
+            "zid": result_doc.id,
+            "timestamp": submission_timestamp,
+            "raw_automark": raw_automark,
+            "tests_passed": tests_passed,
+            "new_raw_automark": round(
+                ((new_tests_passed / tests_total) * 100) * (max_automark / 100)
+            ),
+            "new_tests_passed": new_tests_passed,
+            "tests_total": tests_total,
+        }
 
-            student_result_ref.update(result_record)
-        else:
-            logging.error(
-                "result record does not exist, it should've been created from file upload!"
-            )
-            return jsonify({"error": "Internal server error"}), 500
+    result_docs = [
+        doc
+        for doc in task_ref.collection("results").stream()
+        if doc.to_dict().get("lastSubmitted")
+    ]
+    # Mostly waiting on storage downloads, hence the threads
+    with ThreadPoolExecutor(max_workers=REGRADE_DOWNLOAD_THREADS) as executor:
+        regraded = list(executor.map(regrade_student, result_docs))
 
-        return {"automark_results": result}
+    students = [student for _, student in regraded if student is not None]
+    not_regraded = [zid for zid, student in regraded if student is None]
+    return jsonify({"students": students, "not_regraded": not_regraded}), 200
 
-    except Exception as e:
-        logging.error(f"Error in automark: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+
+@testing.route("/test_stats/<course_code>/<task>/<hidden>", methods=["GET"])
+def test_stats(course_code, task, hidden):
+    """
+    Route to see how much time and memory each test of a task uses across every run
+    of it, to help set its limits.
+    Parameters:
+        - "course_code": the course code in which the task is located
+        - "task": the task name
+        - "hidden": a boolean indicating if the tests are automark (true) or autotest (false) tests
+    Headers:
+        - "Authorization": the bearer token for the user
+    Returns:
+        - 200 status code with json containing:
+            - "tests": a list of dictionaries, one per test in order, each containing:
+                - "test_name": the name of the test
+                - "cpu_time", "memory_megabytes": the limits currently set for the test
+                - "runs": how many times the test has been run
+                - "mean_wall_seconds", "max_wall_seconds": how long the test took
+                - "mean_cpu_seconds", "max_cpu_seconds": user + system CPU time used
+                - "mean_peak_rss_kb", "max_peak_rss_kb": peak memory used
+                - "last_run_at": unix time of the last run
+                (all but the first four are missing if the test has never run)
+        - 401 status code if the user is not authorised
+    """
+    token = request.headers.get("Authorization").split("Bearer ")[1]
+    logged_in_zid = verify_token(token)
+
+    if get_user_level(logged_in_zid, course_code) < USER_LEVEL_TUTOR:
+        return jsonify({"error": "Unauthorised"}), 401
+
+    path = get_script_path(course_code, task, hidden == "true")
+    stats = get_test_usage_stats(path)
+
+    tests = []
+    for blob in bucket.list_blobs(prefix=path):
+        if not blob.name.endswith("/parameters.json"):
+            continue
+        test_number = get_test_number(blob.name)
+        if test_number is None:
+            continue
+
+        parameters = json.loads(read_fixture(blob).decode("utf-8"))
+        test_case_dir = blob.name[: -len("parameters.json")]
+        tests.append(
+            (
+                test_number,
+                {
+                    "test_name": parameters["test_name"],
+                    "cpu_time": parameters["cpu_time"],
+                    "memory_megabytes": parameters["memory_megabytes"],
+                    "runs": 0,
+                    **stats.get(test_case_dir, {}),
+                },
+            )
+        )
+
+    tests.sort(key=lambda test: test[0])
+    return jsonify({"tests": [test for _, test in tests]}), 200
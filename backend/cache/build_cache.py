@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+from cache.fixture_cache import evict_lru_entries
+
+# An on disk cache of built submissions, i.e. what the submission folder looked
+# like after build.sh ran in it. Lets every test case, autotest reruns and automark
+# share one compile instead of each doing their own.
+
+# Entries are keyed by the build.sh and the submitted files (names and md5s), so
+# changing either means a fresh build. It's laid out and evicted exactly like the
+# fixture cache, see fixture_cache.py for why that is safe across processes.
+BUILD_CACHE_DIR = os.environ.get(
+    "IGIVE_BUILD_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "igive_build_cache"),
+)
+BUILD_CACHE_MAX_BYTES = (
+    int(os.environ.get("IGIVE_BUILD_CACHE_MAX_MB", 1024)) * 1024 * 1024
+)
+build_cache_logging = False
+build_cache_feature_enable = True
+
+
+def build_cache_key(build_blob, submission_blobs):
+    """
+    Returns the key of building submission_blobs with build_blob, or None if some
+    file has no md5 to identify it by (builds like that are never cached).
+    """
+    if not build_cache_feature_enable:
+        return None
+    if any(blob.md5_hash is None for blob in [build_blob, *submission_blobs]):
+        return None
+
+    identity = hashlib.sha256(f"build.sh\0{build_blob.md5_hash}\0".encode("utf-8"))
+    for name, md5_hash in sorted(
+        (blob.name.split("/")[-1], blob.md5_hash) for blob in submission_blobs
+    ):
+        identity.update(f"{name}\0{md5_hash}\0".encode("utf-8"))
+    return identity.hexdigest()
+
+
+def _entry_path(key) -> str:
+    return os.path.join(BUILD_CACHE_DIR, key[:2], key + ".tar")
+
+
+def restore_build(key, destination_dir) -> bool:
+    """
+    Unpacks the cached build into destination_dir. Returns False on a miss, the
+    caller has to build it themselves.
+    """
+    if key is None:
+        return False
+
+    entry_path = _entry_path(key)
+    try:
+        # Opened first so an eviction can't pull it out from under us
+        with open(entry_path, "rb") as handle:
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+            with tarfile.open(fileobj=handle, mode="r:") as archive:
+                archive.extractall(destination_dir, filter="data")
+    except FileNotFoundError:
+        if build_cache_logging:
+            logging.critical(f"build cache MISS with key {key}")
+        return False
+    except (OSError, tarfile.TarError) as e:
+        logging.error(f"Couldn't restore cached build {key}: {e}")
+        return False
+
+    if build_cache_logging:
+        logging.critical(f"build cache HIT with key {key}")
+    return True
+
+
+def store_build(key, build_dir):
+    if key is None:
+        return
+
+    entry_path = _entry_path(key)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as tmp_handle:
+            with tarfile.open(fileobj=tmp_handle, mode="w:") as archive:
+                archive.add(build_dir, arcname=".")
+        os.replace(tmp_path, entry_path)
+    except (OSError, tarfile.TarError) as e:
+        # not worth failing the run over, the next one will just build again
+        logging.error(f"Couldn't cache build {key}: {e}")
+        os.unlink(tmp_path)
+        return
+
+    evict_lru_entries(BUILD_CACHE_DIR, BUILD_CACHE_MAX_BYTES)
@@ -0,0 +1,168 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+# An on disk cache for test suite files (run.sh, parameters.json, in, out) so that
+# every autotest run doesn't go back to Cloud Storage for the exact same bytes.
+
+# Entries are keyed by the blob name AND its generation/md5. Cloud Storage gives an
+# overwritten blob a new generation, so an edited test can never be served stale,
+# the old entry just stops being asked for and falls off the end of the LRU.
+
+# Unlike the in memory caches this one is shared by every process on the machine
+# that points at the same directory. That is safe because:
+#   - entries are downloaded to a temp file and atomically renamed into place, so a
+#     reader never sees a half written file.
+#   - readers open the entry and read through the file descriptor, so an eviction
+#     racing with a read only unlinks the name, not the data being read.
+#   - eviction holds an exclusive flock so two processes don't both evict.
+FIXTURE_CACHE_DIR = os.environ.get(
+    "IGIVE_FIXTURE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "igive_fixture_cache"),
+)
+FIXTURE_CACHE_MAX_BYTES = (
+    int(os.environ.get("IGIVE_FIXTURE_CACHE_MAX_MB", 512)) * 1024 * 1024
+)
+fixture_cache_logging = False
+fixture_cache_feature_enable = True
+
+_LOCK_FILE_NAME = ".lock"
+
+
+def fixture_key(blob):
+    # Blobs made with bucket.blob() rather than list_blobs() don't carry any
+    # metadata, we can't tell if those are stale so they are never cached.
+    if blob.generation is None and blob.md5_hash is None:
+        return None
+
+    identity = f"{blob.name}#{blob.generation}#{blob.md5_hash}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def _entry_path(key) -> str:
+    # Shard into sub directories so no single directory gets huge
+    return os.path.join(FIXTURE_CACHE_DIR, key[:2], key)
+
+
+def _download_entry(blob, entry_path):
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as tmp_handle:
+            blob.download_to_file(tmp_handle)
+        os.replace(tmp_path, entry_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    evict_fixture_cache()
+
+
+def open_fixture(blob):
+    """
+    Returns a binary file object with the contents of the blob, downloading it into
+    the cache first on a miss. The caller is responsible for closing it.
+    """
+    # Files of a suite bundle are already on local disk, see suite_bundles.py
+    if hasattr(blob, "open_local"):
+        return blob.open_local()
+
+    key = fixture_key(blob) if fixture_cache_feature_enable else None
+    if key is None:
+        return _open_uncached(blob)
+
+    entry_path = _entry_path(key)
+    # Two attempts: the entry could be evicted by another process between our
+    # download finishing and us opening it.
+    for _ in range(2):
+        try:
+            handle = open(entry_path, "rb")
+            if fixture_cache_logging:
+                logging.critical(f"fixture cache HIT with blob {blob.name}")
+
+            # bump mtime, eviction throws out the least recently used entries first
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+            return handle
+        except FileNotFoundError:
+            if fixture_cache_logging:
+                logging.critical(f"fixture cache MISS with blob {blob.name}")
+            _download_entry(blob, entry_path)
+
+    return _open_uncached(blob)
+
+
+def _open_uncached(blob):
+    handle = tempfile.TemporaryFile()
+    blob.download_to_file(handle)
+    handle.seek(0)
+    return handle
+
+
+def read_fixture(blob) -> bytes:
+    with open_fixture(blob) as handle:
+        return handle.read()
+
+
+def copy_fixture(blob, destination_path):
+    with open_fixture(blob) as handle, open(destination_path, "wb") as destination:
+        shutil.copyfileobj(handle, destination)
+
+
+def evict_fixture_cache():
+    """
+    Throws out the least recently used entries until the cache fits in
+    FIXTURE_CACHE_MAX_BYTES again.
+    """
+    evict_lru_entries(FIXTURE_CACHE_DIR, FIXTURE_CACHE_MAX_BYTES)
+
+
+def evict_lru_entries(cache_dir, max_bytes):
+    """
+    Eviction for any on disk cache laid out like this one: entries sharded into
+    sub directories, written as .part files and renamed into place, mtime bumped
+    on every use. Throws out the least recently used until they fit in max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, _LOCK_FILE_NAME), "a") as lock_handle:
+        try:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Someone else is already evicting, no point doing it twice
+            return
+
+        try:
+            entries = []
+            total_size = 0
+            for shard in os.scandir(cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(".part"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            if total_size <= max_bytes:
+                return
+
+            entries.sort()
+            for _, size, entry_path in entries:
+                if total_size <= max_bytes:
+                    break
+                try:
+                    os.unlink(entry_path)
+                    total_size -= size
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
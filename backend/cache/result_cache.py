@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from grading.local_db import get_connection
+
+# A cache of whole run_testing() results, so re-running autotests on the same
+# submission, re-running automark on unchanged code, or two students handing in
+# identical files doesn't grade the exact same thing twice.
+
+# The key is made of:
+#   - the name and md5 of every submitted file (not the zid or timestamp, so
+#     identical submissions share an entry)
+#   - the name and md5 of every file in the test suite, run.sh and parameters.json
+#     included
+#   - the tolerance filters that are turned on
+# so editing a test, the runner or the filters gives a new key and the old entry
+# just stops being asked for until it is evicted. No invalidation needed.
+
+# Lives in the grading database so every worker process shares it.
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("IGIVE_RESULT_CACHE_MAX_ENTRIES", 5000))
+# Bump this whenever results change shape, so old entries aren't served any more
+RESULT_CACHE_VERSION = 2
+result_cache_logging = False
+result_cache_feature_enable = True
+
+_schema_created = False
+
+
+def _db():
+    global _schema_created
+    connection = get_connection()
+    if not _schema_created:
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS result_cache (
+                cache_key TEXT PRIMARY KEY,
+                results TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """)
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS result_cache_last_used ON result_cache (last_used)"
+        )
+        _schema_created = True
+    return connection
+
+
+def _files_digest(blobs, name_of) -> str:
+    digest = hashlib.sha256()
+    for name, md5_hash in sorted((name_of(blob), blob.md5_hash) for blob in blobs):
+        digest.update(f"{name}\0{md5_hash}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def result_cache_key(submission_blobs, suite_path, suite_blobs, tolerance_filters):
+    """
+    Works out the key for grading the given submission files against the test suite
+    at suite_path. Returns None if some file has no md5 to identify it by, runs
+    like that are never cached.
+    """
+    if not result_cache_feature_enable:
+        return None
+    if any(blob.md5_hash is None for blob in [*submission_blobs, *suite_blobs]):
+        return None
+
+    # Submissions are compared by file name only, suites by their path inside the
+    # task (the course and task themselves are part of suite_path)
+    submission = _files_digest(submission_blobs, lambda blob: blob.name.split("/")[-1])
+    suite = _files_digest(suite_blobs, lambda blob: blob.name[len(suite_path) :])
+    identity = json.dumps(
+        [RESULT_CACHE_VERSION, suite_path, suite, submission, sorted(tolerance_filters)]
+    ).encode("utf-8")
+    return hashlib.sha256(identity).hexdigest()
+
+
+def get_cached_results(cache_key):
+    """
+    Returns the stored results for cache_key, or None on a miss.
+    """
+    if cache_key is None:
+        return None
+
+    # The cache is only ever an optimisation, if it's broken just grade
+    try:
+        connection = _db()
+        row = connection.execute(
+            "SELECT results FROM result_cache WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE result_cache SET last_used = ? WHERE cache_key = ?",
+                (time.time(), cache_key),
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Result cache lookup failed: {e}")
+        return None
+
+    if row is None:
+        if result_cache_logging:
+            logging.critical(f"result cache MISS with key {cache_key}")
+        return None
+
+    if result_cache_logging:
+        logging.critical(f"result cache HIT with key {cache_key}")
+    return json.loads(row["results"])
+
+
+def store_cached_results(cache_key, results):
+    if cache_key is None:
+        return
+
+    try:
+        _db().execute(
+            "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?)",
+            (cache_key, json.dumps(results), time.time()),
+        )
+        evict_result_cache()
+    except sqlite3.Error as e:
+        logging.error(f"Couldn't store results in the result cache: {e}")
+
+
+def evict_result_cache():
+    """
+    Throws out the least recently used entries until there are at most
+    RESULT_CACHE_MAX_ENTRIES left.
+    """
+    _db().execute(
+        """
+        DELETE FROM result_cache WHERE cache_key IN (
+            SELECT cache_key FROM result_cache
+            ORDER BY last_used DESC
+            LIMIT -1 OFFSET ?
+        )
+        """,
+        (RESULT_CACHE_MAX_ENTRIES,),
+    )
@@ -0,0 +1,283 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from cache.fixture_cache import evict_lru_entries, read_fixture
+from firebase import db, bucket
+
+# A test suite is lots of tiny blobs (run.sh, build.sh, test_N/in, test_N/out,
+# test_N/parameters.json), so loading one file by file costs a listing plus a
+# request per file. Every time a suite changes it is also packed into a single
+# bundle, a tar.gz with a manifest.json in front, at
+#   {course}/{task}/bundles/{autotest|automark}/{version}.tar.gz
+# and the task document's "suiteBundles" field points at the current one:
+#   {"autotest": {"version": ..., "path": ...}, "automark": {...}}
+# Graders then fetch the whole suite in one request, and only when the version
+# changes.
+
+# The version is a digest of every file's name and md5, so a bundle never changes
+# once written and a grader can keep it for as long as it likes. Bundles are kept
+# here uncompressed, files are read straight out of them. Laid out and evicted
+# like the fixture cache, see fixture_cache.py for why that's safe across processes.
+SUITE_BUNDLE_CACHE_DIR = os.environ.get(
+    "IGIVE_SUITE_BUNDLE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "igive_suite_bundle_cache"),
+)
+SUITE_BUNDLE_CACHE_MAX_BYTES = (
+    int(os.environ.get("IGIVE_SUITE_BUNDLE_CACHE_MAX_MB", 512)) * 1024 * 1024
+)
+# How many times a publish lists the suite again after losing a race with another
+SUITE_BUNDLE_PUBLISH_ATTEMPTS = 5
+# How old an unused bundle has to be before a publish deletes it
+SUITE_BUNDLE_GRACE_SECONDS = 10 * 60
+# Bump this whenever bundles change shape
+SUITE_BUNDLE_FORMAT = 1
+suite_bundle_logging = False
+suite_bundle_feature_enable = True
+
+_MANIFEST_NAME = "manifest.json"
+# version -> (manifest, {file name: (offset, size)}) of bundles this process has used
+_MAX_INDEXES = 256
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class BundledFile:
+    """
+    A file of a suite bundle, standing in for its blob in run_testing()'s fixtures.
+    Has the same name and md5_hash as the blob it was packed from. The fixture cache
+    reads it through open_local() rather than downloading anything.
+    """
+
+    def __init__(self, name, md5_hash, size, bundle, file_name):
+        self.name = name
+        self.md5_hash = md5_hash
+        self.size = size
+        self.generation = None
+        self._bundle = bundle
+        self._file_name = file_name
+
+    def open_local(self):
+        return io.BytesIO(_read_bundled_file(self._bundle, self._file_name))
+
+
+def _md5_hash(data) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode("utf-8")
+
+
+def suite_bundle_kind(hidden) -> str:
+    return "automark" if hidden else "autotest"
+
+
+def _suite_bundle_pointer(task_snapshot, kind):
+    return ((task_snapshot.to_dict() or {}).get("suiteBundles") or {}).get(kind)
+
+
+@firestore.transactional
+def _swap_suite_bundle_pointer(transaction, task_ref, kind, expected, pointer) -> bool:
+    # Points the task at pointer only if it still points at expected, i.e. nobody
+    # published between us reading expected and listing the suite. If somebody did,
+    # their listing could be newer than ours.
+    current = _suite_bundle_pointer(task_ref.get(transaction=transaction), kind)
+    if current != expected:
+        return False
+    transaction.update(task_ref, {f"suiteBundles.{kind}": pointer})
+    return True
+
+
+def _pack_suite_bundle(course_code, task, kind, suite_path, previous):
+    # Bundles the suite as it is in storage now and returns the task's pointer to
+    # it, None if the suite is empty. Nothing is uploaded if previous is the same.
+    files = {}
+    for blob in bucket.list_blobs(prefix=suite_path):
+        if not blob.name.endswith("/"):
+            files[blob.name[len(suite_path) :]] = read_fixture(blob)
+
+    if not files:
+        return None
+
+    # md5s of the bytes actually packed, in the same format as Cloud Storage's
+    manifest = {
+        "format": SUITE_BUNDLE_FORMAT,
+        "files": {
+            file_name: {"md5_hash": _md5_hash(data), "size": len(data)}
+            for file_name, data in sorted(files.items())
+        },
+    }
+    manifest_bytes = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    version = hashlib.sha256(manifest_bytes).hexdigest()
+    bundle_path = f"{course_code}/{task}/bundles/{kind}/{version}.tar.gz"
+    pointer = {"version": version, "path": bundle_path}
+    if pointer == previous:
+        return pointer
+
+    with tempfile.TemporaryFile() as bundle_handle:
+        with gzip.GzipFile(fileobj=bundle_handle, mode="wb", mtime=0) as gzipped:
+            with tarfile.open(fileobj=gzipped, mode="w:") as archive:
+                for file_name, data in [
+                    (_MANIFEST_NAME, manifest_bytes),
+                    *sorted(files.items()),
+                ]:
+                    member = tarfile.TarInfo(file_name)
+                    member.size = len(data)
+                    archive.addfile(member, io.BytesIO(data))
+        bundle_handle.seek(0)
+        bucket.blob(bundle_path).upload_from_file(
+            bundle_handle, content_type="application/gzip"
+        )
+    return pointer
+
+
+def publish_suite_bundle(course_code, task, hidden):
+    """
+    Packs the task's autotest (or automark if hidden) suite as it is in storage now
+    into a bundle and points the task at it. Call after every change to a suite.
+    Two publishes of the same suite at once can't leave the task pointing at the
+    older listing: whoever loses the race lists the suite again.
+    """
+    kind = suite_bundle_kind(hidden)
+    suite_path = f"{course_code}/{task}/scripts/{kind}/"
+    task_ref = (
+        db.collection("courses")
+        .document(course_code)
+        .collection("tasks")
+        .document(task)
+    )
+    try:
+        for _ in range(SUITE_BUNDLE_PUBLISH_ATTEMPTS):
+            # Read before listing, see _swap_suite_bundle_pointer()
+            previous = _suite_bundle_pointer(task_ref.get(), kind)
+            pointer = _pack_suite_bundle(course_code, task, kind, suite_path, previous)
+            if pointer == previous:
+                return
+            if _swap_suite_bundle_pointer(
+                db.transaction(), task_ref, kind, previous, pointer
+            ):
+                break
+        else:
+            # Whoever keeps beating us lists the suite after we did anyway
+            logging.error(f"Gave up bundling {suite_path}, it kept changing")
+            return
+
+        if pointer is None:
+            return
+
+        # Graders that already started with the previous bundle might still need
+        # it, anything older can go. Except what was only just uploaded, that
+        # could be another publish's that is about to be pointed at.
+        keep = {pointer["path"], None if previous is None else previous["path"]}
+        uploaded_before = datetime.now(timezone.utc) - timedelta(
+            seconds=SUITE_BUNDLE_GRACE_SECONDS
+        )
+        for blob in bucket.list_blobs(prefix=f"{course_code}/{task}/bundles/{kind}/"):
+            if blob.name not in keep and blob.time_created < uploaded_before:
+                blob.delete()
+    except Exception as e:
+        # Without a bundle graders go back to reading the suite file by file, which
+        # is slower but never stale
+        logging.error(f"Couldn't bundle {suite_path}: {e}")
+        try:
+            task_ref.update({f"suiteBundles.{kind}": None})
+        except Exception as e:
+            logging.error(f"Couldn't clear the bundle of {suite_path}: {e}")
+
+
+def get_suite_fixtures(suite_path, task_dict, hidden) -> dict:
+    """
+    Returns every file of the suite at suite_path as blob name -> blob (or
+    BundledFile), from the task's bundle if it has one.
+    """
+    bundle = (task_dict.get("suiteBundles") or {}).get(suite_bundle_kind(hidden))
+    if bundle is not None and suite_bundle_feature_enable:
+        try:
+            manifest, _ = _bundle_index(bundle)
+            fixtures = {}
+            for file_name, details in manifest["files"].items():
+                name = suite_path + file_name
+                fixtures[name] = BundledFile(
+                    name, details["md5_hash"], details["size"], bundle, file_name
+                )
+            return fixtures
+        except Exception as e:
+            logging.error(f"Couldn't load suite bundle {bundle['path']}: {e}")
+
+    return {blob.name: blob for blob in bucket.list_blobs(prefix=suite_path)}
+
+
+def _entry_path(version) -> str:
+    return os.path.join(SUITE_BUNDLE_CACHE_DIR, version[:2], version + ".tar")
+
+
+def _download_bundle(bundle, entry_path):
+    if suite_bundle_logging:
+        logging.critical(f"suite bundle MISS with version {bundle['version']}")
+
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".part")
+    try:
+        with tempfile.TemporaryFile() as compressed, os.fdopen(fd, "wb") as tmp_handle:
+            bucket.blob(bundle["path"]).download_to_file(compressed)
+            compressed.seek(0)
+            with gzip.GzipFile(fileobj=compressed, mode="rb") as gzipped:
+                shutil.copyfileobj(gzipped, tmp_handle)
+        os.replace(tmp_path, entry_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    evict_lru_entries(SUITE_BUNDLE_CACHE_DIR, SUITE_BUNDLE_CACHE_MAX_BYTES)
+
+
+def _open_bundle(bundle):
+    entry_path = _entry_path(bundle["version"])
+    # Two attempts: another process could evict it right after we download it
+    for _ in range(2):
+        try:
+            handle = open(entry_path, "rb")
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+            return handle
+        except FileNotFoundError:
+            _download_bundle(bundle, entry_path)
+    return open(entry_path, "rb")
+
+
+def _bundle_index(bundle):
+    with _indexes_lock:
+        index = _indexes.get(bundle["version"])
+    if index is not None:
+        return index
+
+    with _open_bundle(bundle) as handle:
+        with tarfile.open(fileobj=handle, mode="r:") as archive:
+            offsets = {
+                member.name: (member.offset_data, member.size)
+                for member in archive.getmembers()
+            }
+            manifest = json.loads(archive.extractfile(_MANIFEST_NAME).read())
+    if manifest["format"] != SUITE_BUNDLE_FORMAT:
+        raise ValueError(f"unknown bundle format {manifest['format']}")
+
+    with _indexes_lock:
+        if len(_indexes) >= _MAX_INDEXES:
+            _indexes.pop(next(iter(_indexes)))
+        _indexes[bundle["version"]] = (manifest, offsets)
+    return manifest, offsets
+
+
+def _read_bundled_file(bundle, file_name) -> bytes:
+    _, offsets = _bundle_index(bundle)
+    offset, size = offsets[file_name]
+    with _open_bundle(bundle) as handle:
+        return os.pread(handle.fileno(), size, offset)
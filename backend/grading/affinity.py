@@ -0,0 +1,56 @@
+import bisect
+import hashlib
+
+# Which grading workers a task's jobs should go to. Every worker keeps its own
+# fixture, suite bundle and build caches, so if any worker could pick up any job
+# every worker would end up fetching every task's suite. Instead each task is
+# hashed onto a ring of the live workers and "lives" on the next few of them,
+# its home. Consistent hashing means a worker joining or leaving only moves the
+# tasks next to it on the ring, everyone else's caches stay warm.
+
+# Points each worker gets on the ring per slot, more points spread tasks more evenly
+_POINTS_PER_SLOT = 16
+
+
+def _hash(value) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class AffinityRing:
+    """
+    A consistent hash ring of workers, given as (worker_id, slots) pairs. Workers
+    with more slots get a bigger share of the tasks.
+    """
+
+    def __init__(self, workers, home_size):
+        self._slots = dict(workers)
+        self._home_size = min(home_size, len(self._slots))
+        self._points = sorted(
+            (_hash(f"{worker_id}#{point}"), worker_id)
+            for worker_id, slots in workers
+            for point in range(max(slots, 1) * _POINTS_PER_SLOT)
+        )
+        self._hashes = [point_hash for point_hash, _ in self._points]
+        self._homes = {}
+
+    def home(self, key) -> tuple:
+        """
+        The workers jobs with this affinity key belong on, empty if key is None or
+        there are no workers (anyone can take those jobs).
+        """
+        if key is None or not self._points:
+            return ()
+        home = self._homes.get(key)
+        if home is None:
+            home = []
+            index = bisect.bisect(self._hashes, _hash(key))
+            while len(home) < self._home_size:
+                _, worker_id = self._points[index % len(self._points)]
+                if worker_id not in home:
+                    home.append(worker_id)
+                index += 1
+            home = self._homes[key] = tuple(home)
+        return home
+
+    def slots(self, home) -> int:
+        return sum(self._slots[worker_id] for worker_id in home)
@@ -0,0 +1,275 @@
+import os
+import sqlite3
+import uuid
+from datetime import datetime
+from grading.local_db import get_connection
+
+# The journal of cohort wide batch automark jobs. Every student in a job is an item
+# which moves pending -> running -> done/failed. The journal lives in SQLite so a
+# server restart can pick up the items that never finished instead of starting over.
+
+BATCH_JOB_STATUS_RUNNING = "running"
+BATCH_JOB_STATUS_FINISHED = "finished"
+
+BATCH_ITEM_STATUS_PENDING = "pending"
+BATCH_ITEM_STATUS_RUNNING = "running"
+BATCH_ITEM_STATUS_DONE = "done"
+BATCH_ITEM_STATUS_FAILED = "failed"
+
+_schema_created = False
+
+
+def _process_start_time(pid):
+    # Field 22 of /proc/<pid>/stat, in clock ticks since boot. Unlike the pid it is
+    # never handed to a later process, and the host's boot doesn't change when a
+    # container restarts.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name can contain spaces, the fields we want come after it
+    return stat[stat.rindex(")") + 2 :].split()[19]
+
+
+# Identifies this process among every process that ever had our pid, in a container
+# that restarts, pids come round again straight away
+OWNER_TOKEN = _process_start_time(os.getpid()) or uuid.uuid4().hex
+
+
+def _db():
+    global _schema_created
+    connection = get_connection()
+    if not _schema_created:
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                job_id TEXT PRIMARY KEY,
+                course_code TEXT NOT NULL,
+                task TEXT NOT NULL,
+                requested_by TEXT,
+                status TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS batch_job_items (
+                job_id TEXT NOT NULL,
+                zid TEXT NOT NULL,
+                submission_timestamp TEXT NOT NULL,
+                status TEXT NOT NULL,
+                owner_pid INTEGER,
+                owner_token TEXT,
+                raw_automark INTEGER,
+                tests_passed INTEGER,
+                tests_total INTEGER,
+                error TEXT,
+                finished_at TEXT,
+                PRIMARY KEY (job_id, zid)
+            );
+            """)
+        try:
+            # Journals made before items recorded their owner's token
+            connection.execute("ALTER TABLE batch_job_items ADD COLUMN owner_token TEXT")
+        except sqlite3.OperationalError:
+            pass
+        _schema_created = True
+    return connection
+
+
+def _now() -> str:
+    return datetime.now().strftime("%d-%m-%Y %X")
+
+
+def create_batch_job(course_code, task, requested_by, submissions) -> str:
+    """
+    Journals a new job. submissions is a list of (zid, submission_timestamp).
+    """
+    job_id = uuid.uuid4().hex
+    connection = _db()
+    with connection:
+        connection.execute("BEGIN")
+        connection.execute(
+            "INSERT INTO batch_jobs VALUES (?, ?, ?, ?, ?, ?, NULL)",
+            (job_id, course_code, task, requested_by, BATCH_JOB_STATUS_RUNNING, _now()),
+        )
+        connection.executemany(
+            "INSERT INTO batch_job_items (job_id, zid, submission_timestamp, status) VALUES (?, ?, ?, ?)",
+            [
+                (job_id, zid, timestamp, BATCH_ITEM_STATUS_PENDING)
+                for zid, timestamp in submissions
+            ],
+        )
+    return job_id
+
+
+def claim_batch_item(job_id, zid) -> bool:
+    """
+    Atomically moves an item from pending to running. Only one caller (across every
+    process sharing the journal) gets True for a given item.
+    """
+    cursor = _db().execute(
+        "UPDATE batch_job_items SET status = ?, owner_pid = ?, owner_token = ? WHERE job_id = ? AND zid = ? AND status = ?",
+        (
+            BATCH_ITEM_STATUS_RUNNING,
+            os.getpid(),
+            OWNER_TOKEN,
+            job_id,
+            zid,
+            BATCH_ITEM_STATUS_PENDING,
+        ),
+    )
+    return cursor.rowcount == 1
+
+
+def finish_batch_item(
+    job_id, zid, raw_automark=None, tests_passed=None, tests_total=None, error=None
+):
+    connection = _db()
+    status = BATCH_ITEM_STATUS_FAILED if error is not None else BATCH_ITEM_STATUS_DONE
+    with connection:
+        connection.execute("BEGIN")
+        connection.execute(
+            """
+            UPDATE batch_job_items
+            SET status = ?, raw_automark = ?, tests_passed = ?, tests_total = ?, error = ?, finished_at = ?
+            WHERE job_id = ? AND zid = ?
+            """,
+            (
+                status,
+                raw_automark,
+                tests_passed,
+                tests_total,
+                error,
+                _now(),
+                job_id,
+                zid,
+            ),
+        )
+        # Last one out closes the job
+        connection.execute(
+            """
+            UPDATE batch_jobs SET status = ?, finished_at = ?
+            WHERE job_id = ? AND status = ? AND NOT EXISTS (
+                SELECT 1 FROM batch_job_items WHERE job_id = ? AND status IN (?, ?)
+            )
+            """,
+            (
+                BATCH_JOB_STATUS_FINISHED,
+                _now(),
+                job_id,
+                BATCH_JOB_STATUS_RUNNING,
+                job_id,
+                BATCH_ITEM_STATUS_PENDING,
+                BATCH_ITEM_STATUS_RUNNING,
+            ),
+        )
+
+
+def _owner_alive(pid, token) -> bool:
+    """
+    Whether the process that claimed an item is still running. The pid alone can't
+    say, after a restart the new server (or one of its threads) can have the very
+    pid the old one had.
+    """
+    if pid is None or token is None:
+        return False
+    if pid == os.getpid():
+        return token == OWNER_TOKEN
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # Where there's no /proc the best we can do is trust a live pid
+    start_time = _process_start_time(pid)
+    return start_time is None or start_time == token
+
+
+def get_unfinished_batch_items():
+    """
+    Returns every item that still has to be marked, as a list of dictionaries with
+    the job_id, course_code, task, zid and submission_timestamp. Items left running
+    by a process that has since died (i.e. the server restarted mid job) are put
+    back to pending first, even if a new process has since been given its pid.
+    """
+    connection = _db()
+    running = connection.execute(
+        "SELECT job_id, zid, owner_pid, owner_token FROM batch_job_items WHERE status = ?",
+        (BATCH_ITEM_STATUS_RUNNING,),
+    ).fetchall()
+    for item in running:
+        if not _owner_alive(item["owner_pid"], item["owner_token"]):
+            connection.execute(
+                """
+                UPDATE batch_job_items SET status = ?, owner_pid = NULL, owner_token = NULL
+                WHERE job_id = ? AND zid = ? AND owner_pid IS ? AND owner_token IS ?
+                """,
+                (
+                    BATCH_ITEM_STATUS_PENDING,
+                    item["job_id"],
+                    item["zid"],
+                    item["owner_pid"],
+                    item["owner_token"],
+                ),
+            )
+
+    rows = connection.execute(
+        """
+        SELECT items.job_id, jobs.course_code, jobs.task, items.zid, items.submission_timestamp
+        FROM batch_job_items AS items JOIN batch_jobs AS jobs ON items.job_id = jobs.job_id
+        WHERE items.status = ?
+        ORDER BY items.rowid
+        """,
+        (BATCH_ITEM_STATUS_PENDING,),
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_batch_job(job_id):
+    """
+    Returns the job with its progress and per student outcomes, or None if there is
+    no such job.
+    """
+    connection = _db()
+    job = connection.execute(
+        "SELECT * FROM batch_jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    if job is None:
+        return None
+
+    items = connection.execute(
+        "SELECT * FROM batch_job_items WHERE job_id = ? ORDER BY zid", (job_id,)
+    ).fetchall()
+
+    progress = {
+        BATCH_ITEM_STATUS_PENDING: 0,
+        BATCH_ITEM_STATUS_RUNNING: 0,
+        BATCH_ITEM_STATUS_DONE: 0,
+        BATCH_ITEM_STATUS_FAILED: 0,
+    }
+    for item in items:
+        progress[item["status"]] += 1
+    progress["total"] = len(items)
+
+    return {
+        "job_id": job["job_id"],
+        "course_code": job["course_code"],
+        "task": job["task"],
+        "requested_by": job["requested_by"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+        "progress": progress,
+        "students": [
+            {
+                "zid": item["zid"],
+                "timestamp": item["submission_timestamp"],
+                "status": item["status"],
+                "raw_automark": item["raw_automark"],
+                "tests_passed": item["tests_passed"],
+                "tests_total": item["tests_total"],
+                "error": item["error"],
+            }
+            for item in items
+        ],
+    }
@@ -0,0 +1,182 @@
+import difflib
+import hashlib
+import itertools
+import re
+
+# The output comparison engine used to grade test cases. This used to be a pile of
+# dos2unix, perl and GNU diff forks per test case, now it all happens in process.
+
+# Every tolerance filter an admin can turn on for a task (see set_tolerance_filters)
+TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE = "ignoreTrailingNewline"
+TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES = "ignoreTrailingWhitespaces"
+TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT = "ignoreWhitespacesAmount"
+TOLERANCE_FILTER_IGNORE_CASE_DIFFERENCES = "ignoreCaseDifferences"
+TOLERANCE_FILTERS = [
+    TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE,
+    TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES,
+    TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT,
+    TOLERANCE_FILTER_IGNORE_CASE_DIFFERENCES,
+]
+
+# What GNU diff considers to be white space
+_WHITESPACE = b" \t\v\f\r"
+_WHITESPACE_RUN = re.compile(rb"[ \t\v\f\r]+")
+
+
+def normalise_newlines(data: bytes) -> bytes:
+    """
+    Converts Windows' CRLF to *nix's LF, same as dos2unix.
+    """
+    return data.replace(b"\r\n", b"\n")
+
+
+def normalise_line(line: bytes, tolerance_filters) -> bytes:
+    """
+    Normalises a single line (without its newline) so that two lines are equal
+    under the given tolerance filters exactly when their normalised forms are equal.
+    """
+    if TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT in tolerance_filters:
+        # Same as diff --ignore-space-change, which also ignores trailing white space
+        line = _WHITESPACE_RUN.sub(b" ", line.rstrip(_WHITESPACE))
+    elif TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES in tolerance_filters:
+        line = line.rstrip(_WHITESPACE)
+
+    if TOLERANCE_FILTER_IGNORE_CASE_DIFFERENCES in tolerance_filters:
+        line = line.lower()
+
+    return line
+
+
+class OutputNormaliser:
+    """
+    Turns an output into its canonical form under the given tolerance filters, a
+    chunk at a time so a student's output never has to be held in memory. Two
+    outputs compare equal exactly when their canonical forms are byte for byte equal.
+
+    Every line is terminated with a newline in the canonical form. A last line that
+    was missing its newline gets a trailing backslash on top, so that "missing
+    newline at end of file" is still a difference, like it is in diff. Also like
+    diff, the missing newline stops mattering once either white space filter is on,
+    since it counts as trailing white space.
+    """
+
+    def __init__(self, tolerance_filters, sink):
+        # sink gets called with each piece of the canonical form as it is produced
+        self.tolerance_filters = tolerance_filters
+        self.sink = sink
+        self.chomp = TOLERANCE_FILTER_IGNORE_TRAILING_NEWLINE in tolerance_filters
+        self.ignore_missing_newline = (
+            TOLERANCE_FILTER_IGNORE_TRAILING_WHITESPACES in tolerance_filters
+            or TOLERANCE_FILTER_IGNORE_WHITESPACES_AMOUNT in tolerance_filters
+        )
+        self.partial_line = b""
+        # The last complete line is held back until we know if it is the last one
+        # in the output, that's the only line the trailing newline filter touches.
+        self.held_line = None
+
+    def _emit(self, line: bytes, terminated: bool):
+        if terminated:
+            self.sink(normalise_line(line, self.tolerance_filters) + b"\n")
+        elif line:
+            self.sink(normalise_line(line, self.tolerance_filters) + b"\n")
+            if not self.ignore_missing_newline:
+                self.sink(b"\\")
+
+    def feed(self, chunk: bytes):
+        lines = (self.partial_line + chunk).split(b"\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            if self.held_line is not None:
+                self._emit(self.held_line, True)
+            self.held_line = line
+
+    def finish(self):
+        if self.partial_line:
+            if self.held_line is not None:
+                self._emit(self.held_line, True)
+            self._emit(self.partial_line, False)
+        elif self.held_line is not None:
+            # Same as perl -pe 'chomp if eof', only the very last newline goes
+            self._emit(self.held_line, not self.chomp)
+
+        self.partial_line = b""
+        self.held_line = None
+
+
+def normalise_output(data: bytes, tolerance_filters) -> bytes:
+    """
+    Returns the canonical form of a whole output, see OutputNormaliser.
+    """
+    pieces = []
+    normaliser = OutputNormaliser(tolerance_filters, pieces.append)
+    normaliser.feed(data)
+    normaliser.finish()
+    return b"".join(pieces)
+
+
+def tolerance_filters_key(tolerance_filters) -> str:
+    """
+    A stable name for a set of tolerance filters, used to look up stored digests.
+    """
+    return "+".join(sorted(tolerance_filters)) or "none"
+
+
+def output_digest(chunks, tolerance_filters) -> str:
+    """
+    Digest of the canonical form of an output given as an iterable of byte chunks.
+    Two outputs compare equal exactly when their digests are equal.
+    """
+    digest = hashlib.sha256()
+    normaliser = OutputNormaliser(tolerance_filters, digest.update)
+    for chunk in chunks:
+        normaliser.feed(chunk)
+    normaliser.finish()
+    return digest.hexdigest()
+
+
+def expected_output_digests(expected: bytes) -> dict:
+    """
+    Digests of an expected output under every combination of tolerance filters, so
+    that grading never has to normalise the expected output again however the admin
+    sets the filters. Keyed by tolerance_filters_key().
+    """
+    expected = normalise_newlines(expected)
+    digests = {}
+    for count in range(len(TOLERANCE_FILTERS) + 1):
+        for tolerance_filters in itertools.combinations(TOLERANCE_FILTERS, count):
+            digests[tolerance_filters_key(tolerance_filters)] = output_digest(
+                [expected], tolerance_filters
+            )
+    return digests
+
+
+def compare_outputs(expected: bytes, actual: bytes, tolerance_filters):
+    """
+    Compares the expected output of a test case against a student's output.
+    Returns a (equal, difference) tuple where difference is a unified diff of the
+    two outputs, it is only worked out (and non empty) when they don't match.
+    """
+    if normalise_output(expected, tolerance_filters) == normalise_output(
+        actual, tolerance_filters
+    ):
+        return True, ""
+
+    return False, unified_diff(expected, actual)
+
+
+def unified_diff(expected: bytes, actual: bytes) -> str:
+    diff_lines = difflib.diff_bytes(
+        difflib.unified_diff,
+        expected.splitlines(keepends=True),
+        actual.splitlines(keepends=True),
+        b"expected output",
+        b"your output",
+    )
+
+    difference = b""
+    for line in diff_lines:
+        if not line.endswith(b"\n"):
+            line += b"\n\\ No newline at end of file\n"
+        difference += line
+
+    return difference.decode("utf-8", errors="replace")
@@ -0,0 +1,288 @@
+import os
+import threading
+import time
+import uuid
+import zlib
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from firebase import db
+from grading.job_queue import (
+    GRADING_QUEUE_STATUS_FAILED,
+    GRADING_QUEUE_STATUS_FINISHED,
+    GRADING_QUEUE_STATUS_QUEUED,
+    GRADING_QUEUE_STATUS_RUNNING,
+    GradingQueueBackend,
+)
+
+# The grading queue in Firestore, see job_queue.py. Web servers and grading
+# workers can be on as many machines as they like. It's laid out like the SQLite
+# queue (sqlite_queue.py), a collection per table:
+#   gradingQueue/{job_id}: one per job. Job ids sort by when they were queued, so
+#     the oldest queued jobs are simply the first ones with status "queued".
+#     "collector" is the web process waiting on it, "done" is set once there's a
+#     result for it to pick up.
+#   gradingWorkers/{worker_id}: one per worker, with its slots and last heartbeat
+#   gradingStreamEvents/{stream_id}-{seq}: what a streamed job has reported and
+#     the web process hasn't read yet, in order
+#   gradingStreamCancels/{stream_id}: the streams whose client went away
+# Claims and results are written in transactions that check the job is still
+# in the state it was read in, so two workers never get the same job and a worker
+# that was given up on can't overwrite its job's next run. Every query is on one
+# field at a time (or on equality only), so nothing needs a composite index.
+# Payloads and results are compressed, a document can only hold 1MB.
+
+GRADING_QUEUE_COLLECTION = "gradingQueue"
+GRADING_WORKERS_COLLECTION = "gradingWorkers"
+GRADING_STREAM_EVENTS_COLLECTION = "gradingStreamEvents"
+GRADING_STREAM_CANCELS_COLLECTION = "gradingStreamCancels"
+
+# How far down the queue a worker looks for jobs of its own. Less than SQLite,
+# every job looked at is a read, and locked until the claim commits.
+_CLAIM_LOOKAHEAD = 32
+
+
+def _pack(text) -> bytes:
+    return zlib.compress(text.encode("utf-8"))
+
+
+def _unpack(data) -> str:
+    return zlib.decompress(data).decode("utf-8")
+
+
+@firestore.transactional
+def _claim(transaction, jobs_ref, worker_id, choose):
+    queued = {
+        job.id: job
+        for job in transaction.get(
+            jobs_ref.where(
+                filter=FieldFilter("status", "==", GRADING_QUEUE_STATUS_QUEUED)
+            ).limit(_CLAIM_LOOKAHEAD)
+        )
+    }
+    chosen = choose(
+        [
+            {
+                "job_id": job.id,
+                "affinity": job.get("affinity"),
+                "enqueued_at": job.get("enqueuedAt"),
+            }
+            for job in sorted(queued.values(), key=lambda job: job.id)
+        ]
+    )
+    if chosen is None:
+        return None
+
+    job = queued[chosen["job_id"]]
+    transaction.update(
+        job.reference,
+        {
+            "status": GRADING_QUEUE_STATUS_RUNNING,
+            "workerId": worker_id,
+            "attempts": job.get("attempts") + 1,
+            "heartbeatAt": time.time(),
+        },
+    )
+    return job.id, _unpack(job.get("payload"))
+
+
+@firestore.transactional
+def _update_running_job(transaction, job_ref, worker_id, fields):
+    # Updates the job with fields(job) if it's still running on worker_id (on
+    # anyone if worker_id is None), unless that returns None. Returns what it
+    # wrote, or None.
+    job = job_ref.get(transaction=transaction)
+    if not job.exists or job.get("status") != GRADING_QUEUE_STATUS_RUNNING:
+        return None
+    if worker_id is not None and job.get("workerId") != worker_id:
+        return None
+    update = fields(job)
+    if update is not None:
+        transaction.update(job_ref, update)
+    return update
+
+
+class FirestoreGradingQueue(GradingQueueBackend):
+    def __init__(self):
+        self._jobs = db.collection(GRADING_QUEUE_COLLECTION)
+        self._workers = db.collection(GRADING_WORKERS_COLLECTION)
+        self._stream_events = db.collection(GRADING_STREAM_EVENTS_COLLECTION)
+        self._stream_cancels = db.collection(GRADING_STREAM_CANCELS_COLLECTION)
+        # Which web process to hand results back to
+        self._collector = uuid.uuid4().hex
+        self._last_seq = 0
+        self._seq_lock = threading.Lock()
+
+    def enqueue(self, job_id, payload, affinity):
+        self._jobs.document(job_id).set(
+            {
+                "payload": _pack(payload),
+                "status": GRADING_QUEUE_STATUS_QUEUED,
+                "attempts": 0,
+                "workerId": None,
+                "affinity": affinity,
+                "enqueuedAt": time.time(),
+                "heartbeatAt": None,
+                "finishedAt": None,
+                "collector": self._collector,
+                "done": False,
+            }
+        )
+
+    def claim(self, worker_id, choose):
+        return _claim(db.transaction(), self._jobs, worker_id, choose)
+
+    def finish(self, job_id, worker_id, result, error):
+        update = _update_running_job(
+            db.transaction(),
+            self._jobs.document(job_id),
+            worker_id,
+            lambda job: {
+                "status": (
+                    GRADING_QUEUE_STATUS_FAILED
+                    if error is not None
+                    else GRADING_QUEUE_STATUS_FINISHED
+                ),
+                "result": None if result is None else _pack(result),
+                "error": error,
+                "finishedAt": time.time(),
+                # no longer running, see requeue_abandoned()
+                "heartbeatAt": None,
+                "payload": firestore.DELETE_FIELD,
+                "done": True,
+            },
+        )
+        return update is not None
+
+    def heartbeat(self, worker_id, hostname, slots):
+        now = time.time()
+        self._workers.document(worker_id).set(
+            {
+                "hostname": hostname,
+                "pid": os.getpid(),
+                "slots": slots,
+                "heartbeatAt": now,
+            }
+        )
+        for job in self._jobs.where(
+            filter=FieldFilter("workerId", "==", worker_id)
+        ).stream():
+            if job.get("status") == GRADING_QUEUE_STATUS_RUNNING:
+                _update_running_job(
+                    db.transaction(),
+                    job.reference,
+                    worker_id,
+                    lambda job: {"heartbeatAt": now},
+                )
+
+    def remove_worker(self, worker_id):
+        self._workers.document(worker_id).delete()
+
+    def live_workers(self, since):
+        return [
+            (worker.id, worker.get("slots"))
+            for worker in self._workers.where(
+                filter=FieldFilter("heartbeatAt", ">=", since)
+            ).stream()
+        ]
+
+    def requeue_abandoned(self, cutoff, max_attempts, failed_error, expired):
+        def requeue(job):
+            # It could have heartbeat since it was looked for
+            if job.get("heartbeatAt") >= cutoff:
+                return None
+            if job.get("attempts") >= max_attempts:
+                return {
+                    "status": GRADING_QUEUE_STATUS_FAILED,
+                    "error": failed_error,
+                    "finishedAt": time.time(),
+                    "heartbeatAt": None,
+                    "payload": firestore.DELETE_FIELD,
+                    "done": True,
+                }
+            return {
+                "status": GRADING_QUEUE_STATUS_QUEUED,
+                "workerId": None,
+                "heartbeatAt": None,
+            }
+
+        # Only running jobs have a heartbeat
+        requeued = failed = 0
+        for job in self._jobs.where(
+            filter=FieldFilter("heartbeatAt", "<", cutoff)
+        ).stream():
+            update = _update_running_job(db.transaction(), job.reference, None, requeue)
+            if update is None:
+                continue
+            if update["status"] == GRADING_QUEUE_STATUS_FAILED:
+                failed += 1
+            else:
+                requeued += 1
+
+        for collection, field, before in [
+            (self._workers, "heartbeatAt", cutoff),
+            (self._jobs, "finishedAt", expired),
+            (self._stream_events, "createdAt", expired),
+            (self._stream_cancels, "createdAt", expired),
+        ]:
+            for document in collection.where(
+                filter=FieldFilter(field, "<", before)
+            ).stream():
+                document.reference.delete()
+        return requeued, failed
+
+    def collect(self, job_ids):
+        waiting = set(job_ids)
+        finished = []
+        for job in (
+            self._jobs.where(filter=FieldFilter("collector", "==", self._collector))
+            .where(filter=FieldFilter("done", "==", True))
+            .stream()
+        ):
+            if job.id not in waiting:
+                continue
+            result = job.get("result")
+            finished.append(
+                (
+                    job.id,
+                    job.get("status"),
+                    None if result is None else _unpack(result),
+                    job.get("error"),
+                )
+            )
+            job.reference.delete()
+        return finished
+
+    def put_stream_event(self, stream_id, event):
+        # Events sort by their id, so seq has to go up even if the clock doesn't
+        with self._seq_lock:
+            self._last_seq = max(self._last_seq + 1, time.time_ns())
+            seq = self._last_seq
+        self._stream_events.document(f"{stream_id}-{seq:016x}").set(
+            {"streamId": stream_id, "event": _pack(event), "createdAt": time.time()}
+        )
+
+    def _first_stream_event(self, stream_id):
+        # Equality only, so in document id order
+        for event in (
+            self._stream_events.where(filter=FieldFilter("streamId", "==", stream_id))
+            .limit(1)
+            .stream()
+        ):
+            return event
+        return None
+
+    def take_stream_event(self, stream_id):
+        event = self._first_stream_event(stream_id)
+        if event is None:
+            return None
+        event.reference.delete()
+        return _unpack(event.get("event"))
+
+    def has_stream_event(self, stream_id):
+        return self._first_stream_event(stream_id) is not None
+
+    def cancel_stream(self, stream_id):
+        self._stream_cancels.document(stream_id).set({"createdAt": time.time()})
+
+    def is_stream_cancelled(self, stream_id):
+        return self._stream_cancels.document(stream_id).get().exists
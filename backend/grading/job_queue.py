@@ -0,0 +1,450 @@
+import collections
+import importlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from grading.affinity import AffinityRing
+
+# Grading normally runs on the web server's own worker pool (see worker_pool.py).
+# With a grading queue configured it runs on standalone grading workers instead,
+# started with
+#   IGIVE_GRADING_QUEUE=firestore python -m grading.worker
+# The web server puts jobs in the queue, a worker claims one, runs it on its own
+# pool and writes the result back, and the web server picks it up from there.
+# Workers can then be started and stopped without touching the web servers.
+
+# The queue is kept by one of two backends, both behind GradingQueueBackend:
+#   - IGIVE_GRADING_QUEUE=firestore keeps it in Firestore (firestore_queue.py),
+#     which the app already depends on. Web servers and workers can be on any
+#     number of machines, as long as they share the Firebase project.
+#   - IGIVE_GRADING_QUEUE_DB=/path/to/queue.db keeps it in a SQLite file
+#     (sqlite_queue.py). Everything has to be on the one machine, it's for local
+#     use and testing the workers.
+# Jobs are data, not code: a job is the name of one of GRADING_QUEUE_FUNCTIONS
+# and its arguments, as JSON, and results and stream events are JSON too. So
+# anyone who can write to the queue can at worst have a submission graded, not
+# run code of their choosing on the web servers and workers.
+
+GRADING_QUEUE_SQLITE = "sqlite"
+GRADING_QUEUE_FIRESTORE = "firestore"
+GRADING_QUEUE_DB = os.environ.get("IGIVE_GRADING_QUEUE_DB")
+# Which backend, None for no queue at all
+GRADING_QUEUE = os.environ.get(
+    "IGIVE_GRADING_QUEUE",
+    GRADING_QUEUE_SQLITE if GRADING_QUEUE_DB is not None else None,
+)
+
+# Workers heartbeat every GRADING_HEARTBEAT_SECONDS. A worker that misses
+# GRADING_WORKER_TIMEOUT_SECONDS worth has died, its jobs go back in the queue for
+# someone else, up to GRADING_MAX_ATTEMPTS runs per job.
+GRADING_HEARTBEAT_SECONDS = float(os.environ.get("IGIVE_GRADING_HEARTBEAT_SECONDS", 5))
+GRADING_WORKER_TIMEOUT_SECONDS = float(
+    os.environ.get("IGIVE_GRADING_WORKER_TIMEOUT_SECONDS", 30)
+)
+GRADING_MAX_ATTEMPTS = int(os.environ.get("IGIVE_GRADING_MAX_ATTEMPTS", 3))
+# How often the web server looks for finished jobs and workers look for new ones.
+# Every look is a read for Firestore to bill, so it looks less often.
+GRADING_QUEUE_POLL_SECONDS = float(
+    os.environ.get(
+        "IGIVE_GRADING_QUEUE_POLL_SECONDS",
+        1 if GRADING_QUEUE == GRADING_QUEUE_FIRESTORE else 0.2,
+    )
+)
+# Jobs carry an affinity key, their course and task, and a worker takes the jobs
+# whose tasks live on it (see affinity.py) first. It only takes another home's job
+# once that home has more than GRADING_AFFINITY_SPILL_JOBS_PER_SLOT jobs queued
+# per slot, or the job has waited GRADING_AFFINITY_MAX_WAIT_SECONDS, so a busy
+# task spills over onto the rest of the fleet rather than queueing up.
+GRADING_AFFINITY_WORKERS = int(os.environ.get("IGIVE_GRADING_AFFINITY_WORKERS", 2))
+GRADING_AFFINITY_SPILL_JOBS_PER_SLOT = float(
+    os.environ.get("IGIVE_GRADING_AFFINITY_SPILL_JOBS_PER_SLOT", 2)
+)
+GRADING_AFFINITY_MAX_WAIT_SECONDS = float(
+    os.environ.get("IGIVE_GRADING_AFFINITY_MAX_WAIT_SECONDS", 10)
+)
+# Results nobody collected (the web server that queued them restarted) and
+# leftovers of streams are thrown out after this long
+GRADING_QUEUE_RETENTION_SECONDS = 60 * 60
+
+# What a queued job may run, as module.function
+GRADING_QUEUE_FUNCTIONS = {
+    "blueprints.testing.run_testing",
+    "blueprints.testing.run_testing_streamed",
+    "blueprints.testing.automark_submission",
+    "blueprints.testing.calibrate_suite",
+}
+
+GRADING_QUEUE_STATUS_QUEUED = "queued"
+GRADING_QUEUE_STATUS_RUNNING = "running"
+GRADING_QUEUE_STATUS_FINISHED = "finished"
+GRADING_QUEUE_STATUS_FAILED = "failed"
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# job_id -> Future of the jobs this web process queued and is waiting on
+_pending = {}
+_pending_lock = threading.Lock()
+_poller = None
+
+# (checked_at, [(worker_id, slots)], AffinityRing) of the live workers
+_live_workers = (float("-inf"), [], None)
+_live_workers_lock = threading.Lock()
+
+
+class GradingQueueBackend:
+    """
+    Where the grading queue is kept. Payloads, results and stream events are JSON
+    text by the time they get here, and job ids sort in the order the jobs were
+    queued. Every method can be called from any process on any machine sharing
+    the queue.
+    """
+
+    def enqueue(self, job_id, payload, affinity):
+        """
+        Adds a queued job.
+        """
+        raise NotImplementedError
+
+    def claim(self, worker_id, choose):
+        """
+        Atomically makes one of the oldest queued jobs worker_id's and running.
+        choose(jobs) picks which from a list of dictionaries with "job_id",
+        "affinity" and "enqueued_at", oldest first, or returns None for none of
+        them. Returns (job_id, payload) or None.
+        """
+        raise NotImplementedError
+
+    def finish(self, job_id, worker_id, result, error) -> bool:
+        """
+        Records what a job returned, or error if it raised. Returns False (and
+        records nothing) if it isn't a running job of worker_id's.
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id, hostname, slots):
+        """
+        Records worker_id as alive with slots slots, along with its running jobs.
+        """
+        raise NotImplementedError
+
+    def remove_worker(self, worker_id):
+        raise NotImplementedError
+
+    def live_workers(self, since) -> list:
+        """
+        Returns (worker_id, slots) of every worker that heartbeat since then.
+        """
+        raise NotImplementedError
+
+    def requeue_abandoned(self, cutoff, max_attempts, failed_error, expired):
+        """
+        Requeues running jobs that last heartbeat before cutoff, or fails them with
+        failed_error if they've had max_attempts runs already, and forgets workers
+        that did. Throws out results and streams older than expired. Returns how
+        many jobs were (requeued, failed).
+        """
+        raise NotImplementedError
+
+    def collect(self, job_ids) -> list:
+        """
+        Returns (job_id, status, result, error) of the jobs among job_ids that have
+        finished or failed, and takes them out of the queue.
+        """
+        raise NotImplementedError
+
+    def put_stream_event(self, stream_id, event):
+        raise NotImplementedError
+
+    def take_stream_event(self, stream_id):
+        """
+        Returns the stream's oldest event and takes it off, or None if there is
+        none.
+        """
+        raise NotImplementedError
+
+    def has_stream_event(self, stream_id) -> bool:
+        raise NotImplementedError
+
+    def cancel_stream(self, stream_id):
+        raise NotImplementedError
+
+    def is_stream_cancelled(self, stream_id) -> bool:
+        raise NotImplementedError
+
+
+def get_grading_queue() -> GradingQueueBackend:
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            # Imported here, the Firestore one needs Firebase credentials
+            if GRADING_QUEUE == GRADING_QUEUE_SQLITE:
+                from grading.sqlite_queue import SqliteGradingQueue
+
+                _backend = SqliteGradingQueue(GRADING_QUEUE_DB)
+            elif GRADING_QUEUE == GRADING_QUEUE_FIRESTORE:
+                from grading.firestore_queue import FirestoreGradingQueue
+
+                _backend = FirestoreGradingQueue()
+            else:
+                raise ValueError(f"There's no grading queue called {GRADING_QUEUE}")
+        return _backend
+
+
+def _to_json(value) -> str:
+    def shared_stream(value):
+        # The only things in a job that aren't plain data
+        if isinstance(value, SharedProgressQueue):
+            return {"__grading_stream__": "progress_queue", "stream_id": value.stream_id}
+        if isinstance(value, SharedCancelEvent):
+            return {"__grading_stream__": "cancel_event", "stream_id": value.stream_id}
+        raise TypeError(f"{type(value).__name__} can't go in the grading queue")
+
+    return json.dumps(value, default=shared_stream)
+
+
+def _from_json(text):
+    def shared_stream(value):
+        kind = value.get("__grading_stream__")
+        if kind == "progress_queue":
+            return SharedProgressQueue(value["stream_id"])
+        if kind == "cancel_event":
+            return SharedCancelEvent(value["stream_id"])
+        return value
+
+    return json.loads(text, object_hook=shared_stream)
+
+
+def run_queued_job(payload):
+    # Decoded on the grading worker's pool rather than in the worker itself, so
+    # the worker process never has to import the web app
+    job = _from_json(payload)
+    if job["function"] not in GRADING_QUEUE_FUNCTIONS:
+        raise ValueError(f"{job['function']} can't be run from the grading queue")
+    module_name, function_name = job["function"].rsplit(".", 1)
+    fn = getattr(importlib.import_module(module_name), function_name)
+    return fn(*job["args"])
+
+
+def grading_affinity(course_code, task) -> str:
+    """
+    The affinity key of jobs grading a task, see affinity.py.
+    """
+    return f"{course_code}/{task}"
+
+
+def enqueue_grading_job(fn, *args, affinity=None) -> str:
+    """
+    Queues fn(*args) for a grading worker, preferably one where affinity (see
+    grading_affinity()) lives. fn must be one of GRADING_QUEUE_FUNCTIONS, and its
+    arguments (and what it returns) plain JSON data. Tuples come back as lists.
+    Returns the job id.
+    """
+    function = f"{fn.__module__}.{fn.__name__}"
+    if function not in GRADING_QUEUE_FUNCTIONS:
+        raise ValueError(f"{function} can't be run from the grading queue")
+    # Fixed width hex, so ids sort by when they were queued
+    job_id = f"{time.time_ns():016x}-{uuid.uuid4().hex}"
+    get_grading_queue().enqueue(
+        job_id, _to_json({"function": function, "args": args}), affinity
+    )
+    return job_id
+
+
+def _get_live_workers():
+    # Looked at on every claim, but workers only come and go every heartbeat or so
+    global _live_workers
+    with _live_workers_lock:
+        checked_at, workers, ring = _live_workers
+        if time.monotonic() - checked_at >= GRADING_HEARTBEAT_SECONDS:
+            workers = get_grading_queue().live_workers(
+                time.time() - GRADING_WORKER_TIMEOUT_SECONDS
+            )
+            ring = AffinityRing(workers, GRADING_AFFINITY_WORKERS)
+            _live_workers = (time.monotonic(), workers, ring)
+        return workers, ring
+
+
+def _choose_job(worker_id, jobs, ring):
+    # jobs are the oldest queued ones, oldest first
+    homes = [ring.home(job["affinity"]) for job in jobs]
+    for job, home in zip(jobs, homes):
+        if not home or worker_id in home:
+            return job
+
+    backlog = collections.Counter(homes)
+    now = time.time()
+    for job, home in zip(jobs, homes):
+        if (
+            backlog[home] > GRADING_AFFINITY_SPILL_JOBS_PER_SLOT * ring.slots(home)
+            or now - job["enqueued_at"] >= GRADING_AFFINITY_MAX_WAIT_SECONDS
+        ):
+            return job
+    return None
+
+
+def claim_grading_job(worker_id):
+    """
+    Atomically takes the oldest queued job that lives on worker_id, or failing that
+    the oldest one that should spill over to it. Returns (job_id, payload), payload
+    being what run_queued_job() takes, or None if there's nothing for it.
+    """
+    _, ring = _get_live_workers()
+    return get_grading_queue().claim(
+        worker_id, lambda jobs: _choose_job(worker_id, jobs, ring)
+    )
+
+
+def finish_grading_job(job_id, worker_id, result=None, error=None) -> bool:
+    """
+    Records what a job returned, or error if it raised. Returns False if the job
+    isn't worker_id's anymore (it was given away after missed heartbeats), the
+    result is dropped then.
+    """
+    return get_grading_queue().finish(
+        job_id, worker_id, None if error is not None else _to_json(result), error
+    )
+
+
+def heartbeat_grading_worker(worker_id, hostname, slots):
+    """
+    Tells everyone worker_id is alive and can run slots jobs at once, and keeps
+    the jobs it's running its own.
+    """
+    get_grading_queue().heartbeat(worker_id, hostname, slots)
+
+
+def remove_grading_worker(worker_id):
+    get_grading_queue().remove_worker(worker_id)
+
+
+def requeue_abandoned_jobs():
+    """
+    Puts the jobs of workers that stopped heartbeating back in the queue, or fails
+    them if they've been tried GRADING_MAX_ATTEMPTS times already (a job that
+    keeps taking its worker down with it shouldn't take the whole fleet down).
+    Also throws out whatever has been lying around for too long.
+    """
+    now = time.time()
+    requeued, failed = get_grading_queue().requeue_abandoned(
+        now - GRADING_WORKER_TIMEOUT_SECONDS,
+        GRADING_MAX_ATTEMPTS,
+        f"the grading worker died {GRADING_MAX_ATTEMPTS} times running it",
+        now - GRADING_QUEUE_RETENTION_SECONDS,
+    )
+    if failed or requeued:
+        logging.error(
+            f"Grading workers went missing, requeued {requeued} jobs and gave up on {failed}"
+        )
+
+
+def get_grading_fleet_slots() -> int:
+    """
+    How many jobs the live grading workers can run at once between them.
+    """
+    try:
+        workers, _ = _get_live_workers()
+    except Exception as e:
+        logging.error(f"Couldn't count grading workers: {str(e)}")
+        workers = _live_workers[1]
+    return sum(slots for _, slots in workers)
+
+
+def submit_to_grading_queue(fn, *args, affinity=None) -> Future:
+    """
+    Like worker_pool.submit_to_grading_workers(), but the job runs on whichever
+    grading worker claims it, see claim_grading_job().
+    """
+    global _poller
+    future = Future()
+    future.set_running_or_notify_cancel()
+    job_id = enqueue_grading_job(fn, *args, affinity=affinity)
+    with _pending_lock:
+        _pending[job_id] = future
+        if _poller is None:
+            _poller = threading.Thread(
+                target=_collect_results_forever, name="grading-queue", daemon=True
+            )
+            _poller.start()
+    return future
+
+
+def _collect_results_forever():
+    last_requeue = 0
+    while True:
+        time.sleep(GRADING_QUEUE_POLL_SECONDS)
+        try:
+            _collect_results()
+            # Workers do this too, but if every worker is dead somebody else has to
+            if time.monotonic() - last_requeue > GRADING_HEARTBEAT_SECONDS:
+                last_requeue = time.monotonic()
+                requeue_abandoned_jobs()
+        except Exception as e:
+            logging.error(f"Error collecting grading results: {str(e)}", exc_info=True)
+
+
+def _collect_results():
+    with _pending_lock:
+        job_ids = list(_pending.keys())
+    if not job_ids:
+        return
+    for job_id, status, result, error in get_grading_queue().collect(job_ids):
+        with _pending_lock:
+            future = _pending.pop(job_id)
+        if status == GRADING_QUEUE_STATUS_FAILED:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(_from_json(result))
+
+
+class SharedProgressQueue:
+    """
+    Stands in for the manager queue of worker_pool.create_grading_stream() when
+    the grading worker is a standalone one. Only put(), get() and empty() are
+    supported, and only one reader.
+    """
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+
+    def put(self, item):
+        get_grading_queue().put_stream_event(self.stream_id, _to_json(item))
+
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            event = get_grading_queue().take_stream_event(self.stream_id)
+            if event is not None:
+                return _from_json(event)
+            if time.monotonic() >= deadline:
+                raise queue.Empty
+            time.sleep(min(GRADING_QUEUE_POLL_SECONDS, timeout))
+
+    def empty(self) -> bool:
+        return not get_grading_queue().has_stream_event(self.stream_id)
+
+
+class SharedCancelEvent:
+    """
+    Stands in for the manager event of worker_pool.create_grading_stream(), see
+    SharedProgressQueue.
+    """
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+
+    def set(self):
+        get_grading_queue().cancel_stream(self.stream_id)
+
+    def is_set(self) -> bool:
+        return get_grading_queue().is_stream_cancelled(self.stream_id)
+
+
+def create_shared_grading_stream():
+    stream_id = uuid.uuid4().hex
+    return SharedProgressQueue(stream_id), SharedCancelEvent(stream_id)
@@ -0,0 +1,42 @@
+import os
+import sqlite3
+import threading
+
+# A small SQLite database on the grading machine for state that has to survive a
+# server restart but doesn't belong in Firestore (job journals, statistics...).
+# Every module that keeps state in here creates its own tables on first use.
+
+# SQLite connections can't be shared between threads, so each thread gets its own.
+# WAL mode lets readers carry on while a worker process is writing. It needs
+# memory shared between every process using the file, so databases other
+# programs might open from elsewhere are left in SQLite's default journal mode.
+GRADING_DB_PATH = os.environ.get(
+    "IGIVE_GRADING_DB",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "grading.db"
+    ),
+)
+
+_thread_local = threading.local()
+
+
+def get_connection(path=None, wal=True) -> sqlite3.Connection:
+    """
+    This thread's connection to the database at path, GRADING_DB_PATH by default.
+    wal must be the same for every connection to the same database.
+    """
+    path = path or GRADING_DB_PATH
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if wal:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        else:
+            connection.execute("PRAGMA journal_mode=DELETE")
+        connections[path] = connection
+    return connection
@@ -0,0 +1,161 @@
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import subprocess
+from firebase import bucket
+
+# What the runner actually printed for every automark test case of a submission,
+# kept in storage next to the test suite. Judging a test is just comparing that
+# output against the expected one under the task's tolerance filters, so with the
+# output kept a test can be judged again (new filters, a fixed expected output)
+# without running the student's code again, e.g. by a what-if regrade.
+
+# Only automark outputs are kept. Autotests are on the student's critical path,
+# and loading and uploading a blob on every run cost them more than re-judging
+# ever saved (the result cache already covers re-running the exact same thing).
+
+# One gzipped JSON blob per submitted code, at
+#   {course}/{task}/outputs/automark/{submission digest}.json.gz
+# looking like
+#   {"tests": {"test_3": {"execution_hash": ..., "returncode": 0, "usage": {...},
+#                         "output_limit_exceeded": false,
+#                         "stdout": base64, "stderr": base64}, ...}}
+# Identical submissions share the blob, like they share the result cache.
+
+# A stored output is only used while the test would still be run the exact same
+# way, see execution_hash(). Tests that printed more than RAW_OUTPUT_LIMIT_BYTES
+# (per stream) aren't kept, and a submission keeps no more than
+# RAW_OUTPUTS_TOTAL_LIMIT_BYTES of outputs (as stored, i.e. base64) in all. Tests
+# that don't fit just have to run again to be judged.
+RAW_OUTPUT_LIMIT_BYTES = int(os.environ.get("IGIVE_RAW_OUTPUT_LIMIT_KB", 64)) * 1024
+RAW_OUTPUTS_TOTAL_LIMIT_BYTES = (
+    int(os.environ.get("IGIVE_RAW_OUTPUTS_TOTAL_LIMIT_KB", 2048)) * 1024
+)
+raw_outputs_feature_enable = True
+
+
+def submission_digest(submission_blobs):
+    """
+    Identifies the submitted code by its file names and md5s. Returns None if some
+    file has no md5, outputs of submissions like that aren't kept.
+    """
+    if any(blob.md5_hash is None for blob in submission_blobs):
+        return None
+    digest = hashlib.sha256()
+    for name, md5_hash in sorted(
+        (blob.name.split("/")[-1], blob.md5_hash) for blob in submission_blobs
+    ):
+        digest.update(f"{name}\0{md5_hash}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def raw_outputs_path(course_code, task, digest) -> str:
+    return f"{course_code}/{task}/outputs/automark/{digest}.json.gz"
+
+
+def execution_hash(fixtures, suite_path, test_case_dir, parameters):
+    """
+    Everything that decides what the runner prints for a test case: the runner,
+    the build step, the input and the limits it runs with. The expected output and
+    the tolerance filters are deliberately left out, they only matter to judging.
+    """
+    identity = hashlib.sha256()
+    for blob_name in [
+        suite_path + "run.sh",
+        suite_path + "build.sh",
+        test_case_dir + "in",
+    ]:
+        blob = fixtures.get(blob_name)
+        md5_hash = None if blob is None else blob.md5_hash
+        identity.update(f"{blob_name[len(suite_path):]}\0{md5_hash}\0".encode("utf-8"))
+    limits = [
+        parameters.get(name)
+        for name in [
+            "runner_args",
+            "cpu_time",
+            "memory_megabytes",
+            "output_limit_bytes",
+        ]
+    ]
+    identity.update(json.dumps(limits).encode("utf-8"))
+    return identity.hexdigest()
+
+
+def load_raw_outputs(path) -> dict:
+    """
+    Returns the stored outputs at path as test case folder name -> record, empty if
+    there are none (or they can't be read, they're only ever an optimisation).
+    """
+    if not raw_outputs_feature_enable:
+        return {}
+    try:
+        blob = bucket.get_blob(path)
+        if blob is None:
+            return {}
+        return json.loads(gzip.decompress(blob.download_as_bytes()))["tests"]
+    except Exception as e:
+        logging.error(f"Couldn't load stored outputs {path}: {e}")
+        return {}
+
+
+def store_raw_outputs(path, tests):
+    if not raw_outputs_feature_enable or not tests:
+        return
+    # Whatever fits in RAW_OUTPUTS_TOTAL_LIMIT_BYTES, in test order
+    kept_tests = {}
+    size = 0
+    for name in sorted(tests):
+        if size + raw_output_size(tests[name]) <= RAW_OUTPUTS_TOTAL_LIMIT_BYTES:
+            kept_tests[name] = tests[name]
+            size += raw_output_size(tests[name])
+    tests = kept_tests
+    try:
+        data = gzip.compress(json.dumps({"tests": tests}).encode("utf-8"))
+        bucket.blob(path).upload_from_string(data, content_type="application/gzip")
+    except Exception as e:
+        # the next run will just have to execute these again
+        logging.error(f"Couldn't store outputs {path}: {e}")
+
+
+def make_raw_output(execution, runner_result, usage):
+    """
+    The record kept for one run of a test case, or None if it printed too much to
+    be worth keeping.
+    """
+    if (
+        len(runner_result.stdout) > RAW_OUTPUT_LIMIT_BYTES
+        or len(runner_result.stderr) > RAW_OUTPUT_LIMIT_BYTES
+    ):
+        return None
+    return {
+        "execution_hash": execution,
+        "returncode": runner_result.returncode,
+        "usage": usage,
+        "output_limit_exceeded": runner_result.output_limit_exceeded,
+        "stdout": base64.b64encode(runner_result.stdout).decode("ascii"),
+        "stderr": base64.b64encode(runner_result.stderr).decode("ascii"),
+    }
+
+
+def raw_output_size(record) -> int:
+    """
+    How much of RAW_OUTPUTS_TOTAL_LIMIT_BYTES a record takes up.
+    """
+    return len(record["stdout"]) + len(record["stderr"])
+
+
+def stored_runner_result(record) -> subprocess.CompletedProcess:
+    """
+    Turns a stored record back into what run_sandboxed() returned for that run.
+    """
+    runner_result = subprocess.CompletedProcess(
+        None,
+        record["returncode"],
+        base64.b64decode(record["stdout"]),
+        base64.b64decode(record["stderr"]),
+    )
+    runner_result.output_limit_exceeded = record["output_limit_exceeded"]
+    return runner_result
@@ -0,0 +1,56 @@
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Where grading sandboxes (the student's code, the runner and a folder per test
+# case) live. Dozens of them get created and thrown away every second when a
+# cohort is being marked, so point IGIVE_SANDBOX_ROOT at a tmpfs, e.g. one
+# mounted with
+#   mount -t tmpfs -o size=2g,mode=1777 tmpfs /srv/igive-sandboxes
+# or docker run --tmpfs /srv/igive-sandboxes:size=2g ... The size= is the quota,
+# a submission that fills it up only fails its own tests.
+SANDBOX_ROOT = os.environ.get("IGIVE_SANDBOX_ROOT", tempfile.gettempdir())
+# If the sandbox root is (nearly) full, new sandboxes go in the normal temp
+# directory instead of failing
+SANDBOX_MIN_FREE_BYTES = (
+    int(os.environ.get("IGIVE_SANDBOX_MIN_FREE_MB", 64)) * 1024 * 1024
+)
+
+# Removing a sandbox is a lot of unlinks, it's done here rather than making
+# whoever is waiting on the results wait for it too. Pending removals still
+# finish when the process exits, the executor's threads are joined then.
+_teardown_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="sandbox-teardown"
+)
+
+
+def _sandbox_root() -> str:
+    try:
+        os.makedirs(SANDBOX_ROOT, exist_ok=True)
+        stats = os.statvfs(SANDBOX_ROOT)
+        if stats.f_bavail * stats.f_frsize >= SANDBOX_MIN_FREE_BYTES:
+            return SANDBOX_ROOT
+        logging.error(f"Sandbox root {SANDBOX_ROOT} is full, using the temp directory")
+    except OSError as e:
+        logging.error(f"Can't use sandbox root {SANDBOX_ROOT}: {e}")
+    return tempfile.gettempdir()
+
+
+def remove_sandbox_later(path):
+    _teardown_executor.submit(shutil.rmtree, path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def sandbox_directory():
+    """
+    Like tempfile.TemporaryDirectory(), but under SANDBOX_ROOT and removed in the
+    background once the with block is done with it.
+    """
+    path = tempfile.mkdtemp(prefix="igive-sandbox-", dir=_sandbox_root())
+    try:
+        yield path
+    finally:
+        remove_sandbox_later(path)
@@ -0,0 +1,179 @@
+import json
+import os
+import resource
+import select
+import signal
+import sys
+import time
+
+# A sandbox helper: a tiny single threaded process that starts test runners on
+# behalf of a grading worker. See sandbox_pool.py for why.
+
+# Only uses the standard library and is run as a script, it must start quickly
+# and stay small so that forking it stays cheap.
+
+# Protocol, one JSON object per line over stdin/stdout:
+#   request:  {"argv": [...], "cwd": "...", "stdout_path": "...", "stderr_path": "...",
+#              "timeout": seconds,
+#              "rlimits": {"RLIMIT_DATA": soft_limit, "RLIMIT_CPU": [soft, hard], ...}}
+#   response: {"returncode": int (-signal if killed), "timed_out": bool,
+#              "rusage": {"utime": s, "stime": s, "maxrss_kb": kb,
+#                         "wall_seconds": s from the fork to reaping the runner}}
+#          or {"error": "..."} if the runner couldn't be started at all.
+
+# The peak memory wait4() reports for the runner can't be less than what the
+# forked copy of this helper had resident when it exec'd it, Linux carries that
+# over the exec. Starting the runner with vfork or posix_spawn doesn't help, the
+# child then has the helper's own memory when it execs. So the child measures its
+# peak just before the exec, and a reported peak that isn't more than that (plus
+# _EXEC_SLACK_KB for what the exec itself touches) is the helper's, not the
+# runner's: it's reported as 0, the runner used too little to tell. A peak over
+# it is the runner's own, the kernel takes the larger of the two, not the sum.
+_EXEC_SLACK_KB = 1024
+
+
+def peak_rss_kb() -> int:
+    # VmHWM, the most of this process that has ever been resident
+    with open("/proc/self/status", "rb") as status:
+        for line in status:
+            if line.startswith(b"VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def exec_runner(descriptor, baseline_fd):
+    # Runs in the forked child, never returns. Writes its peak_rss_kb() to
+    # baseline_fd just before the exec.
+    try:
+        # own process group, so a timeout takes out everything run.sh started too
+        os.setsid()
+        for name, value in descriptor.get("rlimits", {}).items():
+            limit = getattr(resource, name)
+            soft, hard = resource.getrlimit(limit)
+            # either just a soft limit, or [soft, hard] to lower the hard one too
+            if isinstance(value, list):
+                soft_limit, new_hard = value
+                if hard == resource.RLIM_INFINITY or new_hard < hard:
+                    hard = new_hard
+            else:
+                soft_limit = value
+            if hard != resource.RLIM_INFINITY:
+                soft_limit = min(soft_limit, hard)
+            resource.setrlimit(limit, (soft_limit, hard))
+
+        os.chdir(descriptor["cwd"])
+        stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        stdout_fd = os.open(descriptor["stdout_path"], os.O_WRONLY | os.O_CREAT, 0o600)
+        stderr_fd = os.open(descriptor["stderr_path"], os.O_WRONLY | os.O_CREAT, 0o600)
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        try:
+            os.write(baseline_fd, str(peak_rss_kb()).encode("ascii"))
+        except (OSError, ValueError):
+            pass
+        # the helper's own stdin/stdout are the pipes to the grading worker, don't
+        # let the runner inherit them (nor baseline_fd)
+        os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+
+        # Python ignores these two, and ignored signals survive exec. A runner that
+        # hits RLIMIT_FSIZE has to die from SIGXFSZ, not carry on getting EFBIG.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+        os.execvp(descriptor["argv"][0], descriptor["argv"])
+    except BaseException as e:
+        try:
+            os.write(2, f"Couldn't start the runner: {e}\n".encode("utf-8"))
+        finally:
+            os._exit(127)
+
+
+def wait_for_runner(pid, timeout):
+    """
+    Waits up to timeout seconds for the runner, killing its whole process group if
+    it takes longer. Returns (wait status, rusage, timed_out).
+    """
+    deadline = time.monotonic() + timeout
+    pidfd = os.pidfd_open(pid) if hasattr(os, "pidfd_open") else None
+    try:
+        while True:
+            waited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+            if waited_pid == pid:
+                return status, rusage, False
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if pidfd is not None:
+                select.select([pidfd], [], [], remaining)
+            else:
+                time.sleep(min(remaining, 0.005))
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # it hasn't even got to setsid() yet
+        os.kill(pid, signal.SIGKILL)
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage, True
+
+
+def handle(descriptor) -> dict:
+    baseline_read, baseline_write = os.pipe()
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os.close(baseline_read)
+        exec_runner(descriptor, baseline_write)
+
+    # Empty if the child failed before it got that far
+    os.close(baseline_write)
+    try:
+        baseline_kb = int(os.read(baseline_read, 32) or 0)
+    finally:
+        os.close(baseline_read)
+
+    status, rusage, timed_out = wait_for_runner(pid, descriptor["timeout"])
+    wall_seconds = time.monotonic() - started
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+
+    # Anything the runner left running in its group goes too
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    return {
+        "returncode": returncode,
+        "timed_out": timed_out,
+        "rusage": {
+            "utime": rusage.ru_utime,
+            "stime": rusage.ru_stime,
+            "maxrss_kb": (
+                rusage.ru_maxrss
+                if rusage.ru_maxrss > baseline_kb + _EXEC_SLACK_KB
+                else 0
+            ),
+            "wall_seconds": wall_seconds,
+        },
+    }
+
+
+def main():
+    for line in sys.stdin:
+        try:
+            response = handle(json.loads(line))
+        except Exception as e:
+            response = {"error": str(e)}
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
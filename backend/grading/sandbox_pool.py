@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+from grading.worker_pool import GRADING_WORKER_CPUS
+
+# Starting a test runner straight from a grading worker is slow: the worker is a
+# big process full of threads and gRPC connections, and subprocess can only use
+# the fast vfork/posix_spawn path when there's no preexec_fn, which we need for
+# the resource limits. So every test paid for a full fork of the worker.
+
+# Instead each grading worker keeps a few sandbox helpers (sandbox_helper.py)
+# running. A helper is a tiny single threaded Python process started once; it
+# forks itself (cheap, it's small), applies the test's rlimits in the child and
+# execs the runner, then waits for it and hands back the exit status and rusage.
+# Output goes to files rather than pipes, the worker reads them afterwards.
+
+# How many helpers a grading worker starts with. By default the worker's share of
+# the CPUs, like its test parallelism. A run that runs more of its test cases at
+# once (a course's testParallelism) gets more, see allow_sandbox_helpers(), and
+# extra concurrent tests past that wait for a free helper.
+SANDBOX_HELPERS = int(os.environ.get("IGIVE_SANDBOX_HELPERS", GRADING_WORKER_CPUS))
+
+_HELPER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sandbox_helper.py"
+)
+
+_idle_helpers = queue.LifoQueue()
+_helpers_started = 0
+_helper_limit = SANDBOX_HELPERS
+_helpers_lock = threading.Lock()
+
+
+class SandboxHelperError(Exception):
+    pass
+
+
+def _start_helper() -> subprocess.Popen:
+    # -S skips site-packages, the helper only needs the standard library
+    return subprocess.Popen(
+        [sys.executable, "-S", _HELPER_SCRIPT],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        close_fds=True,
+        text=True,
+    )
+
+
+def start_sandbox_helpers():
+    """
+    Starts all the helpers up front so that the first tests don't pay for it.
+    Used as the grading workers' initializer.
+    """
+    global _helpers_started
+    with _helpers_lock:
+        while _helpers_started < SANDBOX_HELPERS:
+            _idle_helpers.put(_start_helper())
+            _helpers_started += 1
+
+
+def allow_sandbox_helpers(count):
+    """
+    Lets this worker run at least count helpers at once, for a run about to run
+    count test cases in parallel. Helpers started for it are kept for later runs.
+    """
+    global _helper_limit
+    with _helpers_lock:
+        _helper_limit = max(_helper_limit, count)
+
+
+def _take_helper() -> subprocess.Popen:
+    global _helpers_started
+    try:
+        return _idle_helpers.get_nowait()
+    except queue.Empty:
+        pass
+
+    while True:
+        with _helpers_lock:
+            if _helpers_started < _helper_limit:
+                _helpers_started += 1
+                return _start_helper()
+        # all busy, wait for one to be handed back (or discarded, hence the timeout)
+        try:
+            return _idle_helpers.get(timeout=1)
+        except queue.Empty:
+            pass
+
+
+def _discard_helper(helper):
+    global _helpers_started
+    helper.kill()
+    helper.wait()
+    with _helpers_lock:
+        _helpers_started -= 1
+
+
+def _ask_helper(helper, descriptor) -> dict:
+    helper.stdin.write(json.dumps(descriptor) + "\n")
+    helper.stdin.flush()
+    response = helper.stdout.readline()
+    if not response:
+        raise SandboxHelperError("sandbox helper exited")
+    return json.loads(response)
+
+
+def run_sandboxed(
+    argv, cwd, timeout, rlimits, output_limit=None, output_dir=None
+) -> subprocess.CompletedProcess:
+    """
+    Drop in for subprocess.run(argv, stdout=PIPE, stderr=PIPE, cwd=cwd,
+    timeout=timeout) that also applies rlimits ({"RLIMIT_DATA": soft_limit,
+    "RLIMIT_CPU": [soft_limit, hard_limit], ...}) to the runner. Raises
+    subprocess.TimeoutExpired like subprocess.run() does, the runner and
+    everything it started are killed first. The CompletedProcess
+    (and the TimeoutExpired) also has an "rusage" attribute, the runner's
+    {"utime", "stime", "maxrss_kb", "wall_seconds"}. wall_seconds is how long the
+    runner itself took, not counting waiting for a helper. maxrss_kb is 0 if the runner never had more
+    resident than the helper that started it, see sandbox_helper.py.
+
+    If output_limit is given, at most that many bytes (plus one, to tell it went
+    over) of stdout and stderr are read back. The CompletedProcess then has
+    "output_limit_exceeded" set if either was longer. Set RLIMIT_FSIZE as well to
+    actually stop the runner writing, otherwise it just fills up the disk.
+
+    stdout and stderr go through files in output_dir (the temp directory by
+    default), which should be the sandbox the runner is in so they land on the
+    same filesystem as everything else it writes.
+    """
+    stdout_fd, stdout_path = tempfile.mkstemp(prefix="igive-stdout-", dir=output_dir)
+    stderr_fd, stderr_path = tempfile.mkstemp(prefix="igive-stderr-", dir=output_dir)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+    descriptor = {
+        "argv": argv,
+        "cwd": cwd,
+        "stdout_path": stdout_path,
+        "stderr_path": stderr_path,
+        "timeout": timeout,
+        "rlimits": rlimits,
+    }
+    try:
+        # A broken helper (killed by the OOM killer?) is replaced and the test
+        # retried once, so a runner that keeps killing its helper just fails.
+        for attempt in range(2):
+            helper = _take_helper()
+            try:
+                response = _ask_helper(helper, descriptor)
+                _idle_helpers.put(helper)
+                break
+            except (OSError, ValueError, SandboxHelperError) as e:
+                logging.error(f"Sandbox helper failed: {e}")
+                _discard_helper(helper)
+                if attempt == 1:
+                    raise
+
+        if "error" in response:
+            raise SandboxHelperError(response["error"])
+
+        # Never pull more into memory than we were told to
+        read_size = -1 if output_limit is None else output_limit + 1
+        with open(stdout_path, "rb") as stdout_handle:
+            stdout = stdout_handle.read(read_size)
+        with open(stderr_path, "rb") as stderr_handle:
+            stderr = stderr_handle.read(read_size)
+    finally:
+        os.unlink(stdout_path)
+        os.unlink(stderr_path)
+
+    if response["timed_out"]:
+        timeout_error = subprocess.TimeoutExpired(
+            argv, timeout, output=stdout, stderr=stderr
+        )
+        timeout_error.rusage = response["rusage"]
+        raise timeout_error
+
+    completed = subprocess.CompletedProcess(
+        argv, response["returncode"], stdout, stderr
+    )
+    completed.rusage = response["rusage"]
+    completed.output_limit_exceeded = output_limit is not None and (
+        len(stdout) > output_limit or len(stderr) > output_limit
+    )
+    return completed
@@ -0,0 +1,248 @@
+import collections
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+# The grading workers used to be fed first come first served, so an admin's
+# cohort automark (or one student hammering /run_autotest) queued in front of
+# everybody else. Jobs now wait here instead, and are only handed to the worker
+# pool when a worker is free:
+#   - every job is in a lane: interactive (someone is waiting on the result),
+#     batch (cohort automarks), speculative (autotests nobody asked for yet) or
+#     calibration. Lanes with work share the workers
+#     by weight, stride scheduling style, so a busy lane can't starve the others
+#     and an idle lane doesn't bank up credit while it's idle.
+#   - the non interactive lanes never take the last few workers, so a student's
+#     autotest doesn't have to wait behind a worker's worth of cohort marking.
+#   - within a lane jobs are taken round robin by owner, so somebody with five
+#     jobs queued gets one run per turn like everyone else.
+#   - an owner can only have so many jobs queued or running in a lane at once.
+#   - a lane only queues so many jobs. Past that new jobs are turned away with an
+#     estimate of when to come back, worked out from how long the lane's jobs have
+#     been taking, rather than every job queued getting slower and slower.
+
+# How much each finished job moves a lane's average service time
+_SERVICE_TIME_SMOOTHING = 0.2
+
+
+class GradingQueueFullError(Exception):
+    """
+    A job was turned away. retry_after_seconds is roughly how long until it would
+    be accepted.
+    """
+
+    def __init__(self, message, retry_after_seconds):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class GradingScheduler:
+    """
+    Queues grading jobs by lane and owner and hands them to
+    dispatch(fn, *args, affinity=affinity), which must return a Future, no more than capacity at a time. capacity can be a
+    function, for a number of workers that changes. max_queued_per_lane is either
+    one limit for every lane or a dictionary of lane -> limit.
+    """
+
+    def __init__(
+        self,
+        dispatch,
+        capacity,
+        lane_weights,
+        interactive_lane,
+        interactive_reserved,
+        max_outstanding_per_owner,
+        max_queued_per_lane,
+        initial_service_seconds,
+    ):
+        self._dispatch = dispatch
+        self._get_capacity = capacity if callable(capacity) else lambda: capacity
+        # how often to look at the capacity again while nothing can run
+        self._capacity_poll_seconds = 1 if callable(capacity) else None
+        self._lane_weights = lane_weights
+        self._interactive_lane = interactive_lane
+        self._interactive_reserved = max(interactive_reserved, 0)
+        self._max_outstanding_per_owner = max_outstanding_per_owner
+        if not isinstance(max_queued_per_lane, dict):
+            max_queued_per_lane = {lane: max_queued_per_lane for lane in lane_weights}
+        self._max_queued_per_lane = max_queued_per_lane
+
+        self._condition = threading.Condition()
+        # lane -> owner -> deque of (future, fn, args, affinity), owners in round robin order
+        self._queues = {lane: collections.OrderedDict() for lane in lane_weights}
+        # stride scheduling, the lane with the lowest pass goes next
+        self._passes = {lane: 0.0 for lane in lane_weights}
+        self._virtual_time = 0.0
+        self._running = {lane: 0 for lane in lane_weights}
+        # (lane, owner) -> jobs queued or running
+        self._outstanding = collections.Counter()
+        self._queued = {lane: 0 for lane in lane_weights}
+        # moving average of how long a job of each lane keeps a worker busy
+        self._service_seconds = {lane: initial_service_seconds for lane in lane_weights}
+        self._dispatcher = None
+
+    def schedule(
+        self, fn, *args, lane, owner, affinity=None, admission_control=True
+    ) -> Future:
+        """
+        Queues fn(*args) and returns a Future for its result. Cancelling the Future
+        before the job has started drops it from the queue. Raises
+        GradingQueueFullError if owner already has too many jobs in the lane or the
+        lane's queue is full, unless admission_control is False.
+        """
+        future = Future()
+        with self._condition:
+            if admission_control:
+                if self._outstanding[(lane, owner)] >= self._max_outstanding_per_owner:
+                    raise GradingQueueFullError(
+                        f"You already have {self._max_outstanding_per_owner} jobs "
+                        "being graded, wait for one of them to finish.",
+                        self._estimate_wait(lane),
+                    )
+                if self._queued[lane] >= self._max_queued_per_lane[lane]:
+                    raise GradingQueueFullError(
+                        "The grading servers are busy, try again later.",
+                        self._estimate_wait(lane),
+                    )
+
+            lane_queue = self._queues[lane]
+            if not lane_queue:
+                self._passes[lane] = max(self._passes[lane], self._virtual_time)
+            lane_queue.setdefault(owner, collections.deque()).append(
+                (future, fn, args, affinity)
+            )
+            self._outstanding[(lane, owner)] += 1
+            self._queued[lane] += 1
+
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch_forever,
+                    name="grading-scheduler",
+                    daemon=True,
+                )
+                self._dispatcher.start()
+            self._condition.notify()
+        return future
+
+    def _estimate_wait(self, lane) -> float:
+        # Roughly how long a job queued in lane now would wait before it starts.
+        # The lane gets its weighted share of whichever workers it may use, and
+        # everything already queued in it goes first
+        busy_weight = sum(
+            weight
+            for other_lane, weight in self._lane_weights.items()
+            if other_lane == lane or self._queues[other_lane]
+        )
+        capacity = self._get_capacity()
+        workers = capacity
+        if lane != self._interactive_lane:
+            workers -= self._reserved(capacity)
+        # With no workers at all, assume one will turn up
+        share = max(workers, 1) * self._lane_weights[lane] / busy_weight
+        if self._queued[lane] == 0 and sum(self._running.values()) < capacity:
+            return 0.0
+        return (self._queued[lane] + 1) * self._service_seconds[lane] / share
+
+    def _reserved(self, capacity) -> int:
+        # Never reserve every worker, the other lanes would never run at all
+        return max(min(self._interactive_reserved, capacity - 1), 0)
+
+    def _can_run(self, lane, capacity) -> bool:
+        running = sum(self._running.values())
+        if running >= capacity:
+            return False
+        if lane == self._interactive_lane:
+            return True
+        return running - self._running[
+            self._interactive_lane
+        ] < capacity - self._reserved(capacity)
+
+    def _next_job(self):
+        # Called with the condition held. Returns (lane, owner, future, fn, args,
+        # affinity) or None if nothing can run right now.
+        capacity = self._get_capacity()
+        while True:
+            lanes = [
+                lane
+                for lane, lane_queue in self._queues.items()
+                if lane_queue and self._can_run(lane, capacity)
+            ]
+            if not lanes:
+                return None
+
+            # ties go to the lane listed first, i.e. interactive
+            lane = min(lanes, key=lambda lane: self._passes[lane])
+            self._virtual_time = self._passes[lane]
+            self._passes[lane] += 1 / self._lane_weights[lane]
+
+            lane_queue = self._queues[lane]
+            owner, jobs = next(iter(lane_queue.items()))
+            future, fn, args, affinity = jobs.popleft()
+            self._queued[lane] -= 1
+            if jobs:
+                lane_queue.move_to_end(owner)
+            else:
+                del lane_queue[owner]
+
+            if not future.set_running_or_notify_cancel():
+                # Cancelled while it was waiting, e.g. a stream whose client left
+                self._release(lane, owner, running=False)
+                continue
+
+            self._running[lane] += 1
+            return lane, owner, future, fn, args, affinity
+
+    def _release(self, lane, owner, running):
+        if running:
+            self._running[lane] -= 1
+        self._outstanding[(lane, owner)] -= 1
+        if self._outstanding[(lane, owner)] <= 0:
+            del self._outstanding[(lane, owner)]
+        self._condition.notify()
+
+    def _finished(self, lane, owner, started_at):
+        with self._condition:
+            self._release(lane, owner, running=True)
+            self._service_seconds[lane] += _SERVICE_TIME_SMOOTHING * (
+                time.monotonic() - started_at - self._service_seconds[lane]
+            )
+
+    def _dispatch_forever(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait(self._capacity_poll_seconds)
+                    job = self._next_job()
+            lane, owner, future, fn, args, affinity = job
+
+            started_at = time.monotonic()
+            try:
+                worker_future = self._dispatch(fn, *args, affinity=affinity)
+            except Exception as e:
+                logging.error(f"Couldn't start grading job: {str(e)}", exc_info=True)
+                future.set_exception(e)
+                self._finished(lane, owner, started_at)
+                continue
+
+            worker_future.add_done_callback(
+                functools.partial(
+                    self._copy_result,
+                    future=future,
+                    lane=lane,
+                    owner=owner,
+                    started_at=started_at,
+                )
+            )
+
+    def _copy_result(self, worker_future, future, lane, owner, started_at):
+        # The slot is given back first, whoever is waiting on the result might
+        # well submit the next job straight away
+        self._finished(lane, owner, started_at)
+        exception = worker_future.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(worker_future.result())
@@ -0,0 +1,266 @@
+import os
+import sqlite3
+import time
+from grading.job_queue import (
+    GRADING_QUEUE_STATUS_FAILED,
+    GRADING_QUEUE_STATUS_FINISHED,
+    GRADING_QUEUE_STATUS_QUEUED,
+    GRADING_QUEUE_STATUS_RUNNING,
+    GradingQueueBackend,
+)
+from grading.local_db import get_connection
+
+# The grading queue in a SQLite file, see job_queue.py. A single host stand-in
+# (and what the workers are tested against): every web server and worker has to
+# be on the same machine, SQLite's locking doesn't hold up on network
+# filesystems, so the file must not be put on a shared volume to reach workers
+# elsewhere. Use the Firestore queue (firestore_queue.py) for that.
+
+# How far down the queue a worker looks for jobs of its own
+_CLAIM_LOOKAHEAD = 256
+
+
+class SqliteGradingQueue(GradingQueueBackend):
+    def __init__(self, path):
+        self._path = path
+        self._schema_created = False
+
+    def _db(self):
+        connection = get_connection(self._path, wal=False)
+        if not self._schema_created:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS grading_queue (
+                    job_id TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id TEXT,
+                    affinity TEXT,
+                    enqueued_at REAL NOT NULL,
+                    heartbeat_at REAL,
+                    finished_at REAL,
+                    result BLOB,
+                    error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS grading_queue_by_status
+                    ON grading_queue (status, enqueued_at);
+                CREATE TABLE IF NOT EXISTS grading_workers (
+                    worker_id TEXT PRIMARY KEY,
+                    hostname TEXT,
+                    pid INTEGER,
+                    slots INTEGER NOT NULL,
+                    heartbeat_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS grading_stream_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    stream_id TEXT NOT NULL,
+                    event BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS grading_stream_events_by_stream
+                    ON grading_stream_events (stream_id, seq);
+                CREATE TABLE IF NOT EXISTS grading_stream_cancels (
+                    stream_id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL
+                );
+                """)
+            try:
+                # Queues made before jobs had an affinity
+                connection.execute(
+                    "ALTER TABLE grading_queue ADD COLUMN affinity TEXT"
+                )
+            except sqlite3.OperationalError:
+                pass
+            self._schema_created = True
+        return connection
+
+    def enqueue(self, job_id, payload, affinity):
+        self._db().execute(
+            "INSERT INTO grading_queue (job_id, payload, status, affinity, enqueued_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, payload, GRADING_QUEUE_STATUS_QUEUED, affinity, time.time()),
+        )
+
+    def claim(self, worker_id, choose):
+        connection = self._db()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            jobs = connection.execute(
+                "SELECT job_id, affinity, enqueued_at FROM grading_queue WHERE status = ? ORDER BY enqueued_at LIMIT ?",
+                (GRADING_QUEUE_STATUS_QUEUED, _CLAIM_LOOKAHEAD),
+            ).fetchall()
+            job = choose([dict(job) for job in jobs])
+            if job is None:
+                return None
+            payload = connection.execute(
+                "SELECT payload FROM grading_queue WHERE job_id = ?", (job["job_id"],)
+            ).fetchone()["payload"]
+            connection.execute(
+                """
+                UPDATE grading_queue
+                SET status = ?, worker_id = ?, attempts = attempts + 1, heartbeat_at = ?
+                WHERE job_id = ?
+                """,
+                (GRADING_QUEUE_STATUS_RUNNING, worker_id, time.time(), job["job_id"]),
+            )
+        return job["job_id"], payload
+
+    def finish(self, job_id, worker_id, result, error):
+        cursor = self._db().execute(
+            """
+            UPDATE grading_queue
+            SET status = ?, result = ?, error = ?, finished_at = ?, payload = ''
+            WHERE job_id = ? AND worker_id = ? AND status = ?
+            """,
+            (
+                (
+                    GRADING_QUEUE_STATUS_FAILED
+                    if error is not None
+                    else GRADING_QUEUE_STATUS_FINISHED
+                ),
+                result,
+                error,
+                time.time(),
+                job_id,
+                worker_id,
+                GRADING_QUEUE_STATUS_RUNNING,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, worker_id, hostname, slots):
+        connection = self._db()
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute(
+                "INSERT OR REPLACE INTO grading_workers VALUES (?, ?, ?, ?, ?)",
+                (worker_id, hostname, os.getpid(), slots, now),
+            )
+            connection.execute(
+                "UPDATE grading_queue SET heartbeat_at = ? WHERE worker_id = ? AND status = ?",
+                (now, worker_id, GRADING_QUEUE_STATUS_RUNNING),
+            )
+
+    def remove_worker(self, worker_id):
+        self._db().execute(
+            "DELETE FROM grading_workers WHERE worker_id = ?", (worker_id,)
+        )
+
+    def live_workers(self, since):
+        return [
+            (worker["worker_id"], worker["slots"])
+            for worker in self._db().execute(
+                "SELECT worker_id, slots FROM grading_workers WHERE heartbeat_at >= ?",
+                (since,),
+            )
+        ]
+
+    def requeue_abandoned(self, cutoff, max_attempts, failed_error, expired):
+        connection = self._db()
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            failed = connection.execute(
+                """
+                UPDATE grading_queue
+                SET status = ?, error = ?, finished_at = ?, payload = ''
+                WHERE status = ? AND heartbeat_at < ? AND attempts >= ?
+                """,
+                (
+                    GRADING_QUEUE_STATUS_FAILED,
+                    failed_error,
+                    now,
+                    GRADING_QUEUE_STATUS_RUNNING,
+                    cutoff,
+                    max_attempts,
+                ),
+            ).rowcount
+            requeued = connection.execute(
+                """
+                UPDATE grading_queue SET status = ?, worker_id = NULL, heartbeat_at = NULL
+                WHERE status = ? AND heartbeat_at < ?
+                """,
+                (GRADING_QUEUE_STATUS_QUEUED, GRADING_QUEUE_STATUS_RUNNING, cutoff),
+            ).rowcount
+            connection.execute(
+                "DELETE FROM grading_workers WHERE heartbeat_at < ?", (cutoff,)
+            )
+
+            connection.execute(
+                "DELETE FROM grading_queue WHERE status IN (?, ?) AND finished_at < ?",
+                (GRADING_QUEUE_STATUS_FINISHED, GRADING_QUEUE_STATUS_FAILED, expired),
+            )
+            connection.execute(
+                "DELETE FROM grading_stream_events WHERE created_at < ?", (expired,)
+            )
+            connection.execute(
+                "DELETE FROM grading_stream_cancels WHERE created_at < ?", (expired,)
+            )
+        return requeued, failed
+
+    def collect(self, job_ids):
+        connection = self._db()
+        finished = []
+        # SQLite limits how many parameters a statement can have
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start : start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            jobs = connection.execute(
+                f"SELECT job_id, status, result, error FROM grading_queue WHERE job_id IN ({placeholders}) AND status IN (?, ?)",
+                (*chunk, GRADING_QUEUE_STATUS_FINISHED, GRADING_QUEUE_STATUS_FAILED),
+            ).fetchall()
+            for job in jobs:
+                connection.execute(
+                    "DELETE FROM grading_queue WHERE job_id = ?", (job["job_id"],)
+                )
+                finished.append(
+                    (job["job_id"], job["status"], job["result"], job["error"])
+                )
+        return finished
+
+    def put_stream_event(self, stream_id, event):
+        self._db().execute(
+            "INSERT INTO grading_stream_events (stream_id, event, created_at) VALUES (?, ?, ?)",
+            (stream_id, event, time.time()),
+        )
+
+    def take_stream_event(self, stream_id):
+        connection = self._db()
+        event = connection.execute(
+            "SELECT seq, event FROM grading_stream_events WHERE stream_id = ? ORDER BY seq LIMIT 1",
+            (stream_id,),
+        ).fetchone()
+        if event is None:
+            return None
+        connection.execute(
+            "DELETE FROM grading_stream_events WHERE seq = ?", (event["seq"],)
+        )
+        return event["event"]
+
+    def has_stream_event(self, stream_id):
+        return (
+            self._db()
+            .execute(
+                "SELECT 1 FROM grading_stream_events WHERE stream_id = ? LIMIT 1",
+                (stream_id,),
+            )
+            .fetchone()
+            is not None
+        )
+
+    def cancel_stream(self, stream_id):
+        self._db().execute(
+            "INSERT OR IGNORE INTO grading_stream_cancels VALUES (?, ?)",
+            (stream_id, time.time()),
+        )
+
+    def is_stream_cancelled(self, stream_id):
+        return (
+            self._db()
+            .execute(
+                "SELECT 1 FROM grading_stream_cancels WHERE stream_id = ?",
+                (stream_id,),
+            )
+            .fetchone()
+            is not None
+        )
@@ -0,0 +1,129 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import tarfile
+from cache.fixture_cache import read_fixture
+from firebase import bucket
+
+# Submissions are stored file by file under {course}/{task}/{zid}/{timestamp}/,
+# which is what students and tutors browse and download. Every submission is also
+# packed into a single archive, a tar.gz with a manifest.json in front, at
+#   {course}/{task}/archives/{zid}/{timestamp}.tar.gz
+# so that grading and exports fetch a whole submission in one request. The
+# manifest has every file's name, size and md5 (in Cloud Storage's format, so an
+# archived file is identified exactly like its blob).
+
+# Submissions made before archives existed (or whose archive couldn't be written)
+# just don't have one, everything falls back to the individual files.
+SUBMISSION_ARCHIVE_FORMAT = 1
+submission_archives_feature_enable = True
+
+_MANIFEST_NAME = "manifest.json"
+
+
+class ArchivedFile:
+    """
+    A file of a submission archive, standing in for its blob. Has the same name
+    and md5_hash as the blob, the fixture cache reads it through open_local().
+    """
+
+    def __init__(self, name, md5_hash, data):
+        self.name = name
+        self.md5_hash = md5_hash
+        self.size = len(data)
+        self.generation = None
+        self._data = data
+
+    def open_local(self):
+        return io.BytesIO(self._data)
+
+
+def submission_archive_path(course_code, task, zid, submission_timestamp) -> str:
+    return f"{course_code}/{task}/archives/{zid}/{submission_timestamp}.tar.gz"
+
+
+def store_submission_archive(course_code, task, zid, submission_timestamp, files):
+    """
+    Packs files, a list of (file name, contents), into the submission's archive.
+    """
+    manifest = {
+        "format": SUBMISSION_ARCHIVE_FORMAT,
+        "files": {
+            file_name: {
+                "md5_hash": base64.b64encode(hashlib.md5(data).digest()).decode(
+                    "utf-8"
+                ),
+                "size": len(data),
+            }
+            for file_name, data in files
+        },
+    }
+    archive_bytes = io.BytesIO()
+    with tarfile.open(fileobj=archive_bytes, mode="w:gz") as archive:
+        for file_name, data in [
+            (_MANIFEST_NAME, json.dumps(manifest).encode("utf-8")),
+            *files,
+        ]:
+            member = tarfile.TarInfo(file_name)
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+
+    bucket.blob(
+        submission_archive_path(course_code, task, zid, submission_timestamp)
+    ).upload_from_string(archive_bytes.getvalue(), content_type="application/gzip")
+
+
+def read_submission_archive(archive_blob):
+    """
+    Returns the archive's manifest and its files as {file name: contents}.
+    """
+    # Through the fixture cache, the same submission gets graded over and over
+    with tarfile.open(
+        fileobj=io.BytesIO(read_fixture(archive_blob)), mode="r:gz"
+    ) as archive:
+        manifest = json.loads(archive.extractfile(_MANIFEST_NAME).read())
+        if manifest["format"] != SUBMISSION_ARCHIVE_FORMAT:
+            raise ValueError(f"unknown archive format {manifest['format']}")
+        contents = {
+            file_name: archive.extractfile(file_name).read()
+            for file_name in manifest["files"]
+        }
+    return manifest, contents
+
+
+def load_submission_files(course_code, task, zid, submission_timestamp) -> list:
+    """
+    Returns every file of a submission as a blob (or ArchivedFile), from its
+    archive if it has one. Empty if there is no such submission.
+    """
+    submission_path = f"{course_code}/{task}/{zid}/{submission_timestamp}/"
+    if submission_archives_feature_enable:
+        archive_path = submission_archive_path(
+            course_code, task, zid, submission_timestamp
+        )
+        try:
+            archive_blob = bucket.get_blob(archive_path)
+            if archive_blob is not None:
+                manifest, contents = read_submission_archive(archive_blob)
+                return [
+                    ArchivedFile(
+                        submission_path + file_name,
+                        manifest["files"][file_name]["md5_hash"],
+                        data,
+                    )
+                    for file_name, data in contents.items()
+                ]
+        except Exception as e:
+            logging.error(f"Couldn't read submission archive {archive_path}: {e}")
+
+    return list(bucket.list_blobs(prefix=submission_path))
+
+
+def submission_exists(course_code, task, zid, submission_timestamp) -> bool:
+    archive_path = submission_archive_path(course_code, task, zid, submission_timestamp)
+    if submission_archives_feature_enable and bucket.get_blob(archive_path) is not None:
+        return True
+    submission_path = f"{course_code}/{task}/{zid}/{submission_timestamp}/"
+    return any(True for _ in bucket.list_blobs(prefix=submission_path))
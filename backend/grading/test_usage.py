@@ -0,0 +1,127 @@
+import time
+from grading.job_queue import GRADING_QUEUE, GRADING_QUEUE_DB, GRADING_QUEUE_SQLITE
+from grading.local_db import get_connection
+
+# Resource usage of every test case across everyone's runs, keyed by its storage
+# directory (e.g. "COMP1511/lab01/scripts/autotest/test_3/"). Lets admins see which
+# tests are slow or close to their limits, and orders "cheapest first" runs.
+# With a SQLite grading queue (see job_queue.py) the tests run on the standalone
+# grading workers, so it lives in the queue's database where the web server sees
+# it too. With the Firestore queue every machine keeps its own, so the web
+# server's usage view only covers what it ran itself.
+
+# Weight of the newest run in the moving average of wall time used for ordering
+RUNTIME_SMOOTHING = 0.2
+
+_schema_created = False
+
+
+def _db():
+    global _schema_created
+    if GRADING_QUEUE == GRADING_QUEUE_SQLITE:
+        connection = get_connection(GRADING_QUEUE_DB, wal=False)
+    else:
+        connection = get_connection()
+    if not _schema_created:
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS test_usage (
+                test_case_dir TEXT PRIMARY KEY,
+                runs INTEGER NOT NULL,
+                recent_wall_seconds REAL NOT NULL,
+                total_wall_seconds REAL NOT NULL,
+                max_wall_seconds REAL NOT NULL,
+                total_cpu_seconds REAL NOT NULL,
+                max_cpu_seconds REAL NOT NULL,
+                total_peak_rss_kb INTEGER NOT NULL,
+                max_peak_rss_kb INTEGER NOT NULL,
+                last_run_at REAL NOT NULL
+            )
+            """)
+        _schema_created = True
+    return connection
+
+
+def record_test_usage(test_case_dir, usage):
+    """
+    Adds one run's usage (a test result's "usage" dictionary) to the test's totals.
+    """
+    wall_seconds = usage["wall_seconds"]
+    cpu_seconds = usage["user_cpu_seconds"] + usage["system_cpu_seconds"]
+    peak_rss_kb = usage["peak_rss_kb"]
+    _db().execute(
+        """
+        INSERT INTO test_usage VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (test_case_dir) DO UPDATE SET
+            runs = runs + 1,
+            recent_wall_seconds = recent_wall_seconds * ? + excluded.total_wall_seconds * ?,
+            total_wall_seconds = total_wall_seconds + excluded.total_wall_seconds,
+            max_wall_seconds = MAX(max_wall_seconds, excluded.max_wall_seconds),
+            total_cpu_seconds = total_cpu_seconds + excluded.total_cpu_seconds,
+            max_cpu_seconds = MAX(max_cpu_seconds, excluded.max_cpu_seconds),
+            total_peak_rss_kb = total_peak_rss_kb + excluded.total_peak_rss_kb,
+            max_peak_rss_kb = MAX(max_peak_rss_kb, excluded.max_peak_rss_kb),
+            last_run_at = excluded.last_run_at
+        """,
+        (
+            test_case_dir,
+            wall_seconds,
+            wall_seconds,
+            wall_seconds,
+            cpu_seconds,
+            cpu_seconds,
+            peak_rss_kb,
+            peak_rss_kb,
+            time.time(),
+            1 - RUNTIME_SMOOTHING,
+            RUNTIME_SMOOTHING,
+        ),
+    )
+
+
+def get_test_runtimes(test_case_dirs) -> dict:
+    """
+    Returns test_case_dir -> recent average wall seconds for the test cases we've
+    seen before.
+    """
+    test_case_dirs = list(test_case_dirs)
+    if len(test_case_dirs) == 0:
+        return {}
+
+    placeholders = ", ".join("?" for _ in test_case_dirs)
+    rows = (
+        _db()
+        .execute(
+            f"SELECT test_case_dir, recent_wall_seconds FROM test_usage WHERE test_case_dir IN ({placeholders})",
+            test_case_dirs,
+        )
+        .fetchall()
+    )
+    return {row["test_case_dir"]: row["recent_wall_seconds"] for row in rows}
+
+
+def get_test_usage_stats(suite_path) -> dict:
+    """
+    Returns test_case_dir -> aggregated usage for every test case under suite_path
+    (e.g. "COMP1511/lab01/scripts/autotest/") that has ever run.
+    """
+    rows = (
+        _db()
+        .execute(
+            "SELECT * FROM test_usage WHERE substr(test_case_dir, 1, ?) = ?",
+            (len(suite_path), suite_path),
+        )
+        .fetchall()
+    )
+    return {
+        row["test_case_dir"]: {
+            "runs": row["runs"],
+            "mean_wall_seconds": row["total_wall_seconds"] / row["runs"],
+            "max_wall_seconds": row["max_wall_seconds"],
+            "mean_cpu_seconds": row["total_cpu_seconds"] / row["runs"],
+            "max_cpu_seconds": row["max_cpu_seconds"],
+            "mean_peak_rss_kb": row["total_peak_rss_kb"] / row["runs"],
+            "max_peak_rss_kb": row["max_peak_rss_kb"],
+            "last_run_at": row["last_run_at"],
+        }
+        for row in rows
+    }
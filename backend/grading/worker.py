@@ -0,0 +1,106 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import uuid
+from grading.job_queue import (
+    GRADING_HEARTBEAT_SECONDS,
+    GRADING_QUEUE,
+    GRADING_QUEUE_POLL_SECONDS,
+    claim_grading_job,
+    finish_grading_job,
+    heartbeat_grading_worker,
+    remove_grading_worker,
+    requeue_abandoned_jobs,
+    run_queued_job,
+)
+from grading.worker_pool import GRADING_WORKERS, submit_to_grading_workers
+
+# A standalone grading worker, see job_queue.py. Run as many as needed with
+#   IGIVE_GRADING_QUEUE=firestore python -m grading.worker
+# from the backend folder, with the same Firebase credentials as the web server,
+# on any machine. With a SQLite queue (IGIVE_GRADING_QUEUE_DB=/path/to/queue.db)
+# they have to be on the same machine as it.
+# It runs up to IGIVE_GRADING_WORKERS jobs at once on its own worker pool.
+# SIGTERM (or Ctrl-C) stops it claiming jobs, it exits once the ones it has are done.
+
+
+def run_grading_worker(slots=GRADING_WORKERS):
+    hostname = socket.gethostname()
+    worker_id = f"{hostname}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    free_slots = threading.BoundedSemaphore(slots)
+    stopping = threading.Event()
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        logging.warning(f"Grading worker {worker_id} finishing its jobs and stopping")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def heartbeat():
+        # Carries on while the last jobs are finishing, or they'd be given away
+        while not stopped.wait(GRADING_HEARTBEAT_SECONDS):
+            try:
+                heartbeat_grading_worker(worker_id, hostname, slots)
+                requeue_abandoned_jobs()
+            except Exception as e:
+                logging.error(f"Grading worker heartbeat failed: {str(e)}")
+
+    heartbeat_grading_worker(worker_id, hostname, slots)
+    threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+    logging.warning(f"Grading worker {worker_id} started with {slots} slots")
+
+    def job_done(job_id, future):
+        try:
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                logging.error(f"Grading job {job_id} failed: {str(e)}", exc_info=True)
+                result, error = None, str(e)
+            if not finish_grading_job(job_id, worker_id, result=result, error=error):
+                logging.error(f"Grading job {job_id} was given away before it finished")
+        except Exception as e:
+            logging.error(f"Couldn't record grading job {job_id}: {str(e)}")
+        finally:
+            free_slots.release()
+
+    while not stopping.is_set():
+        if not free_slots.acquire(timeout=GRADING_QUEUE_POLL_SECONDS):
+            continue
+        try:
+            job = claim_grading_job(worker_id)
+        except Exception as e:
+            logging.error(f"Couldn't claim a grading job: {str(e)}")
+            job = None
+        if job is None:
+            free_slots.release()
+            stopping.wait(GRADING_QUEUE_POLL_SECONDS)
+            continue
+
+        job_id, payload = job
+        try:
+            future = submit_to_grading_workers(run_queued_job, payload)
+        except Exception as e:
+            logging.error(f"Couldn't start grading job {job_id}: {str(e)}")
+            finish_grading_job(job_id, worker_id, error=str(e))
+            free_slots.release()
+            continue
+        future.add_done_callback(lambda future, job_id=job_id: job_done(job_id, future))
+
+    # Wait for every slot to come back, i.e. every job to be recorded
+    for _ in range(slots):
+        free_slots.acquire()
+    stopped.set()
+    remove_grading_worker(worker_id)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    if GRADING_QUEUE is None:
+        raise SystemExit(
+            "Set IGIVE_GRADING_QUEUE=firestore or IGIVE_GRADING_QUEUE_DB to the grading queue"
+        )
+    run_grading_worker()
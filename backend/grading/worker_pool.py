@@ -0,0 +1,458 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from google.cloud.firestore_v1.base_query import FieldFilter
+from grading.job_queue import (
+    GRADING_QUEUE,
+    create_shared_grading_stream,
+    get_grading_fleet_slots,
+    grading_affinity,
+    submit_to_grading_queue,
+)
+from grading.scheduler import GradingScheduler
+
+# Grading runs student code for as long as their CPU time limits allow. Doing that
+# inline would hold a Flask request thread for the whole run, so a burst of slow
+# submissions could make every other endpoint unresponsive. Instead grading is
+# dispatched to a pool of dedicated worker processes, and the HTTP layer gets a
+# job id back which it waits on, or if the client asked for it, waits on for a
+# bounded time and then hands to the client to poll.
+# With a grading queue configured the pool is replaced by standalone grading
+# worker processes, see job_queue.py.
+
+# How many submissions can be graded at once, separately from how many requests
+# the web workers can serve.
+GRADING_WORKERS = int(os.environ.get("IGIVE_GRADING_WORKERS", os.cpu_count() or 1))
+# Each worker runs a submission's test cases in parallel as well (see
+# run_testing() and sandbox_pool.py), so by default it gets an equal share of the
+# CPUs for them. Giving every worker all of them would have up to cpu_count²
+# student programs running at once.
+GRADING_WORKER_CPUS = max(1, (os.cpu_count() or 1) // max(GRADING_WORKERS, 1))
+# The most a client may ask a grading endpoint to wait for its job before handing
+# back a job id. Clients that don't ask wait for the results, as they always have.
+GRADING_MAX_WAIT_SECONDS = float(os.environ.get("IGIVE_GRADING_MAX_WAIT_SECONDS", 300))
+# Finished jobs are forgotten after this long, clients must have polled by then
+GRADING_JOB_RETENTION_SECONDS = 60 * 60
+# A job runs in the web process that submitted it (or waits on a grading queue
+# there), but its id can be polled through any of them. So once a job id has
+# been handed out to poll, the job and later its outcome are recorded in
+# Firestore as well, see share_grading_job(). A record still running after this
+# long belonged to a web process that died, and is dropped.
+GRADING_SHARED_JOBS_COLLECTION = "gradingJobs"
+GRADING_SHARED_JOB_MAX_RUNNING_SECONDS = 24 * 60 * 60
+# How often a web process checks on a job running in another one
+GRADING_SHARED_JOB_POLL_SECONDS = 1
+
+# Jobs are queued in front of the workers by lane, see scheduler.py. Lanes with
+# work waiting get workers in proportion to their weights.
+GRADING_LANE_INTERACTIVE = "interactive"
+GRADING_LANE_BATCH = "batch"
+# autotests started on upload before anyone asked for them
+GRADING_LANE_SPECULATIVE = "speculative"
+GRADING_LANE_CALIBRATION = "calibration"
+GRADING_LANE_WEIGHTS = {
+    GRADING_LANE_INTERACTIVE: int(
+        os.environ.get("IGIVE_GRADING_INTERACTIVE_WEIGHT", 6)
+    ),
+    GRADING_LANE_BATCH: int(os.environ.get("IGIVE_GRADING_BATCH_WEIGHT", 3)),
+    GRADING_LANE_SPECULATIVE: int(
+        os.environ.get("IGIVE_GRADING_SPECULATIVE_WEIGHT", 2)
+    ),
+    GRADING_LANE_CALIBRATION: int(
+        os.environ.get("IGIVE_GRADING_CALIBRATION_WEIGHT", 1)
+    ),
+}
+# Workers only the interactive lane may use, so autotests still start promptly
+# while a cohort is being automarked
+GRADING_INTERACTIVE_RESERVED_WORKERS = int(
+    os.environ.get("IGIVE_GRADING_INTERACTIVE_RESERVED_WORKERS", GRADING_WORKERS // 4)
+)
+# How many jobs one user can have queued or running in a lane at once
+GRADING_MAX_OUTSTANDING_PER_ZID = int(
+    os.environ.get("IGIVE_GRADING_MAX_OUTSTANDING_PER_ZID", 2)
+)
+# How many jobs a lane queues before turning new ones away with a 429. Once the
+# queue is that long a new job would wait so long the client may as well come
+# back later, and every request sitting in it is a web worker thread tied up.
+GRADING_MAX_QUEUED_PER_LANE = int(
+    os.environ.get("IGIVE_GRADING_MAX_QUEUED_PER_LANE", GRADING_WORKERS * 8)
+)
+# Except the batch lane. The batch automark dialog sends a /run_automark per
+# student all at once, so a whole cohort has to fit. It is still bounded, and the
+# requests beyond it are told when to come back like any other.
+GRADING_MAX_QUEUED_BATCH = int(
+    os.environ.get(
+        "IGIVE_GRADING_MAX_QUEUED_BATCH", max(GRADING_MAX_QUEUED_PER_LANE, 2000)
+    )
+)
+# What the wait estimate for a 429 assumes a job takes until one has been timed
+GRADING_INITIAL_SERVICE_SECONDS = float(
+    os.environ.get("IGIVE_GRADING_INITIAL_SERVICE_SECONDS", 5)
+)
+
+GRADING_JOB_STATUS_RUNNING = "running"
+GRADING_JOB_STATUS_FINISHED = "finished"
+GRADING_JOB_STATUS_FAILED = "failed"
+
+_executor = None
+_executor_lock = threading.Lock()
+_manager = None
+_scheduler = None
+
+# job_id -> job dictionary, only jobs submitted through this web process are
+# known, the ones submitted elsewhere are looked up in Firestore
+_jobs = {}
+_jobs_lock = threading.Lock()
+_shared_jobs_expired_at = 0
+
+
+def get_grading_executor() -> ProcessPoolExecutor:
+    # Created on first use so that importing this module (e.g. in the Flask
+    # reloader's parent process) doesn't start any workers. The workers are
+    # spawned rather than forked, forking a process with live gRPC connections to
+    # Firestore is asking for trouble. (sandbox_pool.py sizes itself from this
+    # module, hence importing it here.)
+    from grading.sandbox_pool import start_sandbox_helpers
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=GRADING_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=start_sandbox_helpers,
+            )
+        return _executor
+
+
+def create_grading_stream():
+    """
+    Returns a (progress_queue, cancel_event) pair that can be passed to a grading
+    worker, so it can report results while it's still running and be told to stop.
+    """
+    # A standalone grading worker can't reach our manager
+    if GRADING_QUEUE is not None:
+        return create_shared_grading_stream()
+
+    # Plain multiprocessing queues can't be passed through a ProcessPoolExecutor,
+    # the manager's proxies can.
+    global _manager
+    with _executor_lock:
+        if _manager is None:
+            _manager = multiprocessing.get_context("spawn").Manager()
+        return _manager.Queue(), _manager.Event()
+
+
+def submit_to_grading_workers(fn, *args, affinity=None):
+    """
+    Runs fn(*args) on a grading worker and returns its Future. affinity is only
+    for the grading queue, every worker here shares the same caches anyway.
+    """
+    global _executor
+    try:
+        return get_grading_executor().submit(fn, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. the OOM killer got it), the pool is no good anymore
+        logging.error("Grading worker pool is broken, starting a new one")
+        with _executor_lock:
+            _executor = None
+        return get_grading_executor().submit(fn, *args)
+
+
+def schedule_grading(fn, *args, lane, owner, affinity=None, admission_control=True):
+    """
+    Queues fn(*args) for a grading worker in the given lane, taking turns with
+    owner's other jobs. Returns its Future. Raises GradingQueueFullError if owner
+    already has GRADING_MAX_OUTSTANDING_PER_ZID jobs in the lane or the lane
+    already has GRADING_MAX_QUEUED_PER_LANE (GRADING_MAX_QUEUED_BATCH for the
+    batch lane) jobs waiting, unless admission_control is False. Jobs with the
+    same affinity (see job_queue.grading_affinity()) are run where their task's
+    files are cached.
+    """
+    global _scheduler
+    with _executor_lock:
+        if _scheduler is None:
+            if GRADING_QUEUE is not None:
+                # As many at once as the grading workers alive right now can run
+                dispatch, capacity = submit_to_grading_queue, get_grading_fleet_slots
+            else:
+                dispatch, capacity = submit_to_grading_workers, GRADING_WORKERS
+            _scheduler = GradingScheduler(
+                dispatch,
+                capacity,
+                GRADING_LANE_WEIGHTS,
+                GRADING_LANE_INTERACTIVE,
+                GRADING_INTERACTIVE_RESERVED_WORKERS,
+                GRADING_MAX_OUTSTANDING_PER_ZID,
+                {
+                    queue_lane: GRADING_MAX_QUEUED_BATCH
+                    if queue_lane == GRADING_LANE_BATCH
+                    else GRADING_MAX_QUEUED_PER_LANE
+                    for queue_lane in GRADING_LANE_WEIGHTS
+                },
+                GRADING_INITIAL_SERVICE_SECONDS,
+            )
+    return _scheduler.schedule(
+        fn,
+        *args,
+        lane=lane,
+        owner=owner,
+        affinity=affinity,
+        admission_control=admission_control,
+    )
+
+
+def submit_grading_job(
+    fn,
+    *args,
+    kind=None,
+    course_code=None,
+    owner_zid=None,
+    lane=GRADING_LANE_INTERACTIVE,
+    task=None,
+    queue_owner=None,
+) -> str:
+    """
+    Runs fn(*args) on a grading worker. fn and its arguments must be picklable, i.e.
+    fn is a module level function, and with a grading queue fn has to be one of
+    job_queue.GRADING_QUEUE_FUNCTIONS and its arguments plain JSON data. kind,
+    course_code and owner_zid are recorded so that endpoints know what the result
+    looks like and who is allowed to see it. The job is scheduled in lane on behalf of queue_owner (owner_zid unless
+    given), next to the other jobs of the same course and task, see
+    schedule_grading(). Returns the job id.
+    """
+    _forget_old_jobs()
+
+    job_id = uuid.uuid4().hex
+    affinity = None if task is None else grading_affinity(course_code, task)
+    future = schedule_grading(
+        fn,
+        *args,
+        lane=lane,
+        owner=owner_zid if queue_owner is None else queue_owner,
+        affinity=affinity,
+    )
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "future": future,
+            "kind": kind,
+            "course_code": course_code,
+            "owner_zid": owner_zid,
+            "finished_at": None,
+            "shared": False,
+        }
+    future.add_done_callback(lambda _: _mark_finished(job_id))
+    return job_id
+
+
+def _mark_finished(job_id):
+    with _jobs_lock:
+        if job_id in _jobs:
+            _jobs[job_id]["finished_at"] = time.monotonic()
+
+
+def _forget_old_jobs():
+    now = time.monotonic()
+    with _jobs_lock:
+        for job_id in list(_jobs.keys()):
+            finished_at = _jobs[job_id]["finished_at"]
+            if (
+                finished_at is not None
+                and now - finished_at > GRADING_JOB_RETENTION_SECONDS
+            ):
+                del _jobs[job_id]
+
+
+def get_grading_job(job_id):
+    """
+    Returns the job dictionary (with "kind", "course_code" and "owner_zid") or None.
+    Only knows the jobs submitted through this web process.
+    """
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def find_grading_job(job_id):
+    """
+    Like get_grading_job(), but also finds jobs submitted through other web
+    processes if they were shared, see share_grading_job(). Those have no
+    "future".
+    """
+    job = get_grading_job(job_id)
+    if job is not None:
+        return job
+
+    record = _shared_grading_jobs().document(job_id).get()
+    if not record.exists or record.get("expiresAt") < time.time():
+        return None
+    return {
+        "future": None,
+        "kind": record.get("kind"),
+        "course_code": record.get("courseCode"),
+        "owner_zid": record.get("ownerZid"),
+    }
+
+
+def share_grading_job(job_id):
+    """
+    Records a job of this web process in Firestore, and its outcome once it has
+    one, so that it can be polled through any web process. Call it before handing
+    the job id out to poll.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job["shared"]:
+            return
+        job["shared"] = True
+
+    _expire_shared_grading_jobs()
+    record = _shared_grading_jobs().document(job_id)
+    try:
+        record.set(
+            {
+                "kind": job["kind"],
+                "courseCode": job["course_code"],
+                "ownerZid": job["owner_zid"],
+                "status": GRADING_JOB_STATUS_RUNNING,
+                "result": None,
+                "error": None,
+                "expiresAt": time.time() + GRADING_SHARED_JOB_MAX_RUNNING_SECONDS,
+            }
+        )
+    except Exception as e:
+        # It can still be polled through this web process
+        logging.error(f"Error sharing grading job {job_id}: {str(e)}")
+        return
+
+    def record_outcome(future):
+        status, result, error = _grading_job_outcome(job_id, future, 0)
+        expires_at = time.time() + GRADING_JOB_RETENTION_SECONDS
+        try:
+            record.set(
+                {
+                    "status": status,
+                    # Compressed, a document can only hold 1MB
+                    "result": (
+                        None
+                        if result is None
+                        else zlib.compress(json.dumps(result).encode("utf-8"))
+                    ),
+                    "error": error,
+                    "expiresAt": expires_at,
+                },
+                merge=True,
+            )
+        except Exception as e:
+            logging.error(
+                f"Error recording grading job {job_id}: {str(e)}", exc_info=True
+            )
+            # Without it the other web processes would wait on the job forever
+            try:
+                record.set(
+                    {
+                        "status": GRADING_JOB_STATUS_FAILED,
+                        "error": f"A server error occurred: {e}.",
+                        "expiresAt": expires_at,
+                    },
+                    merge=True,
+                )
+            except Exception:
+                pass
+
+    job["future"].add_done_callback(record_outcome)
+
+
+def _shared_grading_jobs():
+    # Imported here, firebase connects to Firestore on import and grading workers
+    # never share a job
+    from firebase import db
+
+    return db.collection(GRADING_SHARED_JOBS_COLLECTION)
+
+
+def _expire_shared_grading_jobs():
+    global _shared_jobs_expired_at
+
+    # A query each time would cost more than the records it deletes
+    now = time.time()
+    if now - _shared_jobs_expired_at < GRADING_JOB_RETENTION_SECONDS / 4:
+        return
+    _shared_jobs_expired_at = now
+    try:
+        for record in (
+            _shared_grading_jobs()
+            .where(filter=FieldFilter("expiresAt", "<", now))
+            .stream()
+        ):
+            record.reference.delete()
+    except Exception as e:
+        logging.error(f"Error expiring shared grading jobs: {str(e)}")
+
+
+def get_grading_wait_seconds(requested):
+    """
+    Works out how long an endpoint should wait given what the client asked for.
+    None (the client didn't ask) means until the job has finished.
+    """
+    if requested is None:
+        return None
+    try:
+        return min(max(float(requested), 0), GRADING_MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return None
+
+
+def wait_for_grading_job(job_id, timeout):
+    """
+    Waits up to timeout seconds (None for as long as it takes) for the job. Returns a (status, result, error)
+    tuple where status is one of GRADING_JOB_STATUS_*, result is the return value of
+    the job's function once finished and error is a message if the job crashed.
+    Jobs of other web processes are waited on through their shared record, where
+    the result has been through JSON, so tuples come back as lists.
+    """
+    job = get_grading_job(job_id)
+    if job is not None:
+        return _grading_job_outcome(job_id, job["future"], timeout)
+
+    # The web process running it could die, so this doesn't wait forever
+    deadline = time.monotonic() + (
+        GRADING_MAX_WAIT_SECONDS if timeout is None else timeout
+    )
+    while True:
+        record = _shared_grading_jobs().document(job_id).get()
+        if not record.exists:
+            return None, None, "Job not found"
+        status = record.get("status")
+        if status != GRADING_JOB_STATUS_RUNNING:
+            result = record.get("result")
+            return (
+                status,
+                (
+                    None
+                    if result is None
+                    else json.loads(zlib.decompress(result).decode("utf-8"))
+                ),
+                record.get("error"),
+            )
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return GRADING_JOB_STATUS_RUNNING, None, None
+        time.sleep(min(GRADING_SHARED_JOB_POLL_SECONDS, remaining))
+
+
+def _grading_job_outcome(job_id, future, timeout):
+    try:
+        result = future.result(timeout=timeout)
+        return GRADING_JOB_STATUS_FINISHED, result, None
+    except TimeoutError:
+        return GRADING_JOB_STATUS_RUNNING, None, None
+    except Exception as e:
+        logging.error(f"Grading job {job_id} failed: {str(e)}", exc_info=True)
+        return GRADING_JOB_STATUS_FAILED, None, f"A server error occurred: {e}."